@@ -4,6 +4,7 @@ import numpy as np
 import os, sys, pickle, tempfile, resource
 from neuroanalysis.ui.plot_grid import PlotGrid
 from multipatch_analysis.experiment_list import cached_experiments()
+from multipatch_analysis.result_cache import pickle_result_cache
 from multipatch_analysis.connection_detection import MultiPatchExperimentAnalyzer, EvokedResponseGroup, fit_psp
 from synaptic_properties import find_connections
 
@@ -79,8 +80,7 @@ if __name__ == '__main__':
     indplots.set_shape(len(types), len(types))
     indplots.show()
 
-    cachefile = "first_pulse_average.pkl"
-    cache = pickle.load(open(cachefile, 'rb')) if os.path.isfile(cachefile) else {}
+    cache = pickle_result_cache("first_pulse_average.pkl")
 
     for expt, conns in sorted(conn_expts.items()):
         if expt.source_id not in cache:
@@ -107,9 +107,6 @@ if __name__ == '__main__':
                 print "Skipped:", expt
                 continue
 
-            pkl = pickle.dumps(cache)
-            open(cachefile, 'wb').write(pkl)
-
 
         for conn in cache[expt.source_id]:
             cretypes = conn['types']
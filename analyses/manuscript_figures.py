@@ -12,6 +12,7 @@ from neuroanalysis.filter import bessel_filter
 from neuroanalysis.spike_detection import detect_ic_evoked_spike
 from scipy import stats
 from multipatch_analysis.constants import EXCITATORY_CRE_TYPES, INHIBITORY_CRE_TYPES
+from multipatch_analysis.result_cache import ResultCache, pickle_result_cache
 from statsmodels.stats.multicomp import pairwise_tukeyhsd
 from statsmodels.stats.multicomp import MultiComparison
 app = pg.mkQApp()
@@ -30,6 +31,19 @@ colors_mouse = [(249, 144, 92), #(202, 168, 220)
                 (162, 62, 247)]
 
 def write_cache(cache, cache_file):
+    """Save results under the name *cache_file*.
+
+    A dict is stored entry by entry in the result cache read by
+    synapse_comparison.load_cache(cache_file); a ResultCache is already
+    stored. Anything else is written to a pickle file.
+    """
+    if isinstance(cache, ResultCache):
+        return
+    if isinstance(cache, dict):
+        print("writing cache to disk...")
+        pickle_result_cache(cache_file).import_dict(cache)
+        print("Done!")
+        return
     print("writing cache to disk...")
     pickle.dump(cache, open(cache_file + '.new', 'wb'))
     if os.path.exists(cache_file):
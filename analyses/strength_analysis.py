@@ -12,11 +12,11 @@ from __future__ import print_function, division
 from collections import OrderedDict
 from multipatch_analysis.constants import EXCITATORY_CRE_TYPES, INHIBITORY_CRE_TYPES
 
-import argparse, time, sys, os, pickle, io, multiprocessing
+import argparse, time, sys, os, pickle, io, multiprocessing, threading
 import numpy as np
 import scipy.stats
 
-from sqlalchemy.orm import aliased
+from sqlalchemy.orm import aliased, joinedload, contains_eager
 
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtGui, QtCore
@@ -45,13 +45,13 @@ class TableGroup(object):
 
     def drop_tables(self):
         for k in self.schemas:
-            if k in db.engine.table_names():
-                self[k].__table__.drop(bind=db.engine)
+            if k in db.get_engine().table_names():
+                self[k].__table__.drop(bind=db.get_engine())
 
     def create_tables(self):
         for k in self.schemas:
-            if k not in db.engine.table_names():
-                self[k].__table__.create(bind=db.engine)
+            if k not in db.get_engine().table_names():
+                self[k].__table__.create(bind=db.get_engine())
 
 
 class PulseResponseStrengthTableGroup(TableGroup):
@@ -429,8 +429,34 @@ def rebuild_connectivity(session):
 
 
 @db.default_session
-def list_experiments(session):
-    return session.query(db.Experiment).all()
+def list_experiments(session, filters=None):
+    """Return experiments sorted by acquisition time, with their slices loaded
+    in the same query.
+
+    *filters* may be a dict of {column name: value} used to select experiments
+    in the query. Names are looked up on Experiment, then on Slice; a list or
+    tuple value matches any of its items.
+    """
+    q = session.query(db.Experiment).join(db.Experiment.slice).options(contains_eager(db.Experiment.slice))
+    for name, value in (filters or {}).items():
+        col = getattr(db.Experiment, name, None)
+        if col is None:
+            col = getattr(db.Slice, name)
+        if isinstance(value, (list, tuple)):
+            q = q.filter(col.in_(value))
+        else:
+            q = q.filter(col == value)
+    return q.order_by(db.Experiment.acq_timestamp).all()
+
+
+@db.default_session
+def list_pairs(session, expt_ids):
+    """Return all pairs from the experiments in *expt_ids*, with their pre- and
+    postsynaptic cells loaded in the same query.
+    """
+    q = session.query(db.Pair).filter(db.Pair.expt_id.in_(expt_ids))
+    q = q.options(joinedload(db.Pair.pre_cell), joinedload(db.Pair.post_cell))
+    return q.order_by(db.Pair.id).all()
 
 
 # @db.default_session
@@ -454,40 +480,80 @@ def list_experiments(session):
 
 
 class ExperimentBrowser(pg.TreeWidget):
-    def __init__(self):
+    """Tree of experiments and the cell pairs in each.
+
+    Experiments are read with a single query, and the pairs of an experiment
+    are queried only when its item is first expanded (or one of its pairs is
+    selected). Keyword arguments are passed as *filters* to list_experiments().
+    """
+    def __init__(self, **filters):
         pg.TreeWidget.__init__(self)
         self.setColumnCount(7)
         self.setHeaderLabels(['date', 'rig', 'organism', 'region', 'genotype', 'acsf'])
-        self.populate()
-        self._last_expanded = None
+        self.session = db.Session()
+        self.itemExpanded.connect(self._item_expanded)
+        self.populate(**filters)
         
-    def populate(self):
+    def populate(self, **filters):
+        """Clear the tree and fill it with all experiments matching *filters*.
+        """
+        self.clear()
         self.items_by_pair_id = {}
+        self.items_by_expt_id = {}
+        self._last_expanded = None
         
-        self.session = db.Session()
-        db_expts = list_experiments(session=self.session)
-        db_expts.sort(key=lambda e: e.acq_timestamp)
-        for expt in db_expts:
-            date = expt.acq_timestamp
-            date_str = date.strftime('%Y-%m-%d')
-            slice = expt.slice
-            expt_item = pg.TreeWidgetItem(map(str, [date_str, expt.rig_name, slice.species, expt.target_region, slice.genotype, expt.acsf]))
-            expt_item.expt = expt
-            self.addTopLevelItem(expt_item)
-
-            for pair in expt.pairs:
-                cells = '%d => %d' % (pair.pre_cell.ext_id, pair.post_cell.ext_id)
-                conn = {True:"connected", False:"unconnected", None:"?"}[pair.synapse]
-                types = 'L%s %s => L%s %s' % (pair.pre_cell.target_layer or "?", pair.pre_cell.cre_type, pair.post_cell.target_layer or "?", pair.post_cell.cre_type)
-                pair_item = pg.TreeWidgetItem([cells, conn, types])
-                expt_item.addChild(pair_item)
-                pair_item.pair = pair
-                pair_item.expt = expt
-                self.items_by_pair_id[pair.id] = pair_item
+        db_expts = list_experiments(session=self.session, filters=filters)
+        self.setUpdatesEnabled(False)
+        try:
+            for expt in db_expts:
+                date = expt.acq_timestamp
+                date_str = date.strftime('%Y-%m-%d')
+                slice = expt.slice
+                expt_item = pg.TreeWidgetItem(map(str, [date_str, expt.rig_name, slice.species, expt.target_region, slice.genotype, expt.acsf]))
+                expt_item.expt = expt
+                expt_item.pairs_loaded = False
+                # show an expand arrow before pairs are loaded
+                expt_item.setChildIndicatorPolicy(QtGui.QTreeWidgetItem.ShowIndicator)
+                self.addTopLevelItem(expt_item)
+                self.items_by_expt_id[expt.id] = expt_item
+        finally:
+            self.setUpdatesEnabled(True)
+
+    def _item_expanded(self, item):
+        if getattr(item, 'pairs_loaded', True) is False:
+            self.load_pairs([item])
+
+    def load_pairs(self, expt_items):
+        """Add pair items below each of *expt_items* (using one query for all).
+        """
+        expt_items = [item for item in expt_items if not item.pairs_loaded]
+        if len(expt_items) == 0:
+            return
+        items = dict([(item.expt.id, item) for item in expt_items])
+        for pair in list_pairs(session=self.session, expt_ids=list(items.keys())):
+            expt_item = items[pair.expt_id]
+            cells = '%d => %d' % (pair.pre_cell.ext_id, pair.post_cell.ext_id)
+            conn = {True:"connected", False:"unconnected", None:"?"}[pair.synapse]
+            types = 'L%s %s => L%s %s' % (pair.pre_cell.target_layer or "?", pair.pre_cell.cre_type, pair.post_cell.target_layer or "?", pair.post_cell.cre_type)
+            pair_item = pg.TreeWidgetItem([cells, conn, types])
+            expt_item.addChild(pair_item)
+            pair_item.pair = pair
+            pair_item.expt = expt_item.expt
+            self.items_by_pair_id[pair.id] = pair_item
+        for item in expt_items:
+            item.pairs_loaded = True
+            if item.childCount() == 0:
+                item.setChildIndicatorPolicy(QtGui.QTreeWidgetItem.DontShowIndicatorWhenChildless)
                 
     def select(self, pair_id):
         """Select a specific pair from the list
         """
+        if pair_id not in self.items_by_pair_id:
+            expt_id = self.session.query(db.Pair.expt_id).filter(db.Pair.id==pair_id).scalar()
+            if expt_id not in self.items_by_expt_id:
+                # experiment is excluded by the current filters
+                return
+            self.load_pairs([self.items_by_expt_id[expt_id]])
         if self._last_expanded is not None:
             self._last_expanded.setExpanded(False)
         item = self.items_by_pair_id[pair_id]
@@ -639,6 +705,153 @@ def join_pulse_response_to_expt(query):
     return query, pre_rec, post_rec
 
 
+def strength_record_query(session, source, ids):
+    """Build a query for the response_query ('fg') or baseline_query ('bg')
+    records belonging to the strength table rows with *ids*. Each record
+    has the strength row ID in its `strength_id` column.
+    """
+    if source == 'fg':
+        q = response_query(session).add_columns(PulseResponseStrength.id.label('strength_id'))
+        q = q.join(PulseResponseStrength)
+        q = q.filter(PulseResponseStrength.id.in_(ids))
+    else:
+        q = baseline_query(session).add_columns(BaselineResponseStrength.id.label('strength_id'))
+        q = q.join(BaselineResponseStrength)
+        q = q.filter(BaselineResponseStrength.id.in_(ids))
+    return q
+
+
+class TraceCache(object):
+    """LRU cache of analyze_response_strength() results for individual
+    records, keyed by (source, strength ID, lpf, remove_artifacts, bsub).
+
+    Safe to use from multiple threads; the cached results must not be modified.
+    """
+    def __init__(self, max_size=5000):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(source, rec_id, params):
+        return (source, int(rec_id), params['lpf'], params['remove_artifacts'], params['bsub'])
+
+    def cached(self, source, ids, params):
+        """Return {id: result} for the *ids* that are in the cache.
+        """
+        results = {}
+        with self._lock:
+            for rec_id in ids:
+                key = self.key(source, rec_id, params)
+                result = self._cache.pop(key, None)
+                if result is not None:
+                    self._cache[key] = result
+                    results[int(rec_id)] = result
+        return results
+
+    def load(self, session, source, ids, params):
+        """Return {id: result} for all *ids*, querying and analyzing those
+        that are not cached yet.
+        """
+        results = self.cached(source, ids, params)
+        missing = [int(rec_id) for rec_id in ids if int(rec_id) not in results]
+        if len(missing) == 0:
+            return results
+        s = {'fg': 'pulse_response', 'bg': 'baseline'}[source]
+        for rec in strength_record_query(session, source, missing).all():
+            result = analyze_response_strength(rec, source=s, **params)
+            results[rec.strength_id] = result
+            self._add(self.key(source, rec.strength_id, params), result)
+        return results
+
+    def _add(self, key, result):
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = result
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+
+class TraceLoader(QtCore.QThread):
+    """Loads records into a TraceCache in a background thread, using its own
+    DB session.
+
+    request() jobs are processed first, and sig_loaded(token) is emitted when
+    each is finished. prefetch() jobs are worked through in small chunks
+    while there are no requests; a new prefetch() from the same owner
+    replaces that owner's unfinished prefetch jobs.
+    """
+    sig_loaded = QtCore.Signal(object)
+
+    def __init__(self, cache, chunk_size=100):
+        QtCore.QThread.__init__(self)
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self._requests = []
+        self._prefetch = OrderedDict()  # owner: list of (source, ids, params) chunks
+        self._cond = threading.Condition()
+        self._stop = False
+
+    def request(self, token, source, ids, params):
+        with self._cond:
+            self._requests.append((token, source, list(ids), params))
+            self._cond.notify()
+
+    def prefetch(self, owner, jobs):
+        """Replace the pending prefetch work of *owner* with *jobs*, a list of
+        (source, ids, params).
+        """
+        chunks = []
+        for source, ids, params in jobs:
+            ids = list(ids)
+            for i in range(0, len(ids), self.chunk_size):
+                chunks.append((source, ids[i:i+self.chunk_size], params))
+        with self._cond:
+            self._prefetch[owner] = chunks
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self.wait()
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                if self._stop:
+                    return None
+                if len(self._requests) > 0:
+                    return self._requests.pop(0)
+                for owner, chunks in list(self._prefetch.items()):
+                    if len(chunks) == 0:
+                        del self._prefetch[owner]
+                        continue
+                    # rotate owners so each gets a turn
+                    del self._prefetch[owner]
+                    self._prefetch[owner] = chunks[1:]
+                    return (None,) + chunks[0]
+                self._cond.wait()
+
+    def run(self):
+        session = db.Session()
+        try:
+            while True:
+                job = self._next_job()
+                if job is None:
+                    break
+                token, source, ids, params = job
+                try:
+                    self.cache.load(session, source, ids, params)
+                except Exception:
+                    session.rollback()
+                    sys.excepthook(*sys.exc_info())
+                if token is not None:
+                    self.sig_loaded.emit(token)
+        finally:
+            session.close()
+
+
 class ResponseStrengthPlots(QtGui.QWidget):
     def __init__(self, session):
         QtGui.QWidget.__init__(self)
@@ -648,10 +861,16 @@ class ResponseStrengthPlots(QtGui.QWidget):
         self.setLayout(self.layout)
         self.layout.setContentsMargins(0, 0, 0, 0)
 
+        # decoded / deconvolved traces are shared by all analyzers
+        self.trace_cache = TraceCache()
+        self.trace_loader = TraceLoader(self.trace_cache)
+        self.trace_loader.start()
+        QtGui.QApplication.instance().aboutToQuit.connect(self.trace_loader.stop)
+
         self.analyses = ['neg', 'pos']
         self.analyzers = []
         for col, analysis in enumerate(self.analyses):
-            analyzer = ResponseStrengthAnalyzer(analysis, session)
+            analyzer = ResponseStrengthAnalyzer(analysis, session, self.trace_cache, self.trace_loader)
             self.analyzers.append(analyzer)
             self.layout.addWidget(analyzer.widget, 0, col)
                 
@@ -665,9 +884,17 @@ class ResponseStrengthPlots(QtGui.QWidget):
 
 
 class ResponseStrengthAnalyzer(object):
-    def __init__(self, analysis, session):
+    # plot_prd_ids loads at most this many uncached traces on the GUI thread;
+    # larger selections are loaded by the TraceLoader and replotted when ready
+    sync_load_limit = 20
+
+    def __init__(self, analysis, session, trace_cache, trace_loader):
         self.analysis = analysis  # 'pos' or 'neg'
         self.session = session
+        self.trace_cache = trace_cache
+        self.trace_loader = trace_loader
+        self._pending_plots = {}  # id(trace_list): (token, plot_prd_ids args)
+        self.trace_loader.sig_loaded.connect(self._traces_loaded)
 
         self.widget = QtGui.QWidget()
         self.layout = QtGui.QGridLayout()
@@ -753,6 +980,8 @@ class ResponseStrengthAnalyzer(object):
         self._selected_bg_ids = []
         self._clicked_fg_ids = []
         self._clicked_bg_ids = []
+        self.fg_data = None
+        self.bg_data = None
     
     def fg_scatter_clicked(self, sp, points):
         """Point(s) were clicked; plot their source traces in a different color.
@@ -815,6 +1044,7 @@ class ResponseStrengthAnalyzer(object):
         self.bg_x = bg_x
         self.fg_data = fg_data
         self.bg_data = bg_data
+        self.prefetch_traces()
 
         # set event region, but don't update (it's too expensive)
         try:
@@ -848,31 +1078,65 @@ class ResponseStrengthAnalyzer(object):
         self.plot_prd_ids(fg_ids, 'fg', trace_list=self.selected_fg_traces, avg=True)
         self.plot_prd_ids(bg_ids, 'bg', trace_list=self.selected_bg_traces, avg=True)
 
+    def trace_params(self):
+        """Return the analyze_response_strength() options selected in the UI.
+        """
+        return {
+            'lpf': self.lpf_check.isChecked(),
+            'remove_artifacts': self.ar_check.isChecked(),
+            'bsub': self.bsub_check.isChecked(),
+        }
+
+    def prefetch_traces(self):
+        """Start loading traces for all fg and bg records of the current pair
+        in the background, using the current filter options.
+        """
+        if self.fg_data is None:
+            return
+        params = self.trace_params()
+        self.trace_loader.prefetch(self, [('fg', self.fg_data['id'], params), ('bg', self.bg_data['id'], params)])
+
+    def _traces_loaded(self, token):
+        for key, (pending_token, args) in list(self._pending_plots.items()):
+            if pending_token is token:
+                del self._pending_plots[key]
+                # load anything evicted in the meantime here rather than requesting it again
+                self.plot_prd_ids(*args, background=False)
+
     def replot_all(self):
+        self.prefetch_traces()
         self.plot_prd_ids(self._selected_fg_ids, 'fg', pen=None, trace_list=self.selected_fg_traces, avg=True)
         self.plot_prd_ids(self._selected_bg_ids, 'bg', pen=None, trace_list=self.selected_bg_traces, avg=True)
         self.plot_prd_ids(self._clicked_fg_ids, 'fg', pen='y', trace_list=self.clicked_fg_traces)
         self.plot_prd_ids(self._clicked_bg_ids, 'bg', pen='y', trace_list=self.clicked_bg_traces)
 
-    def plot_prd_ids(self, ids, source, pen=None, trace_list=None, avg=False):
+    def plot_prd_ids(self, ids, source, pen=None, trace_list=None, avg=False, background=True):
         """Plot raw or decolvolved PulseResponse data, given IDs of records in
         a PulseResponseStrength table.
+
+        Traces are taken from the trace cache. If many are not cached yet (and
+        *background* is True), the cached ones are plotted now and the rest are
+        loaded in the background, after which the plot is redrawn.
         """
         with pg.BusyCursor():
             if source == 'fg':
-                q = response_query(self.session)
-                q = q.join(PulseResponseStrength)
-                q = q.filter(PulseResponseStrength.id.in_(ids))
-                traces = self.selected_fg_traces
                 plot = self.fg_trace_plot
             else:
-                q = baseline_query(self.session)
-                q = q.join(BaselineResponseStrength)
-                q = q.filter(BaselineResponseStrength.id.in_(ids))
-                traces = self.selected_bg_traces
                 plot = self.bg_trace_plot
-            recs = q.all()
-            if len(recs) == 0:
+            params = self.trace_params()
+
+            # a newer plot into this trace list supersedes any pending one
+            self._pending_plots.pop(id(trace_list), None)
+            results = self.trace_cache.cached(source, ids, params)
+            missing = [rec_id for rec_id in ids if int(rec_id) not in results]
+            if len(missing) > 0 and (len(missing) <= self.sync_load_limit or not background):
+                results.update(self.trace_cache.load(self.session, source, missing, params))
+            elif len(missing) > 0:
+                token = object()
+                self._pending_plots[id(trace_list)] = (token, (ids, source, pen, trace_list, avg))
+                self.trace_loader.request(token, source, missing, params)
+            results = [results[int(rec_id)] for rec_id in ids if int(rec_id) in results]
+            if len(results) == 0:
                 return
             
             for i in trace_list[:]:
@@ -880,17 +1144,13 @@ class ResponseStrengthAnalyzer(object):
                 trace_list.remove(i)
                 
             if pen is None:
-                alpha = np.clip(1000 / len(recs), 30, 255)
+                alpha = np.clip(1000 / len(results), 30, 255)
                 pen = (255, 255, 255, alpha)
                 
             traces = []
             spike_times = []
             spike_values = []
-            for rec in recs:
-                s = {'fg': 'pulse_response', 'bg': 'baseline'}[source]
-                result = analyze_response_strength(rec, source=s, lpf=self.lpf_check.isChecked(), 
-                                                   remove_artifacts=self.ar_check.isChecked(), bsub=self.bsub_check.isChecked())
-
+            for result in results:
                 if self.deconv_check.isChecked():
                     trace = result['dec_trace']
                 else:
@@ -902,7 +1162,8 @@ class ResponseStrengthAnalyzer(object):
                 
                 spike_values.append(trace.value_at([result['spike_time']])[0])
                 if self.align_check.isChecked():
-                    trace.t0 = -result['spike_time']
+                    # copy; cached traces must not be modified
+                    trace = trace.copy(t0=-result['spike_time'])
                     spike_times.append(0)
                 else:
                     spike_times.append(result['spike_time'])
@@ -19,6 +19,7 @@ import re
 
 from multipatch_analysis.synaptic_dynamics import DynamicsAnalyzer
 from multipatch_analysis.experiment_list import cached_experiments
+from multipatch_analysis.result_cache import pickle_result_cache
 from neuroanalysis.baseline import float_mode
 from neuroanalysis.data import Trace, TraceList
 from neuroanalysis.filter import bessel_filter
@@ -34,25 +35,18 @@ def arg_to_date(arg):
     parts = re.split('\D+', arg)
     return datetime.date(*map(int, parts))
 
-def load_cache(cache_file):
-    if os.path.exists(cache_file):
-        try:
-            result_cache = pickle.load(open(cache_file, 'rb'))
-            print ('loaded cache')
-        except:
-            result_cache = {}
-            sys.excepthook(*sys.exc_info())
-            print ('Error loading cache')
-    else:
-        result_cache = {}
-
-    return result_cache
+def load_cache(cache_file, version=0):
+    """Return the persistent result cache for *cache_file*. Entries are read
+    and stored one at a time; an old pickle cache with this name is imported
+    on first use. Increment *version* when the cached analysis changes.
+    """
+    return pickle_result_cache(cache_file, version=version)
 
 def responses(expt, pre, post):
     key = (expt.nwb_file, pre, post)
     result_cache = load_cache(result_cache_file)
-    if key in result_cache:
-        res = result_cache[key]
+    res = result_cache.get(key, source_file=expt.nwb_file)
+    if res is not None:
         if 'avg_est' not in res:
             return None, None, None
         avg_est = res['avg_est']
@@ -63,14 +57,13 @@ def responses(expt, pre, post):
     analyzer = DynamicsAnalyzer(expt, pre, post, align_to='spike')
     avg_est, _, avg_amp, _, n_sweeps = analyzer.estimate_amplitude(plot=False)
     if n_sweeps == 0:
-        result_cache[key] = {}
+        res = {}
         ret = None, None, n_sweeps
     else:
-        result_cache[key] = {'avg_est': avg_est, 'data': avg_amp.data, 'dt': avg_amp.dt, 'n_sweeps': n_sweeps}
+        res = {'avg_est': avg_est, 'data': avg_amp.data, 'dt': avg_amp.dt, 'n_sweeps': n_sweeps}
         ret = avg_est, avg_amp, n_sweeps
 
-    data = pickle.dumps(result_cache)
-    open(result_cache_file, 'wb').write(data)
+    result_cache.set(key, res, source_file=expt.nwb_file)
     print (key)
     return ret
 
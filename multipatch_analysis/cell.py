@@ -8,15 +8,61 @@ class Cell(object):
     def __init__(self, expt, cell_id):
         self.expt = expt
         self.cell_id = cell_id
-        self.access_qc = None
-        self.holding_qc = None
-        self.spiking_qc = None
+        self._access_qc = None
+        self._holding_qc = None
+        self._spiking_qc = None
         self._morphology = {}
         self.labels = {}
         self._raw_labels = {}
-        self.position = None
+        self._position = None
         self._target_layer = None
 
+    def __setstate__(self, state):
+        # cells pickled before these became properties stored them as plain attributes
+        for k in ('access_qc', 'holding_qc', 'spiking_qc', 'position'):
+            if k in state:
+                state['_' + k] = state.pop(k)
+        self.__dict__.update(state)
+
+    @property
+    def access_qc(self):
+        self.expt._load_deferred_qc()
+        return self._access_qc
+
+    @access_qc.setter
+    def access_qc(self, qc):
+        self._access_qc = qc
+
+    @property
+    def holding_qc(self):
+        self.expt._load_deferred_qc()
+        return self._holding_qc
+
+    @holding_qc.setter
+    def holding_qc(self, qc):
+        self._holding_qc = qc
+
+    @property
+    def spiking_qc(self):
+        self.expt._load_deferred_qc()
+        return self._spiking_qc
+
+    @spiking_qc.setter
+    def spiking_qc(self, qc):
+        self._spiking_qc = qc
+
+    @property
+    def position(self):
+        """The (x, y, z) position of this cell, read from the site mosaic, or
+        None if it is unknown.
+        """
+        self.expt._load_deferred_positions()
+        return self._position
+
+    @position.setter
+    def position(self, pos):
+        self._position = pos
+
     @property
     def pass_qc(self):
         """True if cell passes QC.
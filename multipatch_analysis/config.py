@@ -13,10 +13,15 @@ synphys_db = "synphys"
 synphys_db_readonly_user = None
 synphys_data = None
 cache_path = "cache"
+cache_max_size = None      # bytes; None for no limit
+cache_eviction = 'lru'     # 'lru' or 'lfu'
 rig_name = None
 n_headstages = 8
 raw_data_paths = []
 summary_files = []
+lims_cache_file = None      # default is cache_path/lims_cache.sqlite; False disables the cache
+lims_cache_ttl = 24 * 3600  # seconds before cached LIMS records are fetched again
+lims_offline = False
 
 
 template = """
@@ -35,13 +40,21 @@ summary_files:
 """
 
 configfile = os.path.join(os.path.dirname(__file__), '..', 'config.yml')
-if not os.path.isfile(configfile):
-    open(configfile, 'wb').write(template)
 
-config = yaml.load(open(configfile, 'rb'))
 
-for k,v in config.items():
-    locals()[k] = v
+def write_template(filename=configfile):
+    """Write an example config.yml to be edited with site-specific values.
+    """
+    open(filename, 'wb').write(template)
+
+
+# If there is no config.yml, the defaults above are used (call write_template() to create one).
+if os.path.isfile(configfile):
+    # the C loader is much faster to import and parse with, where available
+    config = yaml.load(open(configfile, 'rb'), Loader=getattr(yaml, 'CLoader', yaml.Loader))
+
+    for k,v in config.items():
+        locals()[k] = v
 
 
 
@@ -1,14 +1,12 @@
 from copy import deepcopy
 import numpy as np
 import scipy.signal
-import pyqtgraph as pg
 
 from .data import MultiPatchProbe, Analyzer, PulseStimAnalyzer
 from . import qc
 from neuroanalysis.stats import ragged_mean
 from neuroanalysis.data import Trace, TraceList
 from neuroanalysis.fitting import StackedPsp
-from neuroanalysis.ui.plot_grid import PlotGrid
 from neuroanalysis.filter import bessel_filter
 
 
@@ -325,6 +323,10 @@ class NDDict(object):
 
 
 def plot_response_averages(expt, show_baseline=False, **kwds):
+    # Qt is imported here so that headless analysis does not need it
+    import pyqtgraph as pg
+    from neuroanalysis.ui.plot_grid import PlotGrid
+
     analyzer = MultiPatchExperimentAnalyzer.get(expt)
     devs = analyzer.list_devs()
 
@@ -149,3 +149,95 @@ class PulseStimAnalyzer(Analyzer):
         rec_delay = np.round(dt*np.diff(pulses).max(), 3)
         
         return ind_freq, rec_delay
+
+
+def crosstalk_edges(channels, on_times, off_times, max_distance=3):
+    """Return, for each channel, the sample indices of stimulus edges on nearby
+    headstages that cause capacitive artifacts in that channel.
+
+    Parameters
+    ----------
+    channels : list
+        Headstage number of each channel
+    on_times, off_times : list of arrays
+        Sample indices of the pulse onsets / offsets in each channel's stimulus
+    max_distance : int
+        Headstages further apart than this are assumed not to interfere
+
+    Returns a list with one int array per channel, ordered by source channel and
+    then by pulse (onset before offset).
+    """
+    edges = []
+    for j in range(len(channels)):
+        tgt_edges = []
+        for i in range(len(channels)):
+            if i == j or abs(channels[i] - channels[j]) > max_distance:
+                continue
+            n = min(len(on_times[i]), len(off_times[i]))
+            src = np.empty(n * 2, dtype=int)
+            src[0::2] = on_times[i][:n]
+            src[1::2] = off_times[i][:n]
+            tgt_edges.append(src)
+        edges.append(np.concatenate(tgt_edges) if len(tgt_edges) > 0 else np.empty(0, dtype=int))
+    return edges
+
+
+def remove_artifact_windows(data, edges, window):
+    """Return a copy of *data* in which the *window* samples following each edge
+    are replaced by the mean of the *window* samples preceding it.
+
+    Parameters
+    ----------
+    data : array
+        Recordings with shape (channels, samples) or (sweeps, channels, samples)
+    edges : list of arrays
+        Sample indices of artifact onsets for each channel, eg. from crosstalk_edges()
+    window : int
+        Number of samples to replace after each edge
+
+    All windows in all channels and sweeps are replaced at once: the means are
+    taken from a cumulative sum of the original data, and written with a single
+    fancy-indexed assignment. Where windows in a channel overlap, the edge that
+    comes later in *edges* takes precedence.
+    """
+    data = np.asarray(data)
+    out = data.copy()
+    window = int(window)
+    if data.ndim == 2:
+        data = data[None, ...]
+        view = out[None, ...]
+    else:
+        view = out
+    n_samples = data.shape[-1]
+
+    chans = np.concatenate([np.zeros(len(e), dtype=int) + i for i, e in enumerate(edges)] + [np.empty(0, dtype=int)])
+    starts = np.concatenate([np.asarray(e, dtype=int) for e in edges] + [np.empty(0, dtype=int)])
+    keep = (starts >= 0) & (starts < n_samples)
+    chans = chans[keep]
+    starts = starts[keep]
+    if window <= 0 or len(starts) == 0:
+        return out
+
+    # mean of the window preceding each edge, for all sweeps at once
+    csum = np.zeros(data.shape[:-1] + (n_samples + 1,))
+    np.cumsum(data, axis=-1, out=csum[..., 1:])
+    pre = np.maximum(starts - window, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (csum[:, chans, starts] - csum[:, chans, pre]) / (starts - pre)
+
+    # indices of every sample to be replaced
+    cols = starts[:, None] + np.arange(window)[None, :]
+    rows = np.repeat(chans[:, None], window, axis=1)
+    src = np.repeat(np.arange(len(starts))[:, None], window, axis=1)
+    valid = cols < n_samples
+
+    rows, cols, src = rows[valid], cols[valid], src[valid]
+
+    # numpy does not define which value wins when an index is assigned twice,
+    # so where windows overlap only the entry from the last edge is kept
+    flat = rows * n_samples + cols
+    _, last = np.unique(flat[::-1], return_index=True)
+    last = len(flat) - 1 - last
+
+    view[:, rows[last], cols[last]] = means[:, src[last]]
+    return out
@@ -365,10 +365,36 @@ def create_all_mappings():
 
 #-------------- initial DB access ----------------
 
-engine = create_engine(config.synphys_db_host + '/' + config.synphys_db)
+# The engine is created on first use rather than at import, so that importing
+# this module does not require a configured DB host (or the DB driver).
+_engine = None
+
+def get_engine():
+    """Return the engine for config.synphys_db, creating it if needed.
+    """
+    global _engine
+    if _engine is None:
+        if config.synphys_db_host is None:
+            raise Exception("No database configured (set synphys_db_host in config.yml)")
+        _engine = create_engine(config.synphys_db_host + '/' + config.synphys_db)
+    return _engine
+
+
+class _Session(sqlalchemy.orm.Session):
+    """Session that binds to get_engine() unless another bind is given.
+    """
+    def __init__(self, bind=None, **kwds):
+        if bind is None:
+            bind = get_engine()
+        sqlalchemy.orm.Session.__init__(self, bind=bind, **kwds)
+
+
 # external users should create sessions from here.
-Session = sessionmaker(bind=engine)
+Session = sessionmaker(class_=_Session)
 
+# Mapping classes must be module attributes (db.Experiment, etc.), so they are
+# generated here. This does not touch the DB; sqlalchemy defers configuring
+# mappers and relationships until the first query.
 create_all_mappings()
 
 
@@ -388,8 +414,11 @@ def reset_db():
         conn.execute('create database %s' % config.synphys_db)
 
     # reconnect to DB
-    global engine
-    engine = create_engine(config.synphys_db_host + '/' + config.synphys_db)
+    global _engine
+    if _engine is not None:
+        _engine.dispose()
+    _engine = None
+    engine = get_engine()
 
     # Grant readonly permissions
     ro_user = config.synphys_db_readonly_user
@@ -410,7 +439,7 @@ def vacuum(tables=None):
     """Cleans up database and analyzes table statistics in order to improve query planning.
     Should be run after any significant changes to the database.
     """
-    with engine.begin() as conn:
+    with get_engine().begin() as conn:
         conn.connection.set_isolation_level(0)
         if tables is None:
             conn.execute('vacuum analyze')
@@ -456,4 +485,11 @@ def experiment_from_timestamp(ts, session=None):
     return expts[0]
 
 
+@default_session
+def experiment_timestamps(session=None):
+    """Return the set of acq_timestamps (datetime) of all experiments in the DB.
 
+    This is a single query, so it is much faster than calling
+    experiment_from_timestamp() for many experiments.
+    """
+    return set(row[0] for row in session.query(Experiment.acq_timestamp).all())
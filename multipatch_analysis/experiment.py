@@ -22,12 +22,26 @@ from .electrode import Electrode
 from .data import MultiPatchExperiment
 from .pipette_metadata import PipetteMetadata
 from .genotypes import Genotype
-from .synphys_cache import SynPhysCache
+from .synphys_cache import get_cache
+from .experiment_paths import experiment_path_index
 from . import yaml_local, config
 
 
 class Experiment(object):
-    def __init__(self, entry=None, yml_file=None):
+    """Metadata describing a single multipatch experiment (one recording site).
+
+    By default, the experiment is fully validated at construction time: LIMS
+    records are checked, the NWB file is located, cell positions are read from
+    the site mosaic, and cell QC is derived from the NWB file if it is not
+    recorded in pipettes.yml.
+
+    If *lazy* is True, all of these are deferred until the relevant attributes
+    are first accessed (see validate()). If *metadata_only* is True, the NWB file
+    is additionally never opened to derive cell QC and the site mosaic is never
+    read; cells without recorded QC have QC values of None, and cell positions
+    are not loaded.
+    """
+    def __init__(self, entry=None, yml_file=None, lazy=False, metadata_only=False):
         self.entry = entry
         self.source_id = (None, None)
         self.electrodes = None
@@ -46,12 +60,16 @@ class Experiment(object):
         self._mosaic_file = None
         self._nwb_file = None
         self._data = None
+        self._nwb_pin = None
         self._stim_list = None
         self._genotype = None
         self._cre_types = None
         self._labels = None
         self._target_layers = None
         self._rig_name = None
+        self._metadata_only = metadata_only
+        self._positions_loaded = False
+        self._pending_qc = []
         
         if entry is not None:
             self._load_old_format(entry)
@@ -68,6 +86,13 @@ class Experiment(object):
                     if crepart != 'unknown' and crepart not in cell.labels:
                         raise Exception('Cre type "%s" not in cell.labels: %s' % (crepart, cell.labels.keys()))
 
+        if not (lazy or metadata_only):
+            self.validate()
+
+    def validate(self):
+        """Load and check all metadata that is deferred when the experiment is
+        constructed with lazy=True.
+        """
         # pull donor/specimen info from LIMS
         if self.lims_record['organism'] == 'mouse':
             # lots of human donors are missing age.
@@ -78,12 +103,82 @@ class Experiment(object):
             self.nwb_file
 
             # read cell positions from mosaic files
-            try:
-                self.load_cell_positions()
-            except Exception as exc:
-                sys.excepthook(*sys.exc_info())
-                print("Warning: Could not load cell positions for %s (exception printed above)" % (self,))
+            self._load_deferred_positions()
+
+        self._load_deferred_qc()
+
+    @property
+    def metadata_only(self):
+        """True if this experiment was loaded with metadata_only=True, so its
+        cell QC and positions may be incomplete.
+        """
+        return self._metadata_only
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # cache pins hold open lock files and only apply to this process
+        state['_nwb_pin'] = None
+        return state
+
+    def __setstate__(self, state):
+        # experiments pickled before lazy loading was added were fully loaded
+        self._metadata_only = False
+        self._positions_loaded = True
+        self._pending_qc = []
+        self._nwb_pin = None
+        self.__dict__.update(state)
+
+    def _load_deferred_positions(self):
+        """Read cell positions from the site mosaic, if this has not been attempted yet.
+
+        This is skipped for metadata-only experiments.
+        """
+        if self._positions_loaded or self._metadata_only:
+            return
+        self._positions_loaded = True
+        try:
+            self.load_cell_positions()
+        except Exception as exc:
+            sys.excepthook(*sys.exc_info())
+            print("Warning: Could not load cell positions for %s (exception printed above)" % (self,))
 
+    def _load_deferred_qc(self):
+        """Derive QC for cells that have no QC recorded in pipettes.yml, by scanning
+        holding potentials in the NWB file.
+
+        Holding QC requires at least 5 recordings with baseline current < 800 pA
+        (VC) or baseline potential between -75 and -50 mV (IC). This is skipped
+        for metadata-only experiments.
+        """
+        if len(self._pending_qc) == 0 or self._metadata_only:
+            return
+        pending = self._pending_qc
+        self._pending_qc = []
+        nwb = self.data
+        try:
+            for cell, chan in pending:
+                passed_holding = 0
+                for srec in nwb.contents:
+                    try:
+                        rec = srec[chan]
+                    except KeyError:
+                        continue
+                    if rec.clamp_mode == 'vc':
+                        if abs(rec.baseline_current) < 800e-12:
+                            passed_holding += 1
+                    else:
+                        vm = rec.baseline_potential
+                        if vm > -75e-3 and vm < -50e-3:
+                            passed_holding += 1
+                    if passed_holding >= 5:
+                        break
+                if passed_holding >= 5:
+                    cell.holding_qc = True
+                    # need to fix these!
+                    cell.access_qc = True
+                    cell.spiking_qc = True
+        finally:
+            self.close_data()
 
     @staticmethod
     def _id_from_entry(entry):
@@ -276,32 +371,8 @@ class Experiment(object):
                         qc_pass = qc_pass in '+/'
                     setattr(cell, k+'_qc', qc_pass)
             else:
-                # derive from NWB
-                nwb = self.data
-                try:
-                    chan = pip_meta['ad_channel']
-                    passed_holding = 0
-                    for srec in nwb.contents:
-                        try:
-                            rec = srec[chan]
-                        except KeyError:
-                            continue
-                        if rec.clamp_mode == 'vc':
-                            if abs(rec.baseline_current) < 800e-12:
-                                passed_holding += 1
-                        else:
-                            vm = rec.baseline_potential
-                            if vm > -75e-3 and vm < -50e-3:
-                                passed_holding += 1
-                        if passed_holding >= 5:
-                            break
-                    if passed_holding >= 5:
-                        cell.holding_qc = True
-                        # need to fix these!
-                        cell.access_qc = True
-                        cell.spiking_qc = True
-                finally:
-                    self.close_data()
+                # derive from NWB when QC is first needed
+                self._pending_qc.append((cell, pip_meta['ad_channel']))
                 
         # load connections
         for cell in self.cells.values():
@@ -690,7 +761,7 @@ class Experiment(object):
     @property
     def nwb_cache_file(self):
         try:
-            return SynPhysCache().get_cache(self.nwb_file)
+            return get_cache().get_cache(self.nwb_file)
         except:
             # deprecated soon..
             if not os.path.isdir('cache'):
@@ -715,15 +786,34 @@ class Experiment(object):
         """
         if self._data is None:
             try:
-                self._data = MultiPatchExperiment(self.nwb_cache_file)
+                self._data = MultiPatchExperiment(self._pin_nwb_cache_file())
             except IOError:
-                os.remove(self.nwb_cache_file)
-                self._data = MultiPatchExperiment(self.nwb_cache_file)
+                cache_file = self._pin_nwb_cache_file()
+                self._release_nwb_pin()
+                os.remove(cache_file)
+                self._data = MultiPatchExperiment(self._pin_nwb_cache_file())
         return self._data
 
+    def _pin_nwb_cache_file(self):
+        """Return nwb_cache_file, keeping it in the synphys cache until
+        close_data() is called.
+        """
+        if self._nwb_pin is None:
+            try:
+                self._nwb_pin = get_cache().pin(self.nwb_file)
+            except Exception:
+                return self.nwb_cache_file
+        return self._nwb_pin.filename
+
+    def _release_nwb_pin(self):
+        if self._nwb_pin is not None:
+            self._nwb_pin.release()
+            self._nwb_pin = None
+
     def close_data(self):
         self.data.close()
         self._data = None
+        self._release_nwb_pin()
 
     @property
     def specimen_id(self):
@@ -850,9 +940,7 @@ class Experiment(object):
         """The path of this experiment relative to the server storage directory.
         """
         expt_timestamp = self.expt_info['__timestamp__']
-        path_file = os.path.join(config.synphys_data, 'experiment_path_cache.pkl')
-        paths = pickle.load(open(path_file, 'rb'))
-        expt_path = paths.get(expt_timestamp, None)
+        expt_path = experiment_path_index().lookup(expt_timestamp, refresh=False)
         if expt_path is None:
             return None
         rel = self.path.split(os.path.sep)[-2:]
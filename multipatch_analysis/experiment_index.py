@@ -0,0 +1,438 @@
+# *-* coding: utf-8 *-*
+"""
+Indexed on-disk store of experiment metadata.
+
+The index is a single SQLite file with one row per experiment, cell and probed
+pair. Experiment rows carry the summary columns needed to select and summarize
+experiments, plus a pickle of the complete Experiment object that is only
+unpickled when the experiment is actually used. This allows analysis scripts to
+start without unpickling the entire ExperimentList.
+"""
+from __future__ import print_function, division
+import os
+import sys
+import json
+import pickle
+import sqlite3
+import datetime
+
+
+class ExperimentIndex(object):
+    """SQLite-backed index of experiments, cells and probed pairs.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the index file. The file is created if it does not exist.
+    """
+    # Increment when the table layout or the meaning of any column changes;
+    # incompatible index files are cleared and must be rebuilt from the server.
+    schema_version = 2
+
+    schema = [
+        """create table if not exists meta (
+            key text primary key,
+            value text
+        )""",
+        """create table if not exists experiment (
+            uid text primary key,
+            source_file text,
+            source_line text,
+            timestamp real,
+            date text,
+            region text,
+            solution text,
+            temperature text,
+            organism text,
+            age real,
+            cre_types text,
+            target_layers text,
+            n_probed integer,
+            n_connected integer,
+            file_mtimes text,
+            pickle blob
+        )""",
+        """create table if not exists cell (
+            expt_uid text,
+            cell_id integer,
+            cre_type text,
+            target_layer text,
+            pass_qc integer,
+            spiking_qc integer,
+            x real,
+            y real,
+            z real
+        )""",
+        """create table if not exists pair (
+            expt_uid text,
+            pre_cell_id integer,
+            post_cell_id integer,
+            connected integer,
+            distance real
+        )""",
+        "create index if not exists cell_expt_uid on cell (expt_uid, cell_id)",
+        "create index if not exists pair_expt_uid on pair (expt_uid)",
+    ]
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self._init_tables()
+        return self._conn
+
+    def _init_tables(self):
+        conn = self._conn
+        try:
+            ver = conn.execute("select value from meta where key='schema_version'").fetchone()
+        except sqlite3.OperationalError:
+            ver = None
+        cleared = ver is not None and int(ver[0]) != self.schema_version
+        if cleared:
+            print("Experiment index %s has an incompatible version (%s != %s); it was cleared and must be "
+                  "rebuilt with ExperimentList.refresh_cache() or load_from_server()." % (self.filename, ver[0], self.schema_version))
+            with conn:
+                for table in ('meta', 'experiment', 'cell', 'pair'):
+                    conn.execute("drop table if exists %s" % table)
+        with conn:
+            for stmt in self.schema:
+                conn.execute(stmt)
+            conn.execute("insert or replace into meta (key, value) values ('schema_version', ?)", (str(self.schema_version),))
+            if cleared:
+                conn.execute("insert or replace into meta (key, value) values ('rebuild_required', '1')")
+
+    @property
+    def rebuild_required(self):
+        """True if the index was cleared because of a schema change and has not
+        been repopulated from the server since.
+        """
+        return self.conn.execute("select value from meta where key='rebuild_required'").fetchone() is not None
+
+    def mark_rebuilt(self):
+        with self.conn:
+            self.conn.execute("delete from meta where key='rebuild_required'")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __len__(self):
+        return self.conn.execute("select count(*) from experiment").fetchone()[0]
+
+    def uids(self):
+        """Return a list of all experiment UIDs in the index.
+        """
+        return [r[0] for r in self.conn.execute("select uid from experiment order by uid")]
+
+    def experiment_rows(self, columns=None):
+        """Return a list of dicts, one per experiment, containing the requested
+        summary columns (all columns except the pickle by default).
+        """
+        if columns is None:
+            columns = ['uid', 'source_file', 'source_line', 'timestamp', 'date', 'region', 'solution',
+                       'temperature', 'organism', 'age', 'cre_types', 'target_layers', 'n_probed', 'n_connected']
+        rows = self.conn.execute("select %s from experiment order by uid" % ', '.join(columns)).fetchall()
+        recs = []
+        for row in rows:
+            rec = dict(zip(columns, row))
+            for k in ('cre_types', 'target_layers'):
+                if rec.get(k) is not None:
+                    rec[k] = json.loads(rec[k])
+            recs.append(rec)
+        return recs
+
+    def cell_rows(self):
+        """Return all cell rows as a list of tuples
+        (expt_uid, cell_id, cre_type, target_layer, pass_qc, spiking_qc, x, y, z).
+        """
+        return self.conn.execute("select expt_uid, cell_id, cre_type, target_layer, pass_qc, spiking_qc, x, y, z from cell").fetchall()
+
+    def pair_rows(self):
+        """Return all probed pair rows as a list of tuples
+        (expt_uid, pre_cell_id, post_cell_id, connected, distance).
+        """
+        return self.conn.execute("select expt_uid, pre_cell_id, post_cell_id, connected, distance from pair").fetchall()
+
+    def pair_summary_rows(self):
+        """Return {uid: [row, ...]} describing all probed pairs, where each row
+        is formatted as in experiment_pair_rows().
+        """
+        rows = self.conn.execute("""
+            select
+                pair.expt_uid, pair.pre_cell_id, pair.post_cell_id,
+                pre.target_layer, pre.cre_type, post.target_layer, post.cre_type,
+                pair.connected, pair.distance, pre.spiking_qc, post.pass_qc
+            from pair
+                join cell pre on pre.expt_uid=pair.expt_uid and pre.cell_id=pair.pre_cell_id
+                join cell post on post.expt_uid=pair.expt_uid and post.cell_id=pair.post_cell_id
+        """).fetchall()
+        pairs = {}
+        for row in rows:
+            pairs.setdefault(row[0], []).append(row[1:])
+        return pairs
+
+    def load_experiment(self, uid):
+        """Unpickle and return the Experiment with the given UID.
+        """
+        row = self.conn.execute("select pickle from experiment where uid=?", (uid,)).fetchone()
+        if row is None:
+            raise KeyError("No experiment in index with UID '%s'" % uid)
+        return pickle.loads(bytes(row[0]))
+
+    def lazy_experiments(self):
+        """Return a list of LazyExperiment instances for every experiment in the index.
+        """
+        return [LazyExperiment(self, row) for row in self.experiment_rows()]
+
+    def file_mtimes(self):
+        """Return {uid: {filename: mtime}} for all experiments in the index.
+        """
+        rows = self.conn.execute("select uid, file_mtimes from experiment").fetchall()
+        return {uid: json.loads(mtimes) for uid, mtimes in rows}
+
+    def update(self, expts):
+        """Add or replace index entries for a list of Experiments.
+        """
+        entries = [self._experiment_entry(expt) for expt in expts]
+        conn = self.conn
+        with conn:
+            for expt_row, cell_rows, pair_rows in entries:
+                uid = expt_row[0]
+                conn.execute("delete from cell where expt_uid=?", (uid,))
+                conn.execute("delete from pair where expt_uid=?", (uid,))
+                conn.execute("insert or replace into experiment values (%s)" % ', '.join(['?'] * len(expt_row)), expt_row)
+                conn.executemany("insert into cell values (?, ?, ?, ?, ?, ?, ?, ?, ?)", cell_rows)
+                conn.executemany("insert into pair values (?, ?, ?, ?, ?)", pair_rows)
+
+    def remove(self, uids):
+        conn = self.conn
+        with conn:
+            for uid in uids:
+                for table, col in [('experiment', 'uid'), ('cell', 'expt_uid'), ('pair', 'expt_uid')]:
+                    conn.execute("delete from %s where %s=?" % (table, col), (uid,))
+
+    def prune(self, uids):
+        """Remove all experiments whose UIDs are not in *uids*.
+        """
+        keep = set(uids)
+        self.remove([uid for uid in self.uids() if uid not in keep])
+
+    def stale(self):
+        """Return a list of UIDs for experiments whose source files have changed
+        since they were indexed.
+        """
+        stale = []
+        for uid, mtimes in self.file_mtimes().items():
+            if file_mtimes(mtimes.keys()) != mtimes:
+                stale.append(uid)
+        return sorted(stale)
+
+    def refresh(self, uids=None):
+        """Reload experiments whose source files have changed.
+
+        Only experiments loaded from pipettes.yml files can be reloaded individually;
+        experiments from old-style summary files must be reloaded with
+        ExperimentList.load(). Returns a list of (uid, error) for experiments that
+        could not be refreshed.
+        """
+        from .experiment import Experiment
+        if uids is None:
+            uids = self.stale()
+        sources = dict(self.conn.execute("select uid, source_file from experiment").fetchall())
+        errs = []
+        reloaded = []
+        for uid in uids:
+            src = sources.get(uid)
+            if src is None or not src.endswith('pipettes.yml'):
+                errs.append((uid, "Cannot refresh experiment from %s" % src))
+                continue
+            if not os.path.isfile(src):
+                self.remove([uid])
+                continue
+            try:
+                reloaded.append(Experiment(yml_file=src))
+            except Exception:
+                errs.append((uid, sys.exc_info()))
+        self.update(reloaded)
+        return errs
+
+    @staticmethod
+    def _experiment_entry(expt):
+        """Generate rows for experiment, cell and pair tables.
+        """
+        summary = index_summary(expt)
+        uid = summary['uid']
+        expt_row = (
+            uid,
+            summary['source_file'],
+            summary['source_line'],
+            summary['timestamp'],
+            summary['date'],
+            summary['region'],
+            summary['solution'],
+            summary['temperature'],
+            summary['organism'],
+            summary['age'],
+            json.dumps(summary['cre_types']),
+            json.dumps(summary['target_layers']),
+            summary['n_probed'],
+            summary['n_connected'],
+            json.dumps(file_mtimes(experiment_files(expt))),
+            sqlite3.Binary(pickle.dumps(expt, pickle.HIGHEST_PROTOCOL)),
+        )
+
+        cell_rows = []
+        for cell_id, cell in expt.cells.items():
+            pos = cell.position
+            if pos is None:
+                pos = (None, None, None)
+            cell_rows.append((uid, cell_id, cell.cre_type, cell.target_layer, cell.pass_qc,
+                              cell.spiking_qc, pos[0], pos[1], pos[2]))
+
+        pair_rows = []
+        connections = expt.connections
+        for pre_id, post_id in expt.connections_probed:
+            dist = expt.cells[pre_id].distance(expt.cells[post_id])
+            if dist != dist:
+                dist = None
+            pair_rows.append((uid, pre_id, post_id, (pre_id, post_id) in connections, dist))
+
+        return expt_row, cell_rows, pair_rows
+
+
+class LazyExperiment(object):
+    """Stand-in for an Experiment stored in an ExperimentIndex.
+
+    The uid, datetime, source_id and index_summary attributes are available
+    immediately; accessing any other attribute unpickles the Experiment from the
+    index and forwards to it.
+    """
+    def __init__(self, index, row):
+        self._index = index
+        self._expt = None
+        self.index_summary = row
+        self.uid = row['uid']
+        self.source_id = (row['source_file'], row['source_line'])
+        self.datetime = datetime.datetime.fromtimestamp(row['timestamp'])
+
+    @property
+    def experiment(self):
+        """The Experiment instance represented by this object.
+        """
+        if self._expt is None:
+            self._expt = self._index.load_experiment(self.uid)
+        return self._expt
+
+    @property
+    def loaded(self):
+        return self._expt is not None
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') or '_index' not in self.__dict__:
+            raise AttributeError(attr)
+        return getattr(self.experiment, attr)
+
+    def __getstate__(self):
+        # pickle as the real experiment
+        state = self.__dict__.copy()
+        state['_expt'] = self.experiment
+        state['_index'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __repr__(self):
+        if self._expt is None:
+            return "<LazyExperiment uid=%s>" % self.uid
+        return repr(self._expt)
+
+
+def index_summary(expt):
+    """Return a dict of the summary columns stored in the index for an Experiment.
+
+    These are the values used to select experiments without loading them.
+    Metadata that cannot be determined (eg, missing LIMS records) is stored as None.
+    """
+    def attempt(fn):
+        try:
+            return fn()
+        except Exception:
+            return None
+
+    age = attempt(lambda: expt.age)
+    if age is not None and age != age:
+        age = None
+    expt_info = attempt(lambda: expt.expt_info) or {}
+    return {
+        'uid': expt.uid,
+        'source_file': expt.source_id[0],
+        'source_line': None if expt.source_id[1] is None else str(expt.source_id[1]),
+        'timestamp': expt.site_info['__timestamp__'],
+        'date': expt.date.isoformat(),
+        'region': expt.region,
+        'solution': expt_info.get('solution'),
+        'temperature': expt_info.get('temperature'),
+        'organism': attempt(lambda: expt.lims_record['organism']),
+        'age': age,
+        'cre_types': list(expt.cre_types),
+        'target_layers': list(expt.target_layers),
+        'n_probed': expt.n_connections_probed,
+        'n_connected': len(expt.connections),
+    }
+
+
+def experiment_pair_rows(expt):
+    """Return a list of rows describing all probed pairs in an Experiment::
+
+        [(pre_cell_id, post_cell_id, pre_layer, pre_cre_type, post_layer, post_cre_type,
+          connected, distance, pre_spiking_qc, post_pass_qc), ...]
+    """
+    rows = []
+    connections = expt.connections
+    for pre_id, post_id in expt.connections_probed:
+        ci, cj = expt.cells[pre_id], expt.cells[post_id]
+        rows.append((pre_id, post_id, ci.target_layer, ci.cre_type, cj.target_layer, cj.cre_type,
+                     (pre_id, post_id) in connections, ci.distance(cj), ci.spiking_qc, cj.pass_qc))
+    return rows
+
+
+def experiment_files(expt):
+    """Return a list of files that an Experiment's metadata is read from.
+
+    These are used to decide when an indexed experiment needs to be reloaded.
+    """
+    files = []
+    if expt.source_id[0] is not None:
+        files.append(expt.source_id[0])
+    try:
+        path = expt.path
+    except Exception:
+        return files
+    files.extend([
+        os.path.join(path, '.index'),
+        os.path.join(path, '..', '.index'),
+        os.path.join(path, '..', '..', '.index'),
+    ])
+    try:
+        files.append(expt.mosaic_file)
+    except Exception:
+        pass
+    return [os.path.abspath(f) for f in files]
+
+
+def file_mtimes(files):
+    """Return {filename: mtime} for a list of files; missing files have mtime None.
+    """
+    mtimes = {}
+    for f in files:
+        try:
+            mtimes[f] = os.stat(f).st_mtime
+        except OSError:
+            mtimes[f] = None
+    return mtimes
@@ -2,6 +2,8 @@
 from __future__ import print_function, division
 import numpy as np
 import os, glob
+import json
+import time
 import pickle
 import scipy.optimize
 import scipy.stats
@@ -9,20 +11,27 @@ import sys
 import traceback
 import warnings
 import datetime
+from multiprocessing.pool import ThreadPool
 
 import pyqtgraph as pg
 
 from .ui.graphics import MatrixItem, distance_plot
 from .experiment import Experiment
+from .experiment_index import ExperimentIndex, file_mtimes, index_summary, experiment_pair_rows
 from .constants import INHIBITORY_CRE_TYPES, EXCITATORY_CRE_TYPES
-from . import config
+from . import config, lims
 
 
 _expt_list = None
-cache_file = os.path.join(os.path.dirname(__file__), '..', 'expts_cache.pkl')
+cache_file = os.path.join(os.path.dirname(__file__), '..', 'expts_index.sqlite')
+# previous pickle-based cache; converted to an index the first time it is found
+pickle_cache_file = os.path.join(os.path.dirname(__file__), '..', 'expts_cache.pkl')
 def cached_experiments():
     global _expt_list, cache_file
     if _expt_list is None:
+        if not os.path.isfile(cache_file) and os.path.isfile(pickle_cache_file):
+            print("Converting %s to experiment index %s" % (pickle_cache_file, cache_file))
+            ExperimentList(cache=pickle_cache_file, cache_file=cache_file).write_cache()
         _expt_list = ExperimentList(cache=cache_file)
     return _expt_list
 
@@ -54,21 +63,61 @@ class Entry(object):
             ch.print_tree()
 
 
+def _slice_specimen_name(slice_dir):
+    """Return the LIMS specimen name recorded in the .index file of a slice
+    directory, or None if it cannot be read.
+    """
+    try:
+        return pg.configfile.readConfigFile(os.path.join(slice_dir, '.index'))['.']['specimen_ID'].strip()
+    except Exception:
+        return None
+
+
 def indentation(line):
     return len(line) - len(line.lstrip('- '))
 
 
+def _calcium(solution):
+    """Return 'high', 'low' or None to describe the external calcium concentration
+    given an ACSF solution name.
+    """
+    if solution is None:
+        return None
+    if '2mM' in solution:
+        return 'high'
+    elif '1.3mM' in solution:
+        return 'low'
+    return None
+
+
+def _group_by(keys):
+    """Return {key: index_array} grouping the elements of the integer array *keys*.
+    """
+    uniq, inv = np.unique(keys, return_inverse=True)
+    order = np.argsort(inv, kind='mergesort')
+    bounds = np.cumsum(np.bincount(inv, minlength=len(uniq)))[:-1]
+    return dict(zip(uniq, np.split(order, bounds)))
+
+
 class ExperimentList(object):
 
-    def __init__(self, expts=None, cache=None):
+    def __init__(self, expts=None, cache=None, cache_file=None):
         self._cache_version = 8
-        self._cache = cache
+        self._cache = cache if cache_file is None else cache_file
         self._expts = []
         self._expts_by_datetime = {}
         self._expts_by_uid = {}
         self._expts_by_source_id = {}
+        self._summaries = {}
+        self._columns = None
+        self._pair_rows = {}
+        self._pair_table = None
+        self._pair_types = None
         self.start_skip = []
         self.stop_skip = []
+        # True if this list holds every experiment in its index file
+        self._index_complete = False
+        self._server_loaded = False
 
         if expts is not None:
             for expt in expts:
@@ -76,41 +125,128 @@ class ExperimentList(object):
         if cache is not None and os.path.isfile(cache):
             try:
                 self.load(cache)
+                self._index_complete = cache == self._cache and cache.endswith('.sqlite')
             except Exception:
                 sys.excepthook(*sys.exc_info())
                 print('Error reading cache file "%s". (exception printed above)' % cache)
 
-    def load_from_server(self):
-        errs = []
+    def load_from_server(self, workers=8, force=False, summary_file=None, metadata_only=False):
+        """Load all experiments found in pipettes.yml files on the server.
+
+        Experiments are loaded concurrently with a pool of *workers* threads (this
+        is mostly network-filesystem and LIMS I/O). If this list is backed by an
+        ExperimentIndex, experiments whose source files are unchanged since they were
+        indexed are skipped unless *force* is True. LIMS records for the specimens of
+        all experiments to be loaded are fetched together beforehand (see
+        lims.specimen_records).
+
+        If *metadata_only* is True, experiments are constructed without opening NWB
+        files or site mosaics (see Experiment); this is much faster when only
+        listing experiments. Metadata-only experiments do not replace experiments
+        already in the list and are never written to the index by write_cache().
 
+        Returns a list of dicts (one per pipettes.yml file) with keys 'yml_file',
+        'uid', 'status' ('loaded', 'skipped' or 'error'), 'time' and 'error'. This
+        summary is also written as JSON to *summary_file*, if given.
+        """
         # Load all pipettes.yml files found on server
         yamls = glob.glob(os.path.join(config.synphys_data, '*', 'slice_*', 'site_*', 'pipettes.yml'))
-        for i,yml_file in enumerate(yamls):
-            # if i>15:
-                # break
+
+        # file mtimes recorded for experiments we already know about
+        known = {}
+        if not force and self._cache is not None and self._cache.endswith('.sqlite') and os.path.isfile(self._cache):
+            index = ExperimentIndex(self._cache)
+            mtimes = index.file_mtimes()
+            for row in index.experiment_rows(columns=['uid', 'source_file']):
+                if row['uid'] in self._expts_by_uid:
+                    known[row['source_file']] = (row['uid'], mtimes[row['uid']])
+            index.close()
+
+        def load(yml_file):
+            start = time.time()
+            result = {'yml_file': yml_file, 'uid': None, 'status': None, 'error': None, 'expt': None}
             try:
-                expt = Experiment(yml_file=yml_file)
-                self._add_experiment(expt)
+                if yml_file in unchanged:
+                    result['uid'] = known[yml_file][0]
+                    result['status'] = 'skipped'
+                else:
+                    expt = Experiment(yml_file=yml_file, metadata_only=metadata_only)
+                    result['expt'] = expt
+                    result['uid'] = expt.uid
+                    result['status'] = 'loaded'
             except Exception as exc:
                 if len(exc.args) > 0 and exc.args[0] == 'breakpoint':
                     raise
-                errs.append((yml_file, sys.exc_info()))
-                continue
+                result['status'] = 'error'
+                result['error'] = ''.join(traceback.format_exception(*sys.exc_info()))
+            result['time'] = time.time() - start
+            return result
+
+        pool = ThreadPool(workers)
+        try:
+            known_ymls = list(known.keys())
+            is_unchanged = pool.map(lambda y: file_mtimes(known[y][1].keys()) == known[y][1], known_ymls)
+            unchanged = set([y for y, u in zip(known_ymls, is_unchanged) if u])
+
+            # fetch LIMS records for all specimens with one query so that
+            # experiments read them from the local specimen cache
+            slice_dirs = set([os.path.dirname(os.path.dirname(y)) for y in yamls if y not in unchanged])
+            names = set([n for n in pool.map(_slice_specimen_name, slice_dirs) if n is not None])
+            if len(names) > 0:
+                try:
+                    lims.specimen_records(specimen_names=names)
+                except Exception:
+                    print("Error prefetching LIMS records for %d specimens:" % len(names))
+                    sys.excepthook(*sys.exc_info())
+
+            results = pool.map(load, yamls)
+        finally:
+            pool.close()
+
+        errs = []
+        for result in results:
+            expt = result.pop('expt')
+            if expt is not None:
+                if expt.metadata_only and expt.uid in self._expts_by_uid:
+                    # keep the fully loaded experiment
+                    continue
+                self._replace_experiment(expt)
+            if result['status'] == 'error':
+                errs.append(result)
 
         if len(errs) > 0:
             print("Errors loading %d experiments from server:" % len(errs))
-            for yml_file, exc in errs:
+            for result in errs:
                 print("=======================")
-                print(yml_file)
-                traceback.print_exception(*exc)
-                print("")
+                print(result['yml_file'])
+                print(result['error'])
+
+        if summary_file is not None:
+            json.dump(results, open(summary_file, 'w'), indent=2)
+
+        self._server_loaded = True
+        return results
 
     def load(self, filename):
         if filename.endswith('.pkl'):
             self._load_pickle(filename)
+        elif filename.endswith('.sqlite'):
+            self._load_index(filename)
         else:
             self._load_text(filename)
 
+    def _load_index(self, filename):
+        """Load experiments from an ExperimentIndex.
+
+        Experiments are not unpickled until they are accessed (see LazyExperiment).
+        """
+        index = ExperimentIndex(filename)
+        if index.rebuild_required:
+            print("Experiment index %s must be rebuilt; call refresh_cache() or load_from_server() and write_cache()." % filename)
+        for expt in index.lazy_experiments():
+            self._add_experiment(expt)
+        self.sort()
+
     def _load_pickle(self, filename):
         el = pickle.load(open(filename))
         ver = getattr(el, '_cache_version', None)
@@ -185,54 +321,255 @@ class ExperimentList(object):
         self._expts_by_datetime[expt.datetime] = expt
         self._expts_by_source_id[expt.source_id] = expt
         self._expts.sort(key=lambda ex: ex.uid)
+        self._columns = None
+        self._pair_table = None
+
+    def _replace_experiment(self, expt):
+        """Add *expt*, replacing any existing experiment with the same uid.
+        """
+        old = self._expts_by_uid.pop(expt.uid, None)
+        if old is not None:
+            self._expts.remove(old)
+            self._expts_by_datetime.pop(old.datetime, None)
+            self._expts_by_source_id.pop(old.source_id, None)
+            self._summaries.pop(expt.uid, None)
+            self._pair_rows.pop(expt.uid, None)
+        self._add_experiment(expt)
+
+    def write_cache(self, prune=None):
+        """Write this list to its cache file.
 
-    def write_cache(self):
+        For an index file, experiments in the list are added or updated. If
+        *prune* is True, index entries for experiments that are not in this list
+        are also removed. By default this is only done if the list was loaded
+        from the complete index, so that writing a partial list does not delete
+        other experiments.
+        """
         if self._cache is None:
             raise Exception("ExperimentList has no cache file; cannot write cache.")
-        pickle.dump(self, open(self._cache, 'w'))
+        if self._cache.endswith('.sqlite'):
+            if prune is None:
+                prune = self._index_complete
+            # experiments that are still lazy have not changed since they were indexed;
+            # metadata-only experiments lack QC and positions, and must not be
+            # recorded as up to date
+            expts = [getattr(ex, 'experiment', ex) for ex in self._expts if getattr(ex, 'loaded', True)]
+            index = ExperimentIndex(self._cache)
+            index.update([ex for ex in expts if not getattr(ex, 'metadata_only', False)])
+            if prune:
+                index.prune([ex.uid for ex in self._expts])
+            if self._server_loaded and index.rebuild_required:
+                index.mark_rebuilt()
+            index.close()
+        else:
+            pickle.dump(self, open(self._cache, 'w'))
+
+    def refresh_cache(self):
+        """Reload any experiments in the index whose source files changed since they were
+        indexed, then reload this list from the index.
+
+        If the index was cleared because of a schema change, it is rebuilt with
+        load_from_server() instead. Returns the UIDs of the reloaded experiments.
+        """
+        if self._cache is None or not self._cache.endswith('.sqlite'):
+            raise Exception("ExperimentList has no index file; cannot refresh.")
+        index = ExperimentIndex(self._cache)
+        if index.rebuild_required:
+            index.close()
+            print("Rebuilding experiment index %s from the server.." % self._cache)
+            self.load_from_server(force=True)
+            self.write_cache()
+            return [ex.uid for ex in self._expts]
+        stale = index.stale()
+        errs = index.refresh(stale)
+        index.close()
+        for uid, err in errs:
+            print("Could not refresh experiment %s: %s" % (uid, err))
+
+        self._expts = []
+        self._expts_by_datetime = {}
+        self._expts_by_uid = {}
+        self._expts_by_source_id = {}
+        self._summaries = {}
+        self._columns = None
+        self._pair_rows = {}
+        self._pair_table = None
+        self._load_index(self._cache)
+        return stale
 
     def select(self, start=None, stop=None, region=None, source_files=None, cre_type=None, target_layer=None, calcium=None,
                age=None, temp=None, organism=None):
-        expts = []
-        for ex in self._expts:
-            # filter experiments by experimental date and conditions
-            if calcium is not None:
-                if 'solution' in ex.expt_info:
-                    if '2mM' in ex.expt_info['solution']:
-                        ex_calcium = 'high'
-                    elif '1.3mM' in ex.expt_info['solution']:
-                        ex_calcium = 'low'
-                else:
-                    print("External calcium concentration not set for experiment %s" % str(ex.source_id))
-                    continue
-            if age is not None:
-                age_range = sorted([int(i) for i in age.split('-')])
-            if start is not None and ex.date < start:
-                continue
-            elif stop is not None and ex.date > stop:
-                continue
-            elif region is not None and ex.region != region:
-                continue
-            elif source_files is not None and ex.source_id[0] not in source_files:
-                continue
-            elif cre_type is not None and len(set(cre_type) & set(ex.cre_types)) == 0:
-                continue
-            elif target_layer is not None and len(set(target_layer) & set(ex.target_layers)) == 0:
-                continue
-            elif calcium is not None and calcium.lower() != ex_calcium:
-                continue
-            elif age is not None and ((ex.age < age_range[0]) or (ex.age > age_range[1])) :
-                continue
-            elif temp is not None and ex.expt_info['temperature'][:2] != temp:
-                continue
-            elif organism is not None and ex.lims_record['organism'] != organism:
-                continue
-            else:
-                expts.append(ex)
+        """Return a new ExperimentList containing only experiments that match all
+        of the given criteria.
 
+        Selection is done on precomputed attribute columns (see `columns`), so
+        no experiment files or LIMS records are accessed.
+        """
+        cols = self.columns
+        mask = np.ones(len(self._expts), dtype=bool)
+
+        # filter experiments by experimental date and conditions
+        if calcium is not None:
+            missing = mask & ~cols['has_solution']
+            for i in np.argwhere(missing)[:,0]:
+                print("External calcium concentration not set for experiment %s" % str(self._expts[i].source_id))
+            mask &= cols['calcium'] == calcium.lower()
+        if start is not None:
+            mask &= cols['date'] >= start.toordinal()
+        if stop is not None:
+            mask &= cols['date'] <= stop.toordinal()
+        if region is not None:
+            mask &= cols['region'] == region
+        if source_files is not None:
+            mask &= np.array([f in source_files for f in cols['source_file']], dtype=bool)
+        if cre_type is not None:
+            mask &= self._set_mask('cre_types', cre_type)
+        if target_layer is not None:
+            mask &= self._set_mask('target_layers', target_layer)
+        if age is not None:
+            age_range = sorted([int(i) for i in age.split('-')])
+            with np.errstate(invalid='ignore'):
+                mask &= (cols['age'] >= age_range[0]) & (cols['age'] <= age_range[1])
+        if temp is not None:
+            mask &= cols['temperature'] == str(temp)
+        if organism is not None:
+            mask &= cols['organism'] == organism
+
+        expts = [self._expts[i] for i in np.argwhere(mask)[:,0]]
         el = ExperimentList(expts)
+        el._summaries = {ex.uid: self._summaries[ex.uid] for ex in expts}
+        el._pair_rows = {ex.uid: self._pair_rows[ex.uid] for ex in expts if ex.uid in self._pair_rows}
         return el
 
+    def _set_mask(self, column, values):
+        """Return a boolean mask selecting experiments having any of *values* in a
+        set-valued column ('cre_types' or 'target_layers').
+        """
+        index = self.columns[column]
+        mask = np.zeros(len(self._expts), dtype=bool)
+        for v in set(values):
+            if v in index:
+                mask |= index[v]
+        return mask
+
+    @property
+    def columns(self):
+        """A dict of numpy arrays (one element per experiment, in list order) holding
+        the attributes used by select():
+
+        * date (ordinal), region, calcium ('high', 'low' or None), has_solution,
+          age (float; nan if unknown), temperature (first 2 characters), organism,
+          source_file
+        * cre_types, target_layers: {value: boolean mask} set indexes
+
+        Attributes are taken from the experiment index when available; otherwise
+        they are computed once from each Experiment and remembered.
+        """
+        if self._columns is None:
+            for ex in self._expts:
+                if ex.uid not in self._summaries:
+                    summary = getattr(ex, 'index_summary', None)
+                    if summary is None:
+                        summary = index_summary(ex)
+                    self._summaries[ex.uid] = summary
+            rows = [self._summaries[ex.uid] for ex in self._expts]
+
+            def column(values, dtype=object):
+                arr = np.empty(len(values), dtype=dtype)
+                arr[:] = values
+                return arr
+
+            cols = {}
+            cols['date'] = column([datetime.date(*map(int, r['date'].split('-'))).toordinal() for r in rows], dtype=int)
+            cols['region'] = column([r['region'] for r in rows])
+            cols['has_solution'] = column([r['solution'] is not None for r in rows], dtype=bool)
+            cols['calcium'] = column([_calcium(r['solution']) for r in rows])
+            cols['age'] = column([np.nan if r['age'] is None else r['age'] for r in rows], dtype=float)
+            cols['temperature'] = column([None if r['temperature'] is None else r['temperature'][:2] for r in rows])
+            cols['organism'] = column([r['organism'] for r in rows])
+            cols['source_file'] = column([r['source_file'] for r in rows])
+            for k in ('cre_types', 'target_layers'):
+                index = {}
+                for i, r in enumerate(rows):
+                    for v in r[k]:
+                        index.setdefault(v, np.zeros(len(rows), dtype=bool))[i] = True
+                cols[k] = index
+            self._columns = cols
+        return self._columns
+
+    @property
+    def pair_table(self):
+        """A numpy record array with one row per probed cell pair (see
+        Experiment.connections_probed) across all experiments in this list.
+
+        Fields are:
+
+        * expt: index of the experiment in this list
+        * pre_cell, post_cell: cell IDs
+        * pre_layer, pre_cre_type, post_layer, post_cre_type
+        * pre_type, post_type: integer codes for (layer, cre_type); see pair_types
+        * connected: bool
+        * distance: float (nan if unknown)
+        * pre_spiking_qc, post_pass_qc: bool
+
+        Rows are read from the experiment index when available, so building the table
+        does not require unpickling any experiments.
+        """
+        if self._pair_table is None:
+            # read pairs for indexed experiments with one query per index
+            indexes = {}
+            for ex in self._expts:
+                index = getattr(ex, '_index', None)
+                if ex.uid not in self._pair_rows and index is not None:
+                    indexes.setdefault(id(index), (index, []))[1].append(ex)
+            for index, expts in indexes.values():
+                rows = index.pair_summary_rows()
+                for ex in expts:
+                    self._pair_rows[ex.uid] = rows.get(ex.uid, [])
+            for ex in self._expts:
+                if ex.uid not in self._pair_rows:
+                    self._pair_rows[ex.uid] = experiment_pair_rows(ex)
+
+            type_codes = {}
+            types = []
+            recs = []
+            for i, ex in enumerate(self._expts):
+                for row in self._pair_rows[ex.uid]:
+                    pre_id, post_id, pre_layer, pre_cre, post_layer, post_cre, connected, dist, spiking_qc, pass_qc = row
+                    codes = []
+                    for typ in ((pre_layer, pre_cre), (post_layer, post_cre)):
+                        if typ not in type_codes:
+                            type_codes[typ] = len(types)
+                            types.append(typ)
+                        codes.append(type_codes[typ])
+                    recs.append((i, pre_id, post_id, pre_layer, pre_cre, post_layer, post_cre, codes[0], codes[1],
+                                 bool(connected), np.nan if dist is None else dist, bool(spiking_qc), bool(pass_qc)))
+
+            dtype = [
+                ('expt', int), ('pre_cell', int), ('post_cell', int),
+                ('pre_layer', object), ('pre_cre_type', object), ('post_layer', object), ('post_cre_type', object),
+                ('pre_type', int), ('post_type', int),
+                ('connected', bool), ('distance', float), ('pre_spiking_qc', bool), ('post_pass_qc', bool),
+            ]
+            self._pair_types = types
+            self._pair_table = np.array(recs, dtype=dtype)
+        return self._pair_table
+
+    @property
+    def pair_types(self):
+        """List of (layer, cre_type) tuples indexed by the pre_type and post_type
+        codes in pair_table.
+        """
+        self.pair_table
+        return self._pair_types
+
+    def _connection_type(self, code):
+        """Return ((pre_layer, pre_cre), (post_layer, post_cre)) for a code
+        computed as pre_type * len(pair_types) + post_type.
+        """
+        n = len(self._pair_types)
+        return (self._pair_types[code // n], self._pair_types[code % n])
+
     def __getitem__(self, item):
         if isinstance(item, str):
             try:
@@ -259,6 +596,8 @@ class ExperimentList(object):
 
     def sort(self, key=lambda expt: expt.source_id[1], **kwds):
         self._expts.sort(key=key, **kwds)
+        self._columns = None
+        self._pair_table = None
 
     def check(self):
         # sanity check: all experiments should have cre and fl labels
@@ -373,12 +712,8 @@ class ExperimentList(object):
     def n_connections_probed(self):
         """Return (total_probed, total_connected) for all experiments in this list.
         """
-        tot_probed = 0
-        tot_connected = 0
-        for expt in self:
-            tot_probed += expt.n_connections_probed
-            tot_connected += expt.n_connections
-        return tot_probed, tot_connected
+        table = self.pair_table
+        return len(table), int(table['connected'].sum())
 
     def connection_stim_summary(self, cre_type):
         """Return a structure that contains stimulus summary information for each connection type.
@@ -442,18 +777,33 @@ class ExperimentList(object):
         print("Mean age: %0.1f" % np.nanmean(ages))
         print("")
 
+    def _cre_type_mask(self, table, cre_type):
+        """Return a mask selecting pairs in *table* whose (pre, post) cre types match *cre_type*.
+        """
+        cre_type = list(cre_type)
+        if len(cre_type) != 2:
+            return np.zeros(len(table), dtype=bool)
+        return (table['pre_cre_type'] == cre_type[0]) & (table['post_cre_type'] == cre_type[1])
+
     def connectivity_summary(self, cre_type=None):
+        """Return a structure summarizing (non)connectivity across all experiments,
+        in the same format as Experiment.summary().
+        """
+        table = self.pair_table
+        if cre_type is not None:
+            table = table[self._cre_type_mask(table, cre_type)]
+
         summary = {}
-        for expt in self:
-            for k,v in expt.summary().items():
-                if cre_type is not None and list(cre_type) != [x[1] for x in k]:
-                    continue
-                if k not in summary:
-                    summary[k] = {'connected':0, 'unconnected':0, 'cdist':[], 'udist':[]}
-                summary[k]['connected'] += v['connected']
-                summary[k]['unconnected'] += v['unconnected']
-                summary[k]['cdist'].extend(v['cdist'])
-                summary[k]['udist'].extend(v['udist'])
+        n_types = len(self.pair_types)
+        for code, idx in _group_by(table['pre_type'] * n_types + table['post_type']).items():
+            conn = table['connected'][idx]
+            dist = table['distance'][idx]
+            summary[self._connection_type(code)] = {
+                'connected': int(conn.sum()),
+                'unconnected': int((~conn).sum()),
+                'cdist': list(dist[conn]),
+                'udist': list(dist[~conn]),
+            }
         return summary
 
     def reciprocal(self, pre_type=None, post_type=None):
@@ -463,32 +813,45 @@ class ExperimentList(object):
             
             IF pre_type and post_type are not None one may use this to probe a specific connection type"""
 
+        table = self.pair_table
+        types = self.pair_types
+        n_types = len(types)
+        conns = table[table['connected']]
+
+        # encode each (expt, pre, post) as a single integer to look up reverse connections
+        n_cells = max(conns['pre_cell'].max(), conns['post_cell'].max()) + 1 if len(conns) > 0 else 1
+        fwd = (conns['expt'] * n_cells + conns['pre_cell']) * n_cells + conns['post_cell']
+        rev = (conns['expt'] * n_cells + conns['post_cell']) * n_cells + conns['pre_cell']
+        recip = np.in1d(rev, fwd)
+        ctype = conns['pre_type'] * n_types + conns['post_type']
+        rtype = conns['post_type'] * n_types + conns['pre_type']
+
+        if pre_type is not None and post_type is not None:
+            if pre_type not in types or post_type not in types:
+                return {}
+            sel = ctype == types.index(pre_type) * n_types + types.index(post_type)
+        else:
+            sel = np.ones(len(conns), dtype=bool)
+
         summary = {}
-        for expt in self:
-            recip = []
-            if len(expt.connections) == 0:
-                continue
-            for pre, post in expt.connections:
-                connection_type = ((expt.cells[pre].target_layer, expt.cells[pre].cre_type),
-                                   (expt.cells[post].target_layer, expt.cells[post].cre_type))
-                if pre_type is not None and post_type is not None:
-                    if connection_type != (pre_type, post_type):
-                        continue
-                if connection_type not in summary:
-                    summary[connection_type] = {'Uni-directional': 0, 'Reciprocal': 0, 'Total_connections': 0}
-                summary[connection_type]['Total_connections'] += 1
-                if (post, pre) in expt.connections:
-                    if (pre, post) not in recip:
-                        recip.append((post, pre))
-                        if connection_type[::-1] != connection_type:
-                            recip_connection_type = connection_type[::-1]
-                            if recip_connection_type not in summary:
-                                summary[recip_connection_type] = {'Uni-directional': 0, 'Reciprocal': 0,
-                                                                  'Total_connections': 0}
-                            summary[recip_connection_type]['Reciprocal'] += 1
-                        summary[connection_type]['Reciprocal'] += 1
-                else:
-                    summary[connection_type]['Uni-directional'] += 1
+        def entry(code):
+            return summary.setdefault(self._connection_type(code), {'Uni-directional': 0, 'Reciprocal': 0, 'Total_connections': 0})
+
+        for code, idx in _group_by(ctype[sel]).items():
+            e = entry(code)
+            e['Total_connections'] += len(idx)
+            e['Uni-directional'] += int((~recip[sel][idx]).sum())
+
+        # count each reciprocal pair once toward each of its connection types; when
+        # both directions are selected, only the pre < post direction is counted
+        sel_recip = sel & recip
+        both = np.in1d(rev, fwd[sel_recip])
+        count = sel_recip & (~both | (conns['pre_cell'] < conns['post_cell']))
+        for code, idx in _group_by(ctype[count]).items():
+            entry(code)['Reciprocal'] += len(idx)
+        asym = count & (rtype != ctype)
+        for code, idx in _group_by(rtype[asym]).items():
+            entry(code)['Reciprocal'] += len(idx)
         return summary
 
     def print_connectivity_summary(self, cre_type=None):
@@ -592,41 +955,45 @@ class ExperimentList(object):
 
             'stims': {(clamp_mode, stim_name, holding): [n_sweeps, S_n_sweeps]}
         """
+        table = self.pair_table
+        mask = table['connected'].copy()
+        if cre_type is not None:
+            mask &= self._cre_type_mask(table, cre_type)
+
+        # only experiments that contain a selected connection are accessed here
         summary = []
-        for expt in self:
-            for pre_id, post_id in expt.connections:
+        for row in table[mask]:
+            expt = self._expts[row['expt']]
+            pre_id, post_id = int(row['pre_cell']), int(row['post_cell'])
+            c1, c2 = expt.cells[pre_id], expt.cells[post_id]
+            conn_info = {'cells': (c1, c2), 'expt': expt}
+            summary.append(conn_info)
 
-                c1, c2 = expt.cells[pre_id], expt.cells[post_id]
-                if cre_type is not None and list(cre_type) != [c1.cre_type, c2.cre_type]:
-                    continue
-                conn_info = {'cells': (c1, c2), 'expt': expt}
-                summary.append(conn_info)
-
-                if list_stims:
-                    stims = {}
-                    for sweep in expt.sweep_summary:
-                        # NOTE the -1 here converts from cell ID to headstage ID.
-                        # Eventually this mapping should be recorded explicitly.
-                        info1 = sweep.get(pre_id - 1)
-                        info2 = sweep.get(post_id - 1)
-
-                        if info1 is None or info2 is None:
-                            continue
-                        stim_name = expt._short_stim_name(info1[0])
-                        if stim_name.upper().startswith('S'):
-                            short_pulse = True
-                            stim_name = stim_name[1:]
-                        else:
-                            short_pulse = False
-                        mode = info2[1]
-                        holding = 5 * np.round(info2[3] * 1000 / 5.0)
-                        stim = (mode, stim_name, int(holding))
-                        stims.setdefault(stim,[0,0])
-                        if short_pulse is True:
-                            stims[stim][1] += 1
-                        else:
-                            stims[stim][0] += 1
-                    conn_info['stims'] = stims
+            if list_stims:
+                stims = {}
+                for sweep in expt.sweep_summary:
+                    # NOTE the -1 here converts from cell ID to headstage ID.
+                    # Eventually this mapping should be recorded explicitly.
+                    info1 = sweep.get(pre_id - 1)
+                    info2 = sweep.get(post_id - 1)
+
+                    if info1 is None or info2 is None:
+                        continue
+                    stim_name = expt._short_stim_name(info1[0])
+                    if stim_name.upper().startswith('S'):
+                        short_pulse = True
+                        stim_name = stim_name[1:]
+                    else:
+                        short_pulse = False
+                    mode = info2[1]
+                    holding = 5 * np.round(info2[3] * 1000 / 5.0)
+                    stim = (mode, stim_name, int(holding))
+                    stims.setdefault(stim,[0,0])
+                    if short_pulse is True:
+                        stims[stim][1] += 1
+                    else:
+                        stims[stim][0] += 1
+                conn_info['stims'] = stims
         return summary
 
     def print_connection_summary(self, cre_type=None, list_stims=False):
@@ -0,0 +1,338 @@
+"""
+Index mapping experiment timestamps to their top-level directory names on the
+synphys data server.
+
+The index is stored in experiment_paths.sqlite in the server data directory.
+Timestamps are a unique key. SQLite locking cannot be relied on over network
+file systems, so every change to the index (and every new directory name
+reservation) is made while holding experiment_paths.lock, a lock file created
+with O_EXCL on the server. Lookups only read the index and never modify it,
+so they also work on read-only mounts. Until the index has been created,
+lookups read the older experiment_path_cache.pkl instead.
+"""
+from __future__ import print_function
+import os, sys, time, uuid, socket, pickle, sqlite3, threading
+
+import pyqtgraph.configfile
+
+from . import config
+
+
+_index = None
+def experiment_path_index():
+    """Return the ExperimentPathIndex for config.synphys_data.
+    """
+    global _index
+    if _index is None:
+        _index = ExperimentPathIndex()
+    return _index
+
+
+class ServerLock(object):
+    """Exclusive lock between hosts, held by creating *filename* with O_EXCL.
+
+    The lock file contains a token unique to this lock, and is only removed by
+    release() if it still holds that token. While the lock is held, a
+    background thread touches the file every *stale_age*/5 seconds; a lock file
+    that has not been touched for *stale_age* seconds is assumed to be left over
+    from a crashed process and is removed. Ages are measured with the server's
+    clock (the mtime of a probe file), so clock differences between hosts do
+    not matter. Use as a context manager.
+    """
+    def __init__(self, filename, timeout=300, stale_age=600):
+        self.filename = filename
+        self.timeout = timeout
+        self.stale_age = stale_age
+        self.token = "%s %d %s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self._stop = threading.Event()
+        self._heartbeat_thread = None
+
+    def acquire(self):
+        start = time.time()
+        while True:
+            try:
+                fd = os.open(self.filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError:
+                try:
+                    owner = _read_file(self.filename)
+                    age = self._server_time() - os.stat(self.filename).st_mtime
+                except (IOError, OSError):
+                    # released in the meantime
+                    continue
+                if age > self.stale_age:
+                    # only remove the file if it was not replaced by a new lock meanwhile
+                    if _read_file(self.filename) == owner:
+                        print("Removing stale lock file %s (%s)" % (self.filename, owner.strip()))
+                        try:
+                            os.remove(self.filename)
+                        except OSError:
+                            pass
+                    continue
+                if time.time() - start > self.timeout:
+                    raise Exception("Timed out waiting for lock file %s" % self.filename)
+                time.sleep(0.5)
+                continue
+            os.write(fd, self.token.encode())
+            os.close(fd)
+            break
+
+        self._stop.clear()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat)
+        self._heartbeat_thread.daemon = True
+        self._heartbeat_thread.start()
+
+    def release(self):
+        self._stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+        try:
+            owned = _read_file(self.filename) == self.token
+        except (IOError, OSError):
+            owned = False
+        if owned:
+            os.remove(self.filename)
+        else:
+            print("Warning: lock file %s was taken over by another process before it was released." % self.filename)
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.stale_age / 5.):
+            try:
+                if _read_file(self.filename) != self.token:
+                    return
+                now = self._server_time()
+                os.utime(self.filename, (now, now))
+            except Exception:
+                print("Error refreshing lock file %s:" % self.filename)
+                sys.excepthook(*sys.exc_info())
+
+    def _server_time(self):
+        """Return the current time according to the server holding the lock file.
+        """
+        probe = '%s.%s.probe' % (self.filename, self.token.split()[-1])
+        with open(probe, 'w') as fh:
+            fh.write(self.token)
+        try:
+            return os.stat(probe).st_mtime
+        finally:
+            os.remove(probe)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _read_file(filename):
+    with open(filename, 'r') as fh:
+        return fh.read()
+
+
+class ExperimentPathIndex(object):
+    """Maps experiment acquisition timestamps to directory names (relative to
+    *root*, default config.synphys_data).
+
+    lookup() and paths() only read the index. refresh(), reserve() and
+    remove() modify it while holding the server lock file; any top-level
+    directories not yet in the index are read by refresh(), opening only the
+    .index files of those new directories.
+    """
+    def __init__(self, root=None, filename=None):
+        self.root = config.synphys_data if root is None else root
+        if filename is None:
+            filename = os.path.join(self.root, 'experiment_paths.sqlite')
+        self.filename = filename
+        self.lock_file = os.path.splitext(filename)[0] + '.lock'
+        self._lock = threading.Lock()
+        self.conn = None
+        self._writable = False
+        self._legacy = None
+
+    def _connect(self, write=False):
+        """Open the index. Must be called with self._lock held.
+
+        Returns False if the index does not exist and *write* is False.
+        """
+        if self.conn is not None and (self._writable or not write):
+            return True
+        if not write and not os.path.isfile(self.filename):
+            return False
+        is_new = not os.path.isfile(self.filename)
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = sqlite3.connect(self.filename, timeout=60, isolation_level=None, check_same_thread=False)
+        if write:
+            self.conn.execute("create table if not exists expt_path (timestamp real primary key, path text unique)")
+            # every top-level directory that has been examined, whether or not it is an experiment
+            self.conn.execute("create table if not exists scanned (name text primary key)")
+            self._writable = True
+            if is_new:
+                self._import_pickle()
+        return True
+
+    def _read(self, query, args=()):
+        """Run a read-only query, returning [] if the index cannot be read.
+        """
+        with self._lock:
+            try:
+                if not self._connect():
+                    return []
+                return self.conn.execute(query, args).fetchall()
+            except sqlite3.Error:
+                print("Could not read experiment path index %s:" % self.filename)
+                sys.excepthook(*sys.exc_info())
+                return []
+
+    def lookup(self, timestamp, refresh=False):
+        """Return the directory name for the experiment with *timestamp*, or None.
+
+        If the timestamp is not indexed and *refresh* is True, new server
+        directories are indexed first (this writes to the index).
+        """
+        path = self._lookup(timestamp)
+        if path is None and refresh:
+            self.refresh()
+            path = self._lookup(timestamp)
+        return path
+
+    def _lookup(self, timestamp):
+        if not os.path.isfile(self.filename):
+            return self._legacy_paths().get(timestamp)
+        rows = self._read("select path from expt_path where timestamp=?", (timestamp,))
+        return None if len(rows) == 0 else rows[0][0]
+
+    def paths(self):
+        """Return {timestamp: path} for all indexed experiments.
+        """
+        if not os.path.isfile(self.filename):
+            return dict(self._legacy_paths())
+        return dict(self._read("select timestamp, path from expt_path"))
+
+    def _legacy_paths(self):
+        """Return {timestamp: path} from the older experiment_path_cache.pkl, which
+        is used for lookups until the index has been created.
+        """
+        if self._legacy is None:
+            self._legacy = self._load_pickle()
+        return self._legacy
+
+    def refresh(self, full=False):
+        """Index top-level server directories that have not been examined before
+        (or all directories if *full* is True). Returns the number of experiments added.
+        """
+        with ServerLock(self.lock_file):
+            return self._refresh(full)
+
+    def _refresh(self, full):
+        # must be called while holding the server lock
+        with self._lock:
+            self._connect(write=True)
+            scanned = set(r[0] for r in self.conn.execute("select name from scanned"))
+        added = 0
+        for name in sorted(os.listdir(self.root)):
+            if (name in scanned and not full) or 'recycle' in name.lower():
+                continue
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path):
+                continue
+            timestamp = None
+            index_file = os.path.join(path, '.index')
+            if os.path.isfile(index_file):
+                try:
+                    timestamp = pyqtgraph.configfile.readConfigFile(index_file)['.'].get('__timestamp__')
+                except Exception:
+                    print("Error reading %s:" % index_file)
+                    sys.excepthook(*sys.exc_info())
+            if timestamp is None:
+                print("NO TIMESTAMP:", path)
+            with self._lock:
+                self.conn.execute("begin")
+                try:
+                    if timestamp is not None:
+                        row = self.conn.execute("select path from expt_path where timestamp=?", (timestamp,)).fetchone()
+                        if row is None:
+                            self.conn.execute("insert or ignore into expt_path (timestamp, path) values (?, ?)", (timestamp, name))
+                            added += 1
+                        elif row[0] != name:
+                            print("Warning: timestamp %s appears twice in synphys data (%s, %s)" % (timestamp, row[0], name))
+                    self.conn.execute("insert or ignore into scanned (name) values (?)", (name,))
+                    self.conn.execute("commit")
+                except Exception:
+                    self.conn.execute("rollback")
+                    raise
+        return added
+
+    def reserve(self, timestamp, base_name):
+        """Return (name, created) giving the server directory name for the
+        experiment with *timestamp*.
+
+        If the experiment is not indexed yet (even after indexing new server
+        directories), a new name like base_name_000 is chosen and recorded,
+        and *created* is True. The caller is then responsible for creating the
+        directory (or calling remove() if that fails).
+        """
+        with ServerLock(self.lock_file):
+            path = self._lookup(timestamp)
+            if path is None:
+                self._refresh(full=False)
+                path = self._lookup(timestamp)
+            if path is not None:
+                return path, False
+
+            with self._lock:
+                self.conn.execute("begin")
+                try:
+                    taken = set(os.listdir(self.root)) | set(r[0] for r in self.conn.execute("select path from expt_path"))
+                    i = 0
+                    while True:
+                        name = base_name + '_%03d' % i
+                        if name not in taken:
+                            break
+                        i += 1
+                    self.conn.execute("insert into expt_path (timestamp, path) values (?, ?)", (timestamp, name))
+                    self.conn.execute("insert or ignore into scanned (name) values (?)", (name,))
+                    self.conn.execute("commit")
+                except Exception:
+                    self.conn.execute("rollback")
+                    raise
+        return name, True
+
+    def remove(self, timestamp):
+        """Remove an experiment from the index.
+        """
+        with ServerLock(self.lock_file):
+            with self._lock:
+                self._connect(write=True)
+                row = self.conn.execute("select path from expt_path where timestamp=?", (timestamp,)).fetchone()
+                if row is None:
+                    return
+                self.conn.execute("delete from expt_path where timestamp=?", (timestamp,))
+                self.conn.execute("delete from scanned where name=?", (row[0],))
+
+    def _load_pickle(self):
+        """Return {timestamp: path} read from the older experiment_path_cache.pkl,
+        or {} if it is not present.
+        """
+        pkl_file = os.path.join(self.root, 'experiment_path_cache.pkl')
+        if not os.path.isfile(pkl_file):
+            return {}
+        try:
+            return pickle.load(open(pkl_file, 'rb'))
+        except Exception:
+            print("Error loading experiment path cache %s:" % pkl_file)
+            sys.excepthook(*sys.exc_info())
+            return {}
+
+    def _import_pickle(self):
+        """Import entries from the older experiment_path_cache.pkl, if present.
+        """
+        paths = self._load_pickle()
+        if len(paths) == 0:
+            return
+        # called from _connect() with self._lock and the server lock held
+        self.conn.execute("begin")
+        self.conn.executemany("insert or ignore into expt_path (timestamp, path) values (?, ?)", paths.items())
+        self.conn.executemany("insert or ignore into scanned (name) values (?)", [(p,) for p in paths.values()])
+        self.conn.execute("commit")
@@ -1,9 +1,275 @@
 from __future__ import print_function
-import os, re, json
-from allensdk_internal.core import lims_utilities as lims
+import os, re, json, time, sqlite3, pickle, threading
+from . import config
+try:
+    from allensdk_internal.core import lims_utilities
+except ImportError:
+    # only cached / offline lookups are possible without the LIMS client
+    lims_utilities = None
 
 
-def specimen_info(specimen_name=None, specimen_id=None):
+_backend = lims_utilities
+_offline = config.lims_offline
+_cache = None
+_cache_file = config.lims_cache_file
+_cache_lock = threading.Lock()
+
+
+def set_backend(backend):
+    """Set the object used to run LIMS queries.
+
+    *backend* must provide a `query(sql)` method returning a list of dicts, like
+    allensdk_internal.core.lims_utilities (the default). See MemoryLims.
+    """
+    global _backend
+    _backend = backend
+
+
+def set_offline(offline=True):
+    """Enable or disable offline mode.
+
+    While offline, no queries are sent to LIMS; specimen records are read from the
+    local cache regardless of their age, and an exception is raised for any
+    record that is not cached.
+    """
+    global _offline
+    _offline = offline
+
+
+def set_cache_file(filename):
+    """Set the file used to cache specimen records (None disables caching).
+    """
+    global _cache, _cache_file
+    with _cache_lock:
+        if _cache is not None:
+            _cache.close()
+        _cache = None
+        _cache_file = filename
+
+
+def specimen_cache():
+    """Return the SpecimenCache in use, or None if caching is disabled.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            filename = _cache_file
+            if filename is None:
+                filename = os.path.join(_cache_dir(), 'lims_cache.sqlite')
+            elif filename is False:
+                return None
+            _cache = SpecimenCache(filename)
+        return _cache
+
+
+def _cache_dir():
+    # relative paths are interpreted as relative to home
+    path = config.cache_path
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.expanduser('~'), path)
+    return path
+
+
+def query(sql):
+    """Run a query against LIMS and return the list of result records.
+    """
+    if _offline:
+        raise Exception("Cannot query LIMS in offline mode.")
+    if _backend is None:
+        raise Exception("No LIMS backend available (allensdk_internal could not be imported).")
+    return _backend.query(sql)
+
+
+class SpecimenCache(object):
+    """Local on-disk store of specimen records queried from LIMS.
+
+    Records are stored exactly as returned from LIMS, keyed by specimen name and ID,
+    along with the time they were fetched.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        path = os.path.dirname(filename)
+        if path != '' and not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("""create table if not exists specimen (
+            name text primary key,
+            specimen_id integer,
+            fetch_time real,
+            record blob
+        )""")
+        self.conn.execute("create index if not exists specimen_id_index on specimen (specimen_id)")
+        self.conn.commit()
+
+    def get(self, field, keys, max_age=None):
+        """Return {key: record} for all cached records whose *field* ('name' or
+        'specimen_id') is in *keys*, and that were fetched less than *max_age*
+        seconds ago (any age if None).
+        """
+        assert field in ('name', 'specimen_id')
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                rows = self.conn.execute(
+                    "select %s, fetch_time, record from specimen where %s in (%s)" % (field, field, ','.join('?'*len(chunk))),
+                    chunk).fetchall()
+                for key, fetch_time, rec in rows:
+                    if max_age is not None and time.time() - fetch_time > max_age:
+                        continue
+                    found[key] = pickle.loads(bytes(rec))
+        return found
+
+    def put(self, records):
+        """Store a list of records returned from LIMS.
+        """
+        now = time.time()
+        rows = [(rec['specimen_name'], rec['specimen_id'], now, sqlite3.Binary(pickle.dumps(rec, pickle.HIGHEST_PROTOCOL)))
+                for rec in records]
+        with self._lock:
+            self.conn.executemany("insert or replace into specimen (name, specimen_id, fetch_time, record) values (?, ?, ?, ?)", rows)
+            self.conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute("delete from specimen")
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class MemoryLims(object):
+    """In-memory LIMS backend for tests and offline development::
+
+        lims.set_backend(lims.MemoryLims([
+            {'specimen_name': 'Ntsr1-Cre_GN220;Ai14-349905.03.06', 'specimen_id': 1, 'parent_id': None,
+             'organism': 'Mus musculus', ...},
+        ]))
+
+    Each record holds the fields selected by specimen_records(). The queries
+    issued by specimen_records(), specimen_info(), specimen_id_from_name() and
+    cell_cluster_ids() are answered from these records; any other query raises
+    ValueError. Every query received is appended to `queries`.
+    """
+    def __init__(self, specimens):
+        self.specimens = [dict(rec) for rec in specimens]
+        self.queries = []
+
+    def query(self, sql):
+        self.queries.append(sql)
+
+        # specimen_records()
+        m = re.search(r"where specimens\.(name|id) in \((.*)\)", sql, re.S)
+        if m is not None:
+            field = {'name': 'specimen_name', 'id': 'specimen_id'}[m.group(1)]
+            values = set()
+            for name, sid in re.findall(r"'((?:[^']|'')*)'|(\d+)", m.group(2)):
+                values.add(name.replace("''", "'") if sid == '' else int(sid))
+            return [dict(rec) for rec in self.specimens if rec[field] in values]
+
+        # specimen_id_from_name()
+        m = re.match(r"\s*select id from specimens where name='(.*)'\s*$", sql, re.S)
+        if m is not None:
+            return [{'id': rec['specimen_id']} for rec in self.specimens if rec['specimen_name'] == m.group(1)]
+
+        # cell_cluster_ids()
+        m = re.match(r"\s*select id from specimens where specimens\.parent_id=(\d+)\s*$", sql, re.S)
+        if m is not None:
+            parent = int(m.group(1))
+            return [{'id': rec['specimen_id']} for rec in self.specimens if rec.get('parent_id') == parent]
+
+        raise ValueError("MemoryLims does not support this query:\n%s" % sql)
+
+
+_specimen_query = """
+    select 
+        organisms.name as organism, 
+        ages.days as age,
+        donors.date_of_birth as date_of_birth,
+        donors.full_genotype as genotype,
+        donors.weight as weight,
+        genders.name as sex,
+        tissue_processings.section_thickness_um as thickness,
+        tissue_processings.instructions as section_instructions,
+        plane_of_sections.name as plane_of_section,
+        flipped_specimens.name as flipped,
+        specimens.histology_well_name as histology_well_name,
+        specimens.carousel_well_name as carousel_well_name,
+        specimens.parent_id as parent_id,
+        specimens.name as specimen_name,
+        specimens.id as specimen_id
+    from specimens
+        left join donors on specimens.donor_id=donors.id 
+        left join organisms on donors.organism_id=organisms.id
+        left join ages on donors.age_id=ages.id
+        left join genders on donors.gender_id=genders.id
+        left join tissue_processings on specimens.tissue_processing_id=tissue_processings.id
+        left join plane_of_sections on tissue_processings.plane_of_section_id=plane_of_sections.id
+        left join flipped_specimens on flipped_specimens.id = specimens.flipped_specimen_id
+"""
+
+
+def specimen_records(specimen_names=None, specimen_ids=None, max_age=None):
+    """Return {name_or_id: [record, ...]} containing the raw LIMS records found for
+    each of the given specimen names (or IDs).
+
+    Records are read from the local specimen cache when they are younger than
+    *max_age* seconds (default config.lims_cache_ttl); all others are fetched with
+    a single `where specimens.name in (...)` query per 500 specimens and then cached.
+    Specimens that LIMS has no record for are omitted.
+    """
+    if specimen_names is not None:
+        field, col = 'name', 'specimen_name'
+        keys = [name.strip() for name in specimen_names]
+    elif specimen_ids is not None:
+        field, col = 'specimen_id', 'specimen_id'
+        keys = [int(sid) for sid in specimen_ids]
+    else:
+        raise ValueError("Must specify specimen names or IDs")
+    if max_age is None:
+        max_age = config.lims_cache_ttl
+
+    cache = specimen_cache()
+    found = {}
+    if cache is not None:
+        for key, rec in cache.get(field, keys, max_age=None if _offline else max_age).items():
+            found[key] = [rec]
+    missing = [k for k in keys if k not in found]
+    if len(missing) == 0 or _offline:
+        return found
+
+    sql_field = {'name': 'specimens.name', 'specimen_id': 'specimens.id'}[field]
+    fetched = []
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i+500]
+        if field == 'name':
+            values = ', '.join(["'%s'" % k.replace("'", "''") for k in chunk])
+        else:
+            values = ', '.join(['%d' % k for k in chunk])
+        fetched.extend(query(_specimen_query + "where %s in (%s);" % (sql_field, values)))
+
+    for rec in fetched:
+        found.setdefault(rec[col], []).append(rec)
+    if cache is not None:
+        # ambiguous specimens are not cached so that they keep raising errors
+        cache.put([recs[0] for key, recs in found.items() if key in missing and len(recs) == 1])
+    return found
+
+
+def specimen_info_batch(specimen_names=None, specimen_ids=None, max_age=None):
+    """Return {name_or_id: info} for many specimens at once, where each info dict is
+    as returned by specimen_info().
+
+    Specimens that have no unique record in LIMS are omitted.
+    """
+    recs = specimen_records(specimen_names=specimen_names, specimen_ids=specimen_ids, max_age=max_age)
+    return {key: _parse_specimen_info(r[0]) for key, r in recs.items() if len(r) == 1}
+
+
+def specimen_info(specimen_name=None, specimen_id=None, max_age=None):
     """Return a dictionary of information about a specimen queried from LIMS.
     
     Also generates information about the hemisphere and which side of the slice
@@ -29,49 +295,31 @@ def specimen_info(specimen_name=None, specimen_id=None):
     exposed_surface : The surface that was exposed during the experiment (right, 
         left, anterior, or posterior)
     section_number : indicates the order this slice was sectioned (1=first)
-    """
-    
-    # Query all interesting information about this specimen from LIMS
-    query = """
-        select 
-            organisms.name as organism, 
-            ages.days as age,
-            donors.date_of_birth as date_of_birth,
-            donors.full_genotype as genotype,
-            donors.weight as weight,
-            genders.name as sex,
-            tissue_processings.section_thickness_um as thickness,
-            tissue_processings.instructions as section_instructions,
-            plane_of_sections.name as plane_of_section,
-            flipped_specimens.name as flipped,
-            specimens.histology_well_name as histology_well_name,
-            specimens.carousel_well_name as carousel_well_name,
-            specimens.parent_id as parent_id,
-            specimens.name as specimen_name,
-            specimens.id as specimen_id
-        from specimens
-            left join donors on specimens.donor_id=donors.id 
-            left join organisms on donors.organism_id=organisms.id
-            left join ages on donors.age_id=ages.id
-            left join genders on donors.gender_id=genders.id
-            left join tissue_processings on specimens.tissue_processing_id=tissue_processings.id
-            left join plane_of_sections on tissue_processings.plane_of_section_id=plane_of_sections.id
-            left join flipped_specimens on flipped_specimens.id = specimens.flipped_specimen_id
+
+    Records are cached locally; see specimen_records().
     """
     if specimen_name is not None:
         sid = specimen_name.strip()
-        query += "where specimens.name='%s';" % sid
+        recs = specimen_records(specimen_names=[sid], max_age=max_age)
     elif specimen_id is not None:
         sid = specimen_id
-        query += "where specimens.id='%d';" % sid
+        recs = specimen_records(specimen_ids=[sid], max_age=max_age)
     else:
         raise ValueError("Must specify specimen name or ID")
-        
-    r = lims.query(query)
+
+    r = recs.get(sid, [])
     if len(r) != 1:
+        if _offline and len(r) == 0:
+            raise Exception("Specimen '%s' is not in the local LIMS cache (offline mode)" % sid)
         raise Exception("LIMS lookup for specimen '%s' returned %d results (expected 1)" % (sid, len(r)))
-    rec = r[0]
-    
+    return _parse_specimen_info(r[0])
+
+
+def _parse_specimen_info(rec):
+    """Convert a raw specimen record from LIMS to the form returned by specimen_info().
+    """
+    rec = dict(rec)
+
     # convert thickness to unscaled
     rec['thickness'] = rec['thickness'] * 1e-6
     # convert organism to more easily searchable form
@@ -152,14 +400,14 @@ def specimen_images(specimen_name):
         left join treatments on treatments.id = images.treatment_id
         where specimens.name='%s';
         """ % specimen_name
-    r = lims.query(q)
+    r = query(q)
     return [(rec['id'], rec['name']) for rec in r]
 
 
 def specimen_id_from_name(spec_name):
     """Return the LIMS ID of a specimen give its name.
     """
-    recs = lims.query("select id from specimens where name='%s'" % spec_name)
+    recs = query("select id from specimens where name='%s'" % spec_name)
     if len(recs) == 0:
         raise ValueError('No LIMS specimen named "%s"' % spec_name)
     return recs[0]['id']
@@ -169,7 +417,7 @@ def specimen_ephys_roi_plans(spec_name):
     """Return a list of all ephys roi plans for this specimen.
     """
     sid = specimen_id_from_name(spec_name)
-    recs = lims.query("""
+    recs = query("""
         select 
             ephys_roi_plans.id as ephys_roi_plan_id,
             ephys_specimen_roi_plans.id as ephys_specimen_roi_plan_id,
@@ -184,12 +432,12 @@ def specimen_ephys_roi_plans(spec_name):
 
 
 def cell_cluster_ids(spec_id):
-    recs = lims.query("select id from specimens where specimens.parent_id=%d" % spec_id)
+    recs = query("select id from specimens where specimens.parent_id=%d" % spec_id)
     return [rec['id'] for rec in recs]
 
 
 def cell_cluster_data_paths(cluster_id):
-    recs = lims.query("""
+    recs = query("""
         select ephys_roi_results.storage_directory 
         from specimens 
         join ephys_roi_results on ephys_roi_results.id=specimens.ephys_roi_result_id
@@ -199,7 +447,7 @@ def cell_cluster_data_paths(cluster_id):
 
 
 def specimen_metadata(spec_id):
-    recs = lims.query("select data from specimen_metadata where specimen_id=%d" % spec_id)
+    recs = query("select data from specimen_metadata where specimen_id=%d" % spec_id)
     if len(recs) == 0:
         return None
     meta = recs[0]['data']
@@ -297,6 +545,123 @@ def expt_submissions(spec_id, acq_timestamp):
     return submissions
     
 
+_status_table = None
+def submission_status():
+    """Return the SubmissionStatus table stored in config.cache_path.
+    """
+    global _status_table
+    if _status_table is None:
+        _status_table = SubmissionStatus(os.path.join(_cache_dir(), 'lims_submissions.sqlite'))
+    return _status_table
+
+
+class SubmissionStatus(object):
+    """Local table recording the LIMS submission state of each site.
+
+    Each site (keyed by its path) has a state, one of:
+
+    * 'error'           : the site failed checks, packaging, or submission
+    * 'submitted'       : files were handed to LIMS; no trigger seen yet
+    * 'trigger pending' : the trigger file is waiting in the LIMS incoming folder
+    * 'trigger failed'  : LIMS rejected the trigger
+    * 'succeeded'       : the experiment is in LIMS
+
+    and a message giving more detail (errors, trigger error text or data paths).
+    """
+    final_states = ('succeeded',)
+
+    def __init__(self, filename):
+        self.filename = filename
+        path = os.path.dirname(filename)
+        if path != '' and not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.conn.execute("""create table if not exists submission (
+            site_path text primary key,
+            spec_name text,
+            spec_id integer,
+            acq_timestamp real,
+            state text,
+            message text,
+            update_time real
+        )""")
+        self.conn.execute("create index if not exists submission_state_index on submission (state)")
+        self.conn.commit()
+
+    def get(self, site_path):
+        """Return the status record for a site as a dict, or None.
+        """
+        return self.get_many([site_path]).get(site_path)
+
+    def get_many(self, site_paths):
+        """Return {site_path: record} for all of *site_paths* that have a status.
+        """
+        site_paths = list(site_paths)
+        found = {}
+        with self._lock:
+            for i in range(0, len(site_paths), 500):
+                chunk = site_paths[i:i+500]
+                rows = self.conn.execute(
+                    "select * from submission where site_path in (%s)" % ','.join('?'*len(chunk)), chunk)
+                for row in rows:
+                    found[row[0]] = self._record(row)
+        return found
+
+    def by_state(self, *states):
+        """Return a list of records for all sites in any of the given states
+        (or all sites if none are given).
+        """
+        with self._lock:
+            if len(states) == 0:
+                rows = self.conn.execute("select * from submission order by site_path").fetchall()
+            else:
+                rows = self.conn.execute("select * from submission where state in (%s) order by site_path" % ','.join('?'*len(states)), states).fetchall()
+        return [self._record(row) for row in rows]
+
+    def set(self, site_path, state, message='', spec_name=None, spec_id=None, acq_timestamp=None):
+        """Record the state of a site. Fields given as None keep their previous value.
+        """
+        self.set_many([(site_path, state, message, spec_name, spec_id, acq_timestamp)])
+
+    def set_many(self, updates):
+        """Record many (site_path, state, message, spec_name, spec_id, acq_timestamp)
+        tuples at once.
+        """
+        now = time.time()
+        with self._lock:
+            for site_path, state, message, spec_name, spec_id, acq_timestamp in updates:
+                self.conn.execute("insert or ignore into submission (site_path) values (?)", (site_path,))
+                self.conn.execute("""update submission set
+                        state=?, message=?, update_time=?,
+                        spec_name=coalesce(?, spec_name),
+                        spec_id=coalesce(?, spec_id),
+                        acq_timestamp=coalesce(?, acq_timestamp)
+                    where site_path=?""",
+                    (state, message, now, spec_name, spec_id, acq_timestamp, site_path))
+            self.conn.commit()
+
+    def remove(self, site_path):
+        with self._lock:
+            self.conn.execute("delete from submission where site_path=?", (site_path,))
+            self.conn.commit()
+
+    def _record(self, row):
+        keys = ['site_path', 'spec_name', 'spec_id', 'acq_timestamp', 'state', 'message', 'update_time']
+        return dict(zip(keys, row))
+
+
+def submission_state(submissions):
+    """Reduce the list returned by lims.expt_submissions() to a (state, message)
+    pair, or (None, '') if nothing has been submitted.
+    """
+    for state in ('succeeded', 'trigger failed', 'trigger pending'):
+        subs = [sub for sub in submissions if sub[0] == state]
+        if len(subs) > 0:
+            return state, '\n'.join([str(sub[-1]) for sub in subs])
+    return None, ''
+
+
 if __name__ == '__main__':
     # testing specimen
     spec_name = "Ntsr1-Cre_GN220;Ai14-349905.03.06"
@@ -15,6 +15,9 @@ import h5py
 import shutil
 import tempfile
 import atexit
+import threading
+import multiprocessing
+from collections import OrderedDict
 
 # Requires the patched version of nwb-api from https://github.com/t-b/nwb-api/tree/local_fixes
 import nwb
@@ -22,6 +25,10 @@ from nwb.nwbco import *
 
 tmpdir = None
 
+# Groups of the site NWB that are referenced with external links rather than
+# copied in "link" mode
+linkedGroups = ['/acquisition/timeseries', '/stimulus/presentation', '/stimulus/templates']
+
 def removeTmpdir():
     global tmpdir
     if tmpdir is not None:
@@ -30,8 +37,27 @@ def removeTmpdir():
 atexit.register(removeTmpdir)
 
 
-def appendMAFile(siteNWBs, filePath, filedesc):
-    """ Split and append the given ma file from ACQ4 to the NWB files """
+def appendMAFile(siteNWBs, filePath, filedesc, pending=None):
+    """ Split and append the given ma file from ACQ4 to the NWB files
+
+    If `pending` is given ({siteNWB: [operation, ...]}, see collectPackagingOps),
+    the operation is appended to it instead of being written """
+
+    if pending is not None:
+        for f in siteNWBs:
+            pending[f].append(('ma', filePath, filedesc))
+        return
+
+    for f in siteNWBs:
+        handle = openNWB(f)
+        writeMAFile(handle, filePath, filedesc)
+        handle.close()
+
+def writeMAFile(handle, filePath, filedesc, nameFunc=None):
+    """ Write each frame of the given ma file to an open NWB file """
+
+    if nameFunc is None:
+        nameFunc = getUnusedDatasetName
 
     imageAttrs = {}
     suffix     = os.path.splitext(filePath)[1]
@@ -58,30 +84,42 @@ def appendMAFile(siteNWBs, filePath, filedesc):
     dset = root.get('data')
     n    = dset.shape[0]
 
-    for f in siteNWBs:
-        handle = openNWB(f)
+    for i in range(n):
+        image = dset[i, ...]
+
+        meta = json.loads(filedesc)
+        meta['sourceFile']        = str(os.path.basename(filePath))
+        meta['sourceFileDataset'] = '/data'
+        meta['sourceFileIndex']   = i
 
-        for i in range(n):
-            image = dset[i, ...]
+        for m in allMetadata:
+            meta['sourceMetaData_' + m] = allMetadata[m][i].tolist()
 
-            meta = json.loads(filedesc)
-            meta['sourceFile']        = str(os.path.basename(filePath))
-            meta['sourceFileDataset'] = '/data'
-            meta['sourceFileIndex']   = i
+        name = nameFunc(handle, "/acquisition/images/", "image")
+        imageAttrs['desc'] = json.dumps(meta)
+        handle.create_reference_image(image, name, **imageAttrs)
+
+    root.close()
 
-            for m in allMetadata:
-                meta['sourceMetaData_' + m] = allMetadata[m][i].tolist()
+def appendImageFileToNWB(siteNWBs, imageFilePath, filedesc, pending=None):
+    """ Add the contents of `imageFilePath` to all NWB files in the /acquisition/images group
+    (or to `pending`, see appendMAFile) """
 
-            name = getUnusedDatasetName(handle, "/acquisition/images/", "image")
-            imageAttrs['desc'] = json.dumps(meta)
-            handle.create_reference_image(image, name, **imageAttrs)
+    if pending is not None:
+        for f in siteNWBs:
+            pending[f].append(('image', imageFilePath, filedesc))
+        return
 
+    for f in siteNWBs:
+        handle = openNWB(f)
+        writeImageFile(handle, imageFilePath, filedesc)
         handle.close()
 
-    root.close()
+def writeImageFile(handle, imageFilePath, filedesc, nameFunc=None):
+    """ Write the contents of `imageFilePath` to an open NWB file """
 
-def appendImageFileToNWB(siteNWBs, imageFilePath, filedesc):
-    """ Add the contents of `imageFilePath` to all NWB files in the /acquisition/images group """
+    if nameFunc is None:
+        nameFunc = getUnusedDatasetName
 
     imageAttrs = {}
     suffix     = os.path.splitext(imageFilePath)[1]
@@ -95,23 +133,31 @@ def appendImageFileToNWB(siteNWBs, imageFilePath, filedesc):
 
     data = np.fromfile(str(imageFilePath), dtype='int8')
 
-    for f in siteNWBs:
-        handle = openNWB(f)
+    name = nameFunc(handle, "/acquisition/images/", "image")
+    handle.create_reference_image(data, name, **imageAttrs)
 
-        name = getUnusedDatasetName(handle, "/acquisition/images/", "image")
-        handle.create_reference_image(data, name, **imageAttrs)
-        handle.close()
+def appendMiscFileToNWB(siteNWBs, basename, content, pending=None):
+    """ Write the given file contents into all NWB files (or add them to `pending`, see appendMAFile) """
 
-def appendMiscFileToNWB(siteNWBs, basename, content):
-    """ Write the given file contents into all NWB files"""
+    if pending is not None:
+        for f in siteNWBs:
+            pending[f].append(('misc', basename, content))
+        return
 
     for f in siteNWBs:
         handle = openNWB(f)
-
-        name = getUnusedDatasetName(handle, "/general/misc_files", basename)
-        handle.set_metadata("misc_files" + "/" + name, content)
+        writeMiscFile(handle, basename, content)
         handle.close()
 
+def writeMiscFile(handle, basename, content, nameFunc=None):
+    """ Write the given file contents into an open NWB file """
+
+    if nameFunc is None:
+        nameFunc = getUnusedDatasetName
+
+    name = nameFunc(handle, "/general/misc_files", basename)
+    handle.set_metadata("misc_files" + "/" + name, content)
+
 def getUnusedDatasetName(fileHandle, group, basename):
     """ Return an unuused dataset name """
 
@@ -135,6 +181,47 @@ def getUnusedDatasetName(fileHandle, group, basename):
 
     raise NameError("Could not find an unused dataset name")
 
+class DatasetNamer(object):
+    """ Assigns unused dataset names like getUnusedDatasetName, but lists each
+    group only once rather than probing the file for every new name """
+
+    def __init__(self):
+        self.groups = {}
+
+    def __call__(self, fileHandle, group, basename):
+        hdf5File = fileHandle.file_pointer
+
+        if group not in self.groups:
+            g = hdf5File.get(group)
+            if g is None:
+                g = hdf5File.create_group(group)
+            self.groups[group] = set(g.keys())
+
+        used = self.groups[group]
+
+        i = 0
+        while True:
+            name = '%s_%05d' % (basename, i)
+            if name not in used:
+                used.add(name)
+                return name
+            i += 1
+
+def writePackagingOps(handle, ops):
+    """ Write a list of operations collected by collectPackagingOps to an open NWB file """
+
+    nameFunc = DatasetNamer()
+
+    for op in ops:
+        if op[0] == 'misc':
+            writeMiscFile(handle, op[1], op[2], nameFunc=nameFunc)
+        elif op[0] == 'image':
+            writeImageFile(handle, op[1], op[2], nameFunc=nameFunc)
+        elif op[0] == 'ma':
+            writeMAFile(handle, op[1], op[2], nameFunc=nameFunc)
+        else:
+            raise NameError("Unknown packaging operation \"%s\"" % op[0])
+
 def encodeAsJSONString(obj):
     """ Return the object as string in JSON encoding """
 
@@ -229,7 +316,7 @@ def getFileContents(path):
 
     return raw_data
 
-def appendPseudoYamlLog(siteNWBs, path, basename, filedesc):
+def appendPseudoYamlLog(siteNWBs, path, basename, filedesc, pending=None):
     """ Append a pseudo YAML file to NWB """
 
     raw_data = getFileContents(path)
@@ -239,10 +326,10 @@ def appendPseudoYamlLog(siteNWBs, path, basename, filedesc):
 
     data = yaml.dump('[' + raw_data + ']')
 
-    appendMiscFileToNWB(siteNWBs, basename + "_meta", content = filedesc)
-    appendMiscFileToNWB(siteNWBs, basename, content = data)
+    appendMiscFileToNWB(siteNWBs, basename + "_meta", content = filedesc, pending = pending)
+    appendMiscFileToNWB(siteNWBs, basename, content = data, pending = pending)
 
-def addDataSource(siteNWBs):
+def addDataSource(siteNWBs, pending=None):
     """ Add entries to site NWB file identifying the source Igor Experiment (PXP) """
 
     try:
@@ -262,9 +349,9 @@ def addDataSource(siteNWBs):
 
     text = json.dumps({ 'name' : name, 'sha256' : digest, 'last_modification' : isotime})
 
-    appendMiscFileToNWB(siteNWBs, 'dataSource', text)
+    appendMiscFileToNWB(siteNWBs, 'dataSource', text, pending = pending)
 
-def addSiteContents(siteNWBs, filesToInclude, slicePath, siteName):
+def addSiteContents(siteNWBs, filesToInclude, slicePath, siteName, pending=None):
     """ Add site specific entries to the NWB file """
 
     sitePath  = os.path.join(slicePath, siteName)
@@ -274,14 +361,14 @@ def addSiteContents(siteNWBs, filesToInclude, slicePath, siteName):
         print "Expected exactly one NWB file belonging to site folder %s, skipping it." % sitePath
         return 1
 
-    addDataSource(siteNWBs)
+    addDataSource(siteNWBs, pending)
 
     dh = adm.getHandle(sitePath)
     dh.checkIndex()
 
     data = encodeAsJSONString(dh["."].info())
-    appendMiscFileToNWB(siteNWBs, "%s_index_meta" % siteName, data)
-    appendMiscFileToNWB(siteNWBs, "%s_index" % siteName, getFileContents(siteIndex))
+    appendMiscFileToNWB(siteNWBs, "%s_index_meta" % siteName, data, pending = pending)
+    appendMiscFileToNWB(siteNWBs, "%s_index" % siteName, getFileContents(siteIndex), pending = pending)
 
     for k in dh.ls():
 
@@ -300,17 +387,17 @@ def addSiteContents(siteNWBs, filesToInclude, slicePath, siteName):
             filedesc = encodeAsJSONString(dh[k].info())
 
             if path.endswith(".tif"):
-                appendImageFileToNWB(siteNWBs, path, filedesc)
+                appendImageFileToNWB(siteNWBs, path, filedesc, pending = pending)
             elif path.endswith(".ma"):
-                appendMAFile(siteNWBs, path, filedesc)
+                appendMAFile(siteNWBs, path, filedesc, pending = pending)
             elif path.endswith(".log"):
-                appendPseudoYamlLog(siteNWBs, path, k, filedesc)
+                appendPseudoYamlLog(siteNWBs, path, k, filedesc, pending = pending)
             else:
                 raise NameError("Unexpected file type \"%s\" in index \"%s\"." % (k, siteIndex))
         else:
             raise NameError("Unexpected key \"%s\" in index \"%s\"." % (k, siteIndex))
 
-def addSliceContents(siteNWBs, filesToInclude, basepath, sliceName):
+def addSliceContents(siteNWBs, filesToInclude, basepath, sliceName, pending=None):
     """ Add entries to the slice specific NWB file """
 
     slicePath  = os.path.join(basepath, sliceName)
@@ -326,8 +413,8 @@ def addSliceContents(siteNWBs, filesToInclude, basepath, sliceName):
     dh.checkIndex()
 
     data = encodeAsJSONString(dh["."].info())
-    appendMiscFileToNWB(siteNWBs, "%s_index_meta" % sliceName, data)
-    appendMiscFileToNWB(siteNWBs, "%s_index" % sliceName, getFileContents(sliceIndex))
+    appendMiscFileToNWB(siteNWBs, "%s_index_meta" % sliceName, data, pending = pending)
+    appendMiscFileToNWB(siteNWBs, "%s_index" % sliceName, getFileContents(sliceIndex), pending = pending)
 
     for k in dh.ls():
         if not dh.isManaged(k):
@@ -338,17 +425,19 @@ def addSliceContents(siteNWBs, filesToInclude, basepath, sliceName):
         filedesc = encodeAsJSONString(dh[k].info())
 
         if os.path.isdir(path): # site folder
-            appendMiscFileToNWB(sliceNWBs, "%s_%s" % (sliceName, k), filedesc)
-            addSiteContents(sliceNWBs, filesToInclude, slicePath, k)
+            appendMiscFileToNWB(sliceNWBs, "%s_%s" % (sliceName, k), filedesc, pending = pending)
+            siteNWBsInFolder = [elem for elem in sliceNWBs if elem.startswith(path + os.sep)]
+            if len(siteNWBsInFolder) > 0:
+                addSiteContents(siteNWBsInFolder, filesToInclude, slicePath, k, pending)
         elif os.path.isfile(path): # check if we need to handle it
 
             if fileShouldBeSkipped(path, filesToInclude):
                 continue
 
             if path.endswith(".tif"):
-                appendImageFileToNWB(sliceNWBs, path, filedesc)
+                appendImageFileToNWB(sliceNWBs, path, filedesc, pending = pending)
             elif path.endswith(".ma"):
-                appendMAFile(sliceNWBs, path, filedesc)
+                appendMAFile(sliceNWBs, path, filedesc, pending = pending)
             else:
                 raise NameError("Unexpected file type \"%s\" in index \"%s\"" % (k, sliceIndex))
         else:
@@ -374,7 +463,7 @@ def deriveOutputNWB(siteNWB):
 
     return os.path.abspath(os.path.join(tmpdir, filename))
 
-def buildCombinedNWB(siteNWB, filesToInclude = []):
+def buildCombinedNWB(siteNWB, filesToInclude = [], mode = 'legacy'):
     """
     Convenience function for creating a new NWB file from an existing one
     with additional relevant metadata added.
@@ -383,6 +472,8 @@ def buildCombinedNWB(siteNWB, filesToInclude = []):
     @param: filesToInclude List of absolute paths to slice/site metadata files
                            (.ma/.tif/.log) to include only. Default is to include all metadata
                            retrievable from the .index files.
+    @param: mode           "legacy", or "copy"/"link" to write the file in a single streaming
+                           pass (see buildCombinedNWBStreaming)
 
     @return: absolute path to the combined NWB file
 
@@ -399,7 +490,7 @@ def buildCombinedNWB(siteNWB, filesToInclude = []):
 
     basepath = os.path.abspath(os.path.join(os.path.dirname(siteNWB), "../.."))
 
-    return buildCombinedNWBInternal(basepath, [siteNWB], filesToInclude)[0]
+    return buildCombinedNWBInternal(basepath, [siteNWB], filesToInclude, mode)[0]
 
 # - base 1     # no NWB
 #   - slice 1  # no NWB
@@ -408,14 +499,15 @@ def buildCombinedNWB(siteNWB, filesToInclude = []):
 #   - slice 2
 #   - ...
 
-def buildCombinedNWBInternal(basepath, siteNWBs, filesToInclude):
-    """ NOT FOR PUBLIC USE """
+def buildCombinedNWBInternal(basepath, siteNWBs, filesToInclude, mode='legacy'):
+    """ NOT FOR PUBLIC USE
 
-    # we have three types of keys in the main index file
-    # ---------------------------------------------------------------------
-    # '.'               | common description of the experiment | (unique)
-    # '$existingFile'   | log file of the experiment           | (multiple)
-    # '$existingFolder' | different slices for each experiment | (multiple)
+    mode may be "legacy" (each addition opens and closes the output NWB files),
+    or one of the streaming modes "copy" or "link" (see buildCombinedNWBStreaming).
+    """
+
+    if mode != 'legacy':
+        return buildCombinedNWBStreaming(basepath, siteNWBs, filesToInclude, mode)
 
     dh = adm.getHandle(basepath)
     dh.checkIndex()
@@ -429,6 +521,26 @@ def buildCombinedNWBInternal(basepath, siteNWBs, filesToInclude):
     for elem in siteNWBs:
         os.remove(deriveOutputNWB(elem))
 
+    addMainContents(siteNWBs, filesToInclude, basepath, dh)
+
+    combinedNWBs = []
+
+    for elem in siteNWBs:
+        combinedNWBs.append(deriveOutputNWB(elem))
+
+    return combinedNWBs
+
+def addMainContents(siteNWBs, filesToInclude, basepath, dh, pending=None):
+    """ Add entries for the slices and log files in the main experiment folder """
+
+    # we have three types of keys in the main index file
+    # ---------------------------------------------------------------------
+    # '.'               | common description of the experiment | (unique)
+    # '$existingFile'   | log file of the experiment           | (multiple)
+    # '$existingFolder' | different slices for each experiment | (multiple)
+
+    logfile = os.path.join(basepath, '.index')
+
     for k in dh.ls():
         if not dh.isManaged(k):
             continue
@@ -436,22 +548,237 @@ def buildCombinedNWBInternal(basepath, siteNWBs, filesToInclude):
         path = os.path.abspath(os.path.join(basepath, k))
 
         if os.path.isdir(path): # slice folder
-            addSliceContents(siteNWBs, filesToInclude, basepath, k)
+            addSliceContents(siteNWBs, filesToInclude, basepath, k, pending)
         elif os.path.isfile(path): # main log file
 
             data = encodeAsJSONString(dh[k].info())
-            appendMiscFileToNWB(siteNWBs, basename = "main_logfile_meta", content = data)
-            appendMiscFileToNWB(siteNWBs, basename = "main_logfile", content = getFileContents(path))
+            appendMiscFileToNWB(siteNWBs, basename = "main_logfile_meta", content = data, pending = pending)
+            appendMiscFileToNWB(siteNWBs, basename = "main_logfile", content = getFileContents(path), pending = pending)
         else:
             raise NameError("Unexpected key \"%s\" in index \"%s\"" % (k, logfile))
 
+def collectPackagingOps(basepath, siteNWBs, filesToInclude):
+    """
+    Walk the experiment folder and return {siteNWB: [operation, ...]} listing
+    everything to be added to each combined NWB file, without writing anything.
+
+    Metadata shared by several sites (main and slice level) is read and
+    encoded only once.
+    """
+    dh = adm.getHandle(basepath)
+    dh.checkIndex()
+
+    pending = OrderedDict((f, []) for f in siteNWBs)
+
+    data = encodeAsJSONString(dh["."].info())
+    appendMiscFileToNWB(siteNWBs, basename = "main_index_meta", content = data, pending = pending)
+
+    logfile = os.path.join(basepath, '.index')
+    appendMiscFileToNWB(siteNWBs, basename = "main_index", content = getFileContents(logfile), pending = pending)
+
+    addMainContents(siteNWBs, filesToInclude, basepath, dh, pending)
+
+    return pending
+
+def createOutputNWB(siteNWB, outputNWB, mode):
+    """
+    Create the combined NWB file from the site NWB, either as a full copy
+    (mode="copy") or as a new file holding external links to the site NWB's
+    acquisition and stimulus data (mode="link").
+
+    Files created in link mode are only readable while the site NWB remains at
+    the same location, so they are not suitable for submission.
+    """
+
+    if mode == 'copy':
+        shutil.copyfile(siteNWB, outputNWB)
+    elif mode == 'link':
+        src = h5py.File(siteNWB, 'r')
+        dst = h5py.File(outputNWB, 'w')
+        try:
+            linkGroup(src, dst, os.path.abspath(siteNWB))
+        finally:
+            dst.close()
+            src.close()
+    else:
+        raise NameError("Unknown packaging mode \"%s\"" % mode)
+
+def linkGroup(src, dst, srcFile):
+    """ Recursively copy the group `src` into `dst`, replacing groups listed in linkedGroups with external links """
+
+    for k, v in src.attrs.items():
+        dst.attrs[k] = v
+
+    for name in src:
+        path = src[name].name
+
+        if path in linkedGroups:
+            dst[name] = h5py.ExternalLink(srcFile, path)
+        elif any([g.startswith(path + '/') for g in linkedGroups]):
+            linkGroup(src[name], dst.create_group(name), srcFile)
+        else:
+            src.copy(name, dst)
+
+def writeCombinedNWB(siteNWB, outputNWB, ops, mode='copy'):
+    """
+    Create the combined NWB file and write all collected operations with a single open.
+
+    The file is written as "<outputNWB>.partial" and only renamed to outputNWB
+    once complete, so an existing outputNWB is never left half written.
+    """
+
+    partialNWB = outputNWB + ".partial"
+
+    if os.path.isfile(partialNWB):
+        os.remove(partialNWB)
+
+    try:
+        createOutputNWB(siteNWB, partialNWB, mode)
+
+        settings = {}
+
+        settings["filename"]      = partialNWB
+        settings["auto_compress"] = True
+        settings["modify"]        = True
+
+        try:
+            handle = nwb.NWB(**settings)
+        except:
+            raise NameError("Could not open the NWB file \"%s\"." % partialNWB)
+
+        try:
+            writePackagingOps(handle, ops)
+        finally:
+            handle.close()
+
+        if os.path.isfile(outputNWB):
+            os.remove(outputNWB)
+        os.rename(partialNWB, outputNWB)
+    finally:
+        if os.path.isfile(partialNWB):
+            os.remove(partialNWB)
+
+    return outputNWB
+
+def buildCombinedNWBStreaming(basepath, siteNWBs, filesToInclude, mode='copy'):
+    """
+    Build the combined NWB files in one pass: all additions are collected
+    first, then each output file is created (see createOutputNWB) and written
+    with a single open.
+
+    Unlike the legacy mode, the main .index contents ("main_index" and
+    "main_index_meta") are retained in the output.
+    """
+
+    ops = collectPackagingOps(basepath, siteNWBs, filesToInclude)
+
     combinedNWBs = []
 
     for elem in siteNWBs:
-        combinedNWBs.append(deriveOutputNWB(elem))
+        combinedNWBs.append(writeCombinedNWB(elem, deriveOutputNWB(elem), ops[elem], mode))
 
     return combinedNWBs
 
+def packageSiteNWB(job):
+    """ Worker for buildCombinedNWBParallel, returns the output file and the time taken """
+
+    siteNWB, outputNWB, ops, mode = job
+
+    start = time.time()
+    writeCombinedNWB(siteNWB, outputNWB, ops, mode)
+
+    return outputNWB, time.time() - start
+
+def buildCombinedNWBParallel(basepath, siteNWBs, filesToInclude, processes = None, mode = 'copy'):
+    """
+    Build the combined NWB files for several sites concurrently.
+
+    Experiment and slice level metadata is read and encoded once in this
+    process (see collectPackagingOps), then each site is written by a pool
+    of `processes` worker processes (default: one per CPU) using
+    writeCombinedNWB.
+
+    @return: (list of combined NWB files, {siteNWB: seconds spent writing it})
+    """
+
+    ops = collectPackagingOps(basepath, siteNWBs, filesToInclude)
+
+    jobs = [(elem, deriveOutputNWB(elem), ops[elem], mode) for elem in siteNWBs]
+
+    processes = min(processes or multiprocessing.cpu_count(), len(jobs))
+
+    if processes <= 1:
+        results = [packageSiteNWB(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(packageSiteNWB, jobs, chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    combinedNWBs = [res[0] for res in results]
+    timing = OrderedDict((elem, res[1]) for elem, res in zip(siteNWBs, results))
+
+    return combinedNWBs, timing
+
+def directorySize(path):
+    """ Return the total size of all files below `path` """
+
+    total = 0
+
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+
+    return total
+
+def benchmarkPackaging(siteNWB, filesToInclude = [], modes = ('legacy', 'copy', 'link'), interval = 0.05):
+    """
+    Package a single site with each of the given modes and return
+    {mode: {'time': seconds, 'peak_disk': bytes, 'output_size': bytes}}.
+
+    Peak disk usage is that of the temporary packaging folder, sampled every
+    `interval` seconds.
+    """
+
+    basepath = os.path.abspath(os.path.join(os.path.dirname(siteNWB), "../.."))
+    outputNWB = deriveOutputNWB(siteNWB)
+    results = OrderedDict()
+
+    for mode in modes:
+        if os.path.isfile(outputNWB):
+            os.remove(outputNWB)
+
+        peak = [0]
+        done = threading.Event()
+
+        def monitor():
+            while not done.is_set():
+                peak[0] = max(peak[0], directorySize(tmpdir))
+                done.wait(interval)
+
+        thread = threading.Thread(target=monitor)
+        thread.daemon = True
+        thread.start()
+
+        start = time.time()
+        try:
+            buildCombinedNWBInternal(basepath, [siteNWB], filesToInclude, mode=mode)
+        finally:
+            elapsed = time.time() - start
+            done.set()
+            thread.join()
+
+        peak[0] = max(peak[0], directorySize(tmpdir))
+        results[mode] = {'time': elapsed, 'peak_disk': peak[0], 'output_size': os.path.getsize(outputNWB)}
+        os.remove(outputNWB)
+
+    return results
+
 # Example invocations:
 #
 # python __main__.py --siteNWB 2017.05.22_000/slice_000/site_000/2017_05_22_122620-compressed.nwb --filesToInclude /e/projekte/mies-igor/m4-nwb/2017.05.22_000/slice_000/image_000.tif /e/projekte/mies-igor/m4-nwb/2017.05.22_000/slice_000/site_000/video_001.ma /e/projekte/mies-igor/m4-nwb/2017.05.22_000/slice_000/site_000/MultiPatch_000.log
@@ -466,6 +793,9 @@ def main():
     parser.add_argument('--basePath', help='Base path to look for MIES NWB files, alternative to --siteNWB')
     parser.add_argument('--siteNWB', help='Site NWB file')
     parser.add_argument('--filesToInclude', default = [], nargs = '*', help='Only include these metadata files')
+    parser.add_argument('--mode', default = 'legacy', choices = ['legacy', 'copy', 'link'], help='Packaging mode')
+    parser.add_argument('--processes', type = int, default = None, help='Package sites concurrently with this many worker processes (implies --mode copy unless link is given)')
+    parser.add_argument('--benchmark', action = 'store_true', default = False, help='Report packaging time and peak disk usage of each mode for --siteNWB')
 
     args = parser.parse_args()
 
@@ -495,7 +825,30 @@ def main():
 
     filesToInclude = [ os.path.abspath(elem) for elem in args.filesToInclude ]
 
-    outputNWBs = buildCombinedNWBInternal(basepath, siteNWBs, filesToInclude)
+    if args.benchmark:
+        if args.siteNWB is None:
+            print "--benchmark requires --siteNWB."
+            return 1
+
+        results = benchmarkPackaging(siteNWBs[0], filesToInclude)
+
+        print "%-8s %10s %14s %14s" % ("mode", "time (s)", "peak disk (MB)", "output (MB)")
+        for mode, res in results.items():
+            print "%-8s %10.2f %14.1f %14.1f" % (mode, res['time'], res['peak_disk'] / 1e6, res['output_size'] / 1e6)
+
+        return 0
+
+    if args.processes is not None:
+        mode = 'copy' if args.mode == 'legacy' else args.mode
+        start = time.time()
+        outputNWBs, timing = buildCombinedNWBParallel(basepath, siteNWBs, filesToInclude, args.processes, mode)
+
+        print "Site timing:"
+        for elem, elapsed in timing.items():
+            print "%8.2f s  %s" % (elapsed, elem)
+        print "%8.2f s  total" % (time.time() - start)
+    else:
+        outputNWBs = buildCombinedNWBInternal(basepath, siteNWBs, filesToInclude, args.mode)
 
     print "Creating combined NWB files:"
     for elem in outputNWBs:
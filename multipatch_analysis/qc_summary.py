@@ -0,0 +1,199 @@
+"""
+Per-NWB summaries of the recording QC metrics (baseline potential, baseline
+current and baseline RMS noise of every sweep).
+
+Computing these metrics means reading and analyzing the raw data of every
+recording in the file, which takes minutes for a multi-hour experiment. The
+results are saved in a small JSON file in config.cache_path/qc_summary so that
+tools like the experiment timeline only do this once per NWB file. A summary is
+discarded when the size or mtime of its NWB file changes.
+
+Summaries can be precomputed for a set of files with::
+
+    python -m multipatch_analysis.qc_summary file1.nwb file2.nwb ...
+"""
+from __future__ import print_function
+import os, sys, json, hashlib, datetime, threading
+from . import config
+
+
+SUMMARY_VERSION = 1
+
+_epoch = datetime.datetime(1970, 1, 1)
+
+_pending = {}   # nwb file name: list of callbacks waiting for a summary
+_pending_lock = threading.Lock()
+
+
+def summary_path():
+    """Return the directory where QC summaries are stored.
+    """
+    path = config.cache_path
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.expanduser('~'), path)
+    return os.path.join(path, 'qc_summary')
+
+
+def summary_file(nwb_file):
+    """Return the name of the QC summary file for *nwb_file*.
+    """
+    nwb_file = os.path.abspath(nwb_file)
+    key = hashlib.sha1(nwb_file.encode('utf8')).hexdigest()
+    return os.path.join(summary_path(), key + '.json')
+
+
+def load_qc_summary(nwb_file):
+    """Return the QC summary for *nwb_file*, or None if there is no summary or
+    the NWB file has changed since it was written.
+
+    The summary is a dict {channel: metrics}, where metrics is a dict of lists
+    with one value per recording on that channel, in acquisition order:
+    'start_time' (datetime), 'clamp_mode', 'baseline_potential',
+    'baseline_current' and 'baseline_rms_noise'.
+    """
+    filename = summary_file(nwb_file)
+    if not os.path.isfile(filename):
+        return None
+    try:
+        with open(filename, 'r') as fh:
+            data = json.load(fh)
+    except Exception:
+        print("Error reading QC summary %s; it will be regenerated:" % filename)
+        sys.excepthook(*sys.exc_info())
+        return None
+    stat = os.stat(nwb_file)
+    if data.get('version') != SUMMARY_VERSION or data['size'] != stat.st_size or data['mtime'] != stat.st_mtime:
+        return None
+    return _decode(data['channels'])
+
+
+def build_qc_summary(nwb_file):
+    """Compute the QC summary for *nwb_file* from its raw data, save it, and
+    return it (see load_qc_summary).
+    """
+    from neuroanalysis.miesnwb import MiesNwb
+
+    stat = os.stat(nwb_file)
+    nwb = MiesNwb(nwb_file)
+    channels = {}
+    for srec in nwb.contents:
+        for chan in srec.devices:
+            rec = srec[chan]
+            metrics = channels.setdefault(chan, {
+                'start_time': [],
+                'clamp_mode': [],
+                'baseline_potential': [],
+                'baseline_current': [],
+                'baseline_rms_noise': [],
+            })
+            metrics['start_time'].append(rec.start_time)
+            metrics['clamp_mode'].append(rec.clamp_mode)
+            for name in ('baseline_potential', 'baseline_current', 'baseline_rms_noise'):
+                val = getattr(rec, name)
+                metrics[name].append(float('nan') if val is None else float(val))
+
+    data = {
+        'version': SUMMARY_VERSION,
+        'nwb_file': os.path.abspath(nwb_file),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'channels': _encode(channels),
+    }
+    filename = summary_file(nwb_file)
+    try:
+        _write(filename, data)
+    except Exception:
+        print("Could not write QC summary %s:" % filename)
+        sys.excepthook(*sys.exc_info())
+    return channels
+
+
+def get_qc_summary(nwb_file, callback=None):
+    """Return the QC summary for *nwb_file* if one is available.
+
+    Otherwise, return None and build the summary in a background thread. When
+    it is done, ``callback(nwb_file, summary)`` is called from that thread
+    (*summary* is None if the build failed). Requests for a file that is
+    already being summarized wait for the same build.
+    """
+    summary = load_qc_summary(nwb_file)
+    if summary is not None:
+        return summary
+
+    with _pending_lock:
+        start = nwb_file not in _pending
+        callbacks = _pending.setdefault(nwb_file, [])
+        if callback is not None:
+            callbacks.append(callback)
+    if start:
+        thread = threading.Thread(target=_build_in_background, args=(nwb_file,))
+        thread.daemon = True
+        thread.start()
+    return None
+
+
+def _build_in_background(nwb_file):
+    try:
+        summary = build_qc_summary(nwb_file)
+    except Exception:
+        print("Error generating QC summary for %s:" % nwb_file)
+        sys.excepthook(*sys.exc_info())
+        summary = None
+    with _pending_lock:
+        callbacks = _pending.pop(nwb_file, [])
+    for callback in callbacks:
+        try:
+            callback(nwb_file, summary)
+        except Exception:
+            sys.excepthook(*sys.exc_info())
+
+
+def _encode(channels):
+    enc = {}
+    for chan, metrics in channels.items():
+        metrics = dict(metrics)
+        metrics['start_time'] = [(t - _epoch).total_seconds() for t in metrics['start_time']]
+        enc[str(chan)] = metrics
+    return enc
+
+
+def _decode(channels):
+    dec = {}
+    for chan, metrics in channels.items():
+        metrics = dict(metrics)
+        metrics['start_time'] = [_epoch + datetime.timedelta(seconds=t) for t in metrics['start_time']]
+        dec[int(chan)] = metrics
+    return dec
+
+
+def _write(filename, data):
+    path = os.path.dirname(filename)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # may have been created concurrently
+            if not os.path.isdir(path):
+                raise
+    tmp_filename = filename + '.partial'
+    try:
+        with open(tmp_filename, 'w') as fh:
+            json.dump(data, fh)
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp_filename, filename)
+    finally:
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+
+
+if __name__ == '__main__':
+    for nwb_file in sys.argv[1:]:
+        if load_qc_summary(nwb_file) is not None:
+            print("%s: up to date" % nwb_file)
+            continue
+        print("%s: summarizing.." % nwb_file)
+        try:
+            build_qc_summary(nwb_file)
+        except Exception:
+            sys.excepthook(*sys.exc_info())
@@ -0,0 +1,279 @@
+"""
+Persistent, per-key storage for analysis results.
+
+Each named cache is an SQLite file in config.cache_path/results. Entries are
+read and written one at a time, so looking up or adding a result does not
+load or rewrite the rest of the cache. Large values are pickled to separate
+files next to the index instead of being stored in the database.
+
+Every entry records the version of the analysis that produced it and,
+optionally, the mtime of the input file it was computed from; entries whose
+version or input mtime no longer match are treated as missing::
+
+    cache = get_result_cache('synapse_comparison', version=2)
+    result = cache.get(key, source_file=nwb_file)
+    if result is None:
+        result = analyze(...)
+        cache.set(key, result, source_file=nwb_file)
+
+Caches can be opened by several processes at once. If *max_size* is given,
+the least recently used entries are removed to keep the total size of stored
+values below that limit.
+"""
+from __future__ import print_function
+import os, sys, time, pickle, hashlib, sqlite3, threading
+from . import config
+
+
+_caches = {}
+def get_result_cache(name, version=0, max_size=None):
+    """Return the ResultCache called *name* (one instance per process).
+    """
+    cache = _caches.get(name)
+    if cache is None or cache.version != str(version):
+        cache = ResultCache(name, version=version, max_size=max_size)
+        _caches[name] = cache
+    return cache
+
+
+def pickle_result_cache(filename, version=0):
+    """Return the ResultCache that replaces a dict pickled in *filename*
+    (named after the file, eg. 'feature_cache_file' for 'feature_cache_file.pkl').
+
+    If the cache is empty and the pickle file exists, its contents are
+    imported first.
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    cache = get_result_cache(name, version=version)
+    if len(cache) == 0 and os.path.isfile(filename):
+        print("Importing %s into result cache %s.." % (filename, name))
+        try:
+            cache.import_dict(pickle.load(open(filename, 'rb')))
+        except Exception:
+            print("Error importing %s:" % filename)
+            sys.excepthook(*sys.exc_info())
+    return cache
+
+
+def cache_dir():
+    """Return the directory containing all result caches.
+    """
+    path = config.cache_path
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.expanduser('~'), path)
+    return os.path.join(path, 'results')
+
+
+class ResultCache(object):
+    """Persistent mapping from picklable keys to picklable results.
+
+    Keys are compared by their repr(), so they should be made of simple
+    types (strings, numbers, tuples). Besides get() and set(), the usual
+    dict operations (``cache[key]``, ``key in cache``, keys(), items()) work
+    on entries of the current version, ignoring input file mtimes.
+    """
+    def __init__(self, name, version=0, path=None, max_size=None, sidecar_size=1e6):
+        self.name = name
+        self.version = str(version)
+        self.path = cache_dir() if path is None else path
+        self.max_size = max_size
+        self.sidecar_size = sidecar_size
+        self.sidecar_path = os.path.join(self.path, name)
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            for path in (self.path, self.sidecar_path):
+                if not os.path.isdir(path):
+                    try:
+                        os.makedirs(path)
+                    except OSError:
+                        # may have been created concurrently
+                        if not os.path.isdir(path):
+                            raise
+            db = sqlite3.connect(os.path.join(self.path, self.name + '.sqlite'), timeout=60, isolation_level=None, check_same_thread=False)
+            # let readers proceed while another process writes
+            db.execute("pragma journal_mode=wal")
+            db.execute("""create table if not exists entry (
+                key text primary key,
+                key_pkl blob,
+                version text,
+                source_mtime real,
+                size integer,
+                last_access real,
+                value blob,
+                sidecar text
+            )""")
+            self._db = db
+        return self._db
+
+    def get(self, key, default=None, source_file=None):
+        """Return the result stored for *key*, or *default* if there is none
+        for the current version (or *source_file* has changed since it was stored).
+        """
+        k = repr(key)
+        with self._lock:
+            row = self.db.execute("select version, source_mtime, value, sidecar from entry where key=?", (k,)).fetchone()
+        if row is None:
+            return default
+        version, source_mtime, value, sidecar = row
+        if version != self.version:
+            return default
+        if source_file is not None and source_mtime is not None and source_mtime != _mtime(source_file):
+            return default
+        try:
+            if sidecar is not None:
+                with open(os.path.join(self.sidecar_path, sidecar), 'rb') as fh:
+                    value = fh.read()
+            result = pickle.loads(bytes(value))
+        except Exception:
+            print("Error reading %s cache entry %s; it will be recomputed:" % (self.name, k))
+            sys.excepthook(*sys.exc_info())
+            return default
+        with self._lock:
+            self.db.execute("update entry set last_access=? where key=?", (time.time(), k))
+        return result
+
+    def set(self, key, value, source_file=None):
+        """Store *value* as the result for *key*.
+
+        If *source_file* is given, its mtime is recorded so that the entry
+        is ignored after the file changes. Entries stored without a source
+        file mtime are not checked.
+        """
+        k = repr(key)
+        data = pickle.dumps(value, protocol=2)
+        size = len(data)
+        sidecar = None
+        # opening the database creates the sidecar directory
+        db = self.db
+        if size > self.sidecar_size:
+            sidecar = hashlib.sha1(k.encode('utf8')).hexdigest() + '.pkl'
+            _write_file(os.path.join(self.sidecar_path, sidecar), data)
+            data = None
+        mtime = None if source_file is None else _mtime(source_file)
+        with self._lock:
+            db.execute("insert or replace into entry (key, key_pkl, version, source_mtime, size, last_access, value, sidecar) values (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (k, sqlite3.Binary(pickle.dumps(key, protocol=2)), self.version, mtime, size, time.time(),
+                             None if data is None else sqlite3.Binary(data), sidecar))
+        if sidecar is None:
+            # the key may have been stored in a sidecar before
+            _remove_file(os.path.join(self.sidecar_path, hashlib.sha1(k.encode('utf8')).hexdigest() + '.pkl'))
+        self._evict(k)
+
+    def remove(self, key):
+        k = repr(key)
+        with self._lock:
+            row = self.db.execute("select sidecar from entry where key=?", (k,)).fetchone()
+            self.db.execute("delete from entry where key=?", (k,))
+        if row is not None and row[0] is not None:
+            _remove_file(os.path.join(self.sidecar_path, row[0]))
+
+    def clear(self):
+        """Remove all entries (of any version).
+        """
+        with self._lock:
+            sidecars = [r[0] for r in self.db.execute("select sidecar from entry where sidecar is not null")]
+            self.db.execute("delete from entry")
+        for sidecar in sidecars:
+            _remove_file(os.path.join(self.sidecar_path, sidecar))
+
+    def size(self):
+        """Return the total size in bytes of all stored values.
+        """
+        with self._lock:
+            return self.db.execute("select coalesce(sum(size), 0) from entry").fetchone()[0]
+
+    def keys(self):
+        with self._lock:
+            rows = self.db.execute("select key_pkl from entry where version=?", (self.version,)).fetchall()
+        return [pickle.loads(bytes(r[0])) for r in rows]
+
+    def items(self):
+        """Iterate over (key, result) for all entries of the current version.
+        Results are loaded one at a time.
+        """
+        for key in self.keys():
+            value = self.get(key, default=_missing)
+            if value is not _missing:
+                yield key, value
+
+    def import_dict(self, results):
+        """Store all items of a dict (for example a legacy pickle cache).
+        """
+        for key, value in results.items():
+            self.set(key, value)
+
+    def __contains__(self, key):
+        with self._lock:
+            row = self.db.execute("select version from entry where key=?", (repr(key),)).fetchone()
+        return row is not None and row[0] == self.version
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute("select count(*) from entry where version=?", (self.version,)).fetchone()[0]
+
+    def __getitem__(self, key):
+        value = self.get(key, default=_missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.remove(key)
+
+    def _evict(self, keep_key):
+        """Remove least recently used entries until the cache fits in max_size.
+        """
+        if self.max_size is None:
+            return
+        with self._lock:
+            total = self.db.execute("select coalesce(sum(size), 0) from entry").fetchone()[0]
+            if total <= self.max_size:
+                return
+            candidates = self.db.execute("select key, size, sidecar from entry where key!=? order by last_access", (keep_key,)).fetchall()
+            removed = []
+            for k, size, sidecar in candidates:
+                if total <= self.max_size:
+                    break
+                self.db.execute("delete from entry where key=?", (k,))
+                total -= size
+                if sidecar is not None:
+                    removed.append(sidecar)
+        for sidecar in removed:
+            _remove_file(os.path.join(self.sidecar_path, sidecar))
+
+
+_missing = object()
+
+
+def _mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
+def _write_file(filename, data):
+    tmp_filename = '%s.%d.%d.partial' % (filename, os.getpid(), threading.current_thread().ident)
+    try:
+        with open(tmp_filename, 'wb') as fh:
+            fh.write(data)
+        if sys.platform == 'win32' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp_filename, filename)
+    finally:
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def _remove_file(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
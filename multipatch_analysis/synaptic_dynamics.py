@@ -1,15 +1,14 @@
-import sys
+import sys, time
 from collections import OrderedDict
 import numpy as np
-import pyqtgraph as pg
 from .connection_detection import MultiPatchSyncRecAnalyzer, EvokedResponseGroup, fit_psp
 from neuroanalysis.stats import ragged_mean
 from neuroanalysis.baseline import float_mode
-from neuroanalysis.ui.plot_grid import PlotGrid
 from neuroanalysis.fitting import PspTrain
 from neuroanalysis.synaptic_release import ReleaseModel
 from neuroanalysis.event_detection import exp_deconvolve
 from neuroanalysis.filter import bessel_filter
+from neuroanalysis.data import Trace
 
 
 class RawDynamicsAnalyzer(object):
@@ -31,7 +30,17 @@ class RawDynamicsAnalyzer(object):
         self.cutoff = 500.
         
         self._reset()
-        
+
+    @classmethod
+    def from_db(cls, pair, session=None, method='deconv', align_to='pulse'):
+        """Create a RawDynamicsAnalyzer for a database pair without opening the NWB file.
+
+        *pair* may be a database Pair instance or its ID. Responses are reconstructed
+        from the pulse_response, stim_pulse and stim_spike tables; see
+        collect_stim_trains_from_db() for details.
+        """
+        return db_dynamics_analyzers([pair], session=session, method=method, align_to=align_to)[getattr(pair, 'id', pair)]
+
     def _reset(self):
         """Clear out cached analysis results
         """
@@ -175,6 +184,8 @@ class RawDynamicsAnalyzer(object):
 
         Return a new PlotGrid.
         """
+        import pyqtgraph as pg
+        from neuroanalysis.ui.plot_grid import PlotGrid
         train_responses = self.train_responses
 
         if plot_grid is None:
@@ -252,6 +263,7 @@ class RawDynamicsAnalyzer(object):
         # Generate average first response
         avg_amp = amp_group.bsub_mean()
         if plot:
+            import pyqtgraph as pg
             amp_plot = pg.plot(title='First pulse amplitude')
             amp_plot.plot(avg_amp.time_values, avg_amp.data)
 
@@ -279,6 +291,7 @@ class RawDynamicsAnalyzer(object):
         avg_kinetic.t0 = 0
         
         if plot:
+            import pyqtgraph as pg
             kin_plot = pg.plot(title='Kinetics')
             kin_plot.plot(avg_kinetic.time_values, avg_kinetic.data)
         else:
@@ -471,14 +484,7 @@ class RawDynamicsAnalyzer(object):
         #dyn_plots.show()
 
     def fit_release_model(self, dynamics):
-        model = ReleaseModel()
-        for gate in dynamics:
-            if gate not in model.Dynamics:
-                raise ValueError("Unknown gating mechanism for release model: %s" % gate)
-        for gate in model.Dynamics:
-            if gate in dynamics:
-                model.Dynamics[gate] = 1
-                
+        model = release_model(dynamics)
         fit = model.run_fit(self.spike_sets)
         
         self._last_model_fit = (model, fit)
@@ -491,6 +497,7 @@ class RawDynamicsAnalyzer(object):
             model, fit = self._last_model_fit
         spike_sets = self.spike_sets
         
+        from neuroanalysis.ui.plot_grid import PlotGrid
         rel_plots = PlotGrid()
         rel_plots.set_shape(2, 1)
         ind_plot = rel_plots[0, 0]
@@ -641,3 +648,350 @@ class DynamicsAnalyzer(RawDynamicsAnalyzer):
         self._pulse_offsets = pulse_offsets
 
 
+
+
+def release_model(dynamics):
+    """Return a new ReleaseModel with the named gating mechanisms enabled.
+    """
+    model = ReleaseModel()
+    for gate in dynamics:
+        if gate not in model.Dynamics:
+            raise ValueError("Unknown gating mechanism for release model: %s" % gate)
+    for gate in model.Dynamics:
+        if gate in dynamics:
+            model.Dynamics[gate] = 1
+    return model
+
+
+def stim_protocol_key(spike_sets, precision=0.1):
+    """Return a hashable key describing the pulse timing of a list of spike sets.
+
+    Synapses probed with the same stimulus protocols share the same key. Times are
+    in ms (as generated by RawDynamicsAnalyzer.prepare_spike_sets) and are rounded
+    to *precision*.
+    """
+    return tuple([tuple(np.round(np.asarray(x) / precision).astype(int)) for x, y in spike_sets])
+
+
+def fit_release_models(spike_set_collections, dynamics, workers=None, progress=None, chunk_size=10):
+    """Fit the synaptic release model to many synapses at once.
+
+    Parameters
+    ----------
+    spike_set_collections : list
+        Each item is a list of spike sets for one synapse, as returned by
+        RawDynamicsAnalyzer.spike_sets.
+    dynamics : list
+        Names of the release model gating mechanisms to enable (eg ['Dep', 'Fac', 'UR']).
+    workers : int | None
+        Number of worker processes. If None, then one worker per CPU is used.
+    progress : str | None
+        If given, a progress dialog is shown with this message (requires a QApplication).
+    chunk_size : int
+        Number of fits handed to a worker at a time.
+
+    Synapses whose spike sets are identical (same stimulus protocol and same
+    amplitudes) are fit only once. The remaining fits are split into chunks of
+    *chunk_size* that are distributed over the workers, regardless of protocol.
+
+    Returns
+    -------
+    A numpy record array with one row per input synapse and fields:
+
+    * index : position of the synapse in *spike_set_collections*
+    * protocol : integer ID of the stimulus protocol (see stim_protocol_key())
+    * one float field per fit parameter
+    * rmse, r2 : goodness of fit between the model and measured amplitudes
+    * fit_time : seconds spent fitting (0 for duplicates of an earlier fit)
+    """
+    import pyqtgraph.multiprocess as mp
+
+    protocols = OrderedDict()
+    synapse_protocol = []
+    synapse_fit = []
+    fit_inputs = OrderedDict()  # input key: index of the first synapse with this input
+    for i, spike_sets in enumerate(spike_set_collections):
+        protocol_key = stim_protocol_key(spike_sets)
+        synapse_protocol.append(protocols.setdefault(protocol_key, len(protocols)))
+        input_key = (protocol_key, tuple([tuple(np.asarray(y).round(12)) for x, y in spike_sets]))
+        synapse_fit.append(fit_inputs.setdefault(input_key, i))
+
+    to_fit = list(fit_inputs.values())
+    chunks = [to_fit[i:i+chunk_size] for i in range(0, len(to_fit), chunk_size)]
+
+    fits = {}
+    with mp.Parallelize(chunks, results=fits, workers=workers, progressDialog=progress) as tasker:
+        for chunk in tasker:
+            model = release_model(dynamics)
+            for i in chunk:
+                spike_sets = spike_set_collections[i]
+                start = time.time()
+                params = model.run_fit(spike_sets)
+                fit_time = time.time() - start
+
+                # compare model output to measured amplitudes
+                err = []
+                amps = []
+                for x, y in spike_sets:
+                    output = model.eval(x, params.values())
+                    err.append(np.interp(x, output[:,0], output[:,1]) - y)
+                    amps.append(y)
+                err = np.concatenate(err)
+                amps = np.concatenate(amps)
+                rmse = (err**2).mean()**0.5
+                ss_tot = ((amps - amps.mean())**2).sum()
+                r2 = np.nan if ss_tot == 0 else 1.0 - (err**2).sum() / ss_tot
+
+                tasker.results[i] = (dict(params), rmse, r2, fit_time)
+
+    results = {}
+    for i, j in enumerate(synapse_fit):
+        params, rmse, r2, fit_time = fits[j]
+        results[i] = (synapse_protocol[i], params, rmse, r2, fit_time if i == j else 0.0)
+
+    param_names = []
+    for i in sorted(results.keys()):
+        for k in results[i][1]:
+            if k not in param_names:
+                param_names.append(k)
+
+    dtype = [('index', int), ('protocol', int)] + [(str(k), float) for k in param_names]
+    dtype += [('rmse', float), ('r2', float), ('fit_time', float)]
+    table = np.empty(len(spike_set_collections), dtype=dtype)
+    for i in range(len(table)):
+        protocol, params, rmse, r2, fit_time = results[i]
+        row = [i, protocol] + [params.get(k, np.nan) for k in param_names] + [rmse, r2, fit_time]
+        table[i] = tuple(row)
+    return table
+
+
+def release_fit_timing(table):
+    """Summarize the per-fit timing in a table returned by fit_release_models().
+
+    Returns a list of (protocol, n_fits, total_time, mean_time) tuples, sorted by
+    total time so that the most expensive protocols are listed first.
+    """
+    summary = []
+    for protocol in np.unique(table['protocol']):
+        times = table['fit_time'][table['protocol'] == protocol]
+        n_fits = (times > 0).sum()
+        summary.append((protocol, n_fits, times.sum(), times.sum() / max(n_fits, 1)))
+    summary.sort(key=lambda x: x[2], reverse=True)
+    return summary
+
+
+def collect_stim_trains_from_db(pairs, session=None, pre_pad=10e-3, post_pad=50e-3, align_to='pulse'):
+    """Collect stimulus-response data for many pairs from the synphys database.
+
+    This is the database counterpart to DynamicsAnalyzer._collect_stim_trains; all
+    pairs are loaded with a single query, so the NWB files are never touched.
+
+    Parameters
+    ----------
+    pairs : list
+        Database Pair instances or pair IDs.
+    session : Session | None
+        Database session to use. If None, then a new session is created and closed.
+    pre_pad, post_pad : float
+        Padding (s) around pulses and trains. Responses were stored starting 10 ms
+        before each pulse, so *pre_pad* may not exceed 10 ms.
+    align_to : 'pulse' | 'spike'
+        Align pulse responses to the pulse onset or to the presynaptic spike.
+
+    Returns
+    -------
+    A dict ``{pair_id: (pulse_responses, train_responses, pulse_offsets)}`` using the
+    same structures as DynamicsAnalyzer. Some values are necessarily approximated:
+
+    * Train responses are stitched together from the stored pulse responses; gaps
+      between pulses longer than 50 ms (induction < 20 Hz) are linearly interpolated.
+    * The baseline is the 10 ms of data preceding the 9th pulse (inside the recovery
+      delay), rather than the 200 ms chunk used when reading from NWB.
+    * Stimulus commands are reconstructed as ideal square pulses.
+    * Holding potential is the recording baseline potential rounded to 5 mV.
+
+    Sweeps are skipped if any pulse has no recorded amplitude or if the recording
+    has no baseline potential.
+    """
+    from .database import database as db
+
+    if pre_pad > 10e-3:
+        raise ValueError("pre_pad may not exceed the 10 ms stored in the database")
+
+    pair_ids = [getattr(p, 'id', p) for p in pairs]
+    close = session is None
+    if close:
+        session = db.Session()
+    try:
+        pre_pcrec = db.aliased(db.PatchClampRecording)
+        post_pcrec = db.aliased(db.PatchClampRecording)
+        q = session.query(
+            db.PulseResponse.pair_id,
+            db.PulseResponse.start_time.label('rec_start'),
+            db.PulseResponse.data,
+            db.StimPulse.recording_id.label('pre_rec_id'),
+            db.StimPulse.pulse_number,
+            db.StimPulse.onset_time.label('pulse_start'),
+            db.StimPulse.duration.label('pulse_dur'),
+            db.StimPulse.amplitude.label('pulse_amp'),
+            db.StimPulse.n_spikes,
+            db.StimPulse.data.label('pre_data'),
+            db.StimPulse.data_start_time.label('pre_start'),
+            db.StimSpike.peak_time,
+            db.StimSpike.max_dvdt_time,
+            db.StimSpike.max_dvdt,
+            db.StimSpike.peak_diff,
+            db.MultiPatchProbe.induction_frequency,
+            db.MultiPatchProbe.recovery_delay,
+            post_pcrec.baseline_potential,
+        )
+        q = q.join(db.StimPulse, db.PulseResponse.pulse_id==db.StimPulse.id)
+        q = q.outerjoin(db.StimSpike, db.StimSpike.pulse_id==db.StimPulse.id)
+        q = q.join(pre_pcrec, pre_pcrec.recording_id==db.StimPulse.recording_id)
+        q = q.join(db.MultiPatchProbe, db.MultiPatchProbe.patch_clamp_recording_id==pre_pcrec.id)
+        q = q.join(post_pcrec, post_pcrec.recording_id==db.PulseResponse.recording_id)
+        q = q.filter(db.PulseResponse.pair_id.in_(pair_ids))
+        q = q.filter(post_pcrec.clamp_mode=='ic')
+        q = q.order_by(db.PulseResponse.pair_id, db.StimPulse.recording_id, db.StimPulse.onset_time)
+        recs = q.all()
+    finally:
+        if close:
+            session.close()
+
+    dt = 1.0 / db.default_sample_rate
+
+    # group rows by pair, then by presynaptic recording (one sweep each)
+    sweeps = OrderedDict([(pair_id, OrderedDict()) for pair_id in pair_ids])
+    for rec in recs:
+        sweeps[rec.pair_id].setdefault(rec.pre_rec_id, []).append(rec)
+
+    results = {}
+    for pair_id, pair_sweeps in sweeps.items():
+        pulse_responses = {}
+        train_responses = {}
+        pulse_offsets = {}
+        for pre_rec_id, rows in pair_sweeps.items():
+            # pulses with no recorded amplitude are dropped along with test pulses
+            rows = [r for r in rows if r.pulse_amp is not None and r.pulse_amp > 0]
+            if len(rows) != 12 or any([r.n_spikes in (None, 0) or r.max_dvdt_time is None for r in rows]):
+                # for dynamics, we require all 12 pulses to elicit a presynaptic spike
+                continue
+            if rows[0].baseline_potential is None:
+                # holding potential is unknown
+                continue
+
+            # baseline is taken from the quiescent period just before the 9th pulse
+            base_row = rows[8]
+            base_len = int(round((base_row.pulse_start - base_row.rec_start) / dt))
+            base = Trace(base_row.data[:base_len], dt=dt, t0=base_row.rec_start)
+
+            pulses = np.array([r.pulse_start for r in rows])
+            chunks = [(r.rec_start, r.data) for r in rows]
+            ind = _stitch_train(chunks[:8], pulses[0] - pre_pad, pulses[7] + post_pad, dt)
+            rec = _stitch_train(chunks[8:], pulses[8] - pre_pad, pulses[11] + post_pad, dt)
+            if _has_artifacts(ind.data) or _has_artifacts(rec.data):
+                continue
+
+            resp = []
+            for row in rows:
+                if align_to == 'spike':
+                    start = row.max_dvdt_time - pre_pad
+                elif align_to == 'pulse':
+                    start = row.pulse_start - pre_pad
+                else:
+                    raise ValueError("align_to must be 'pulse' or 'spike'")
+                i0 = max(0, int(round((start - row.rec_start) / dt)))
+                response = Trace(row.data[i0:], dt=dt, t0=row.rec_start + i0 * dt)
+
+                command = np.zeros(len(response))
+                on = int(round((row.pulse_start - response.t0) / dt))
+                off = int(round((row.pulse_start + row.pulse_dur - response.t0) / dt))
+                command[max(0, on):max(0, off)] = row.pulse_amp
+
+                spike = {
+                    'peak_time': row.peak_time,
+                    'max_dvdt_time': row.max_dvdt_time,
+                    'max_dvdt': row.max_dvdt,
+                    'peak_diff': row.peak_diff,
+                    'peak_index': None if row.peak_time is None else int(round(row.peak_time / dt)),
+                    'rise_index': int(round(row.max_dvdt_time / dt)),
+                }
+                resp.append({
+                    'pulse_n': row.pulse_number,
+                    'pulse_ind': int(round(row.pulse_start / dt)),
+                    'spike': spike,
+                    'response': response,
+                    'pre_rec': Trace(row.pre_data, dt=dt, t0=row.pre_start),
+                    'command': Trace(command, dt=dt, t0=response.t0),
+                    'baseline': base,
+                    'rec_start': int(round(response.t0 / dt)),
+                    'rec_stop': int(round(response.t0 / dt)) + len(response),
+                })
+
+            holding = 5e-3 * np.round(rows[0].baseline_potential / 5e-3)
+            stim_params = (rows[0].induction_frequency, rows[0].recovery_delay, holding)
+
+            ind.t0 = 0
+            rec.t0 = 0
+            if stim_params not in train_responses:
+                train_responses[stim_params] = (EvokedResponseGroup(), EvokedResponseGroup())
+            train_responses[stim_params][0].add(ind, base)
+            train_responses[stim_params][1].add(rec, base)
+            pulse_responses.setdefault(stim_params, []).append(resp)
+            if stim_params not in pulse_offsets:
+                pulse_offsets[stim_params] = list(pulses - pulses[0])
+
+        # re-write as ordered dicts
+        stim_param_order = sorted(pulse_offsets.keys())
+        pulse_responses = OrderedDict([(k, pulse_responses[k]) for k in stim_param_order])
+        train_responses = OrderedDict([(k, train_responses[k]) for k in stim_param_order])
+        pulse_offsets = OrderedDict([(k, pulse_offsets[k]) for k in stim_param_order])
+        results[pair_id] = (pulse_responses, train_responses, pulse_offsets)
+
+    return results
+
+
+def db_dynamics_analyzers(pairs, session=None, method='deconv', align_to='pulse'):
+    """Return an OrderedDict of {pair_id: RawDynamicsAnalyzer} for many database pairs.
+
+    All data are loaded with collect_stim_trains_from_db(). For very large sets of
+    pairs, call this in batches to limit memory usage.
+    """
+    trains = collect_stim_trains_from_db(pairs, session=session, align_to=align_to)
+    analyzers = OrderedDict()
+    for p in pairs:
+        pair_id = getattr(p, 'id', p)
+        pulse_responses, train_responses, pulse_offsets = trains[pair_id]
+        analyzers[pair_id] = RawDynamicsAnalyzer(pulse_responses, train_responses, pulse_offsets,
+                                                 method=method, align_to=align_to)
+    return analyzers
+
+
+def _stitch_train(chunks, start, stop, dt):
+    """Assemble a continuous Trace covering *start* to *stop* from a list of
+    (t0, data) chunks. Samples not covered by any chunk are linearly interpolated,
+    and the result is truncated where the last chunk ends.
+    """
+    stop = min(stop, chunks[-1][0] + len(chunks[-1][1]) * dt)
+    n = int(round((stop - start) / dt))
+    data = np.empty(n)
+    data[:] = np.nan
+    for t0, chunk in chunks:
+        i0 = int(round((t0 - start) / dt))
+        i1 = min(n, i0 + len(chunk))
+        j0 = max(0, -i0)
+        if i1 > max(i0, 0):
+            data[max(i0, 0):i1] = chunk[j0:j0 + i1 - max(i0, 0)]
+    missing = np.isnan(data)
+    if missing.any():
+        inds = np.arange(n)
+        data[missing] = np.interp(inds[missing], inds[~missing], data[~missing])
+    trace = Trace(data, dt=dt, t0=start)
+    trace.meta['interpolated'] = missing
+    return trace
+
+
+def _has_artifacts(data, pos_threshold=-10e-3, neg_threshold=-100e-3):
+    """Same criteria as MultiPatchSyncRecAnalyzer.find_artifacts
+    """
+    return bool(np.any(data >= pos_threshold) or np.any(data <= neg_threshold))
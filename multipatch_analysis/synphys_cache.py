@@ -1,6 +1,16 @@
-import os, sys, glob
+from __future__ import print_function
+import os, sys, glob, time, hashlib, sqlite3, threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 import config
-from .util import sync_file
+from .util import chunk_copy
 
 
 _cache = None
@@ -11,42 +21,423 @@ def get_cache():
     return _cache
 
 
+def file_digest(filename, chunk_size=10e6):
+    """Return the SHA-1 hex digest of a file's contents.
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        while True:
+            chunk = fh.read(int(chunk_size))
+            if len(chunk) == 0:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FileLock(object):
+    """Lock on a file, shared between threads and processes.
+
+    Use as a context manager::
+
+        with FileLock(filename + '.lock'):
+            ...
+
+    The lock is exclusive unless acquired with shared=True. Shared locks
+    are only enforced where fcntl is available; elsewhere a shared lock just
+    keeps the lock file open.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._fh = None
+        self._locked = False
+
+    def acquire(self, blocking=True, shared=False):
+        """Acquire the lock. If *blocking* is False, return False immediately
+        if the lock is held elsewhere.
+        """
+        fh = open(self.filename, 'a+')
+        if shared and fcntl is None:
+            self._fh = fh
+            self._locked = False
+            return True
+        try:
+            while True:
+                try:
+                    if fcntl is not None:
+                        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+                        fcntl.flock(fh.fileno(), mode | (0 if blocking else fcntl.LOCK_NB))
+                    else:
+                        fh.seek(0)
+                        msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except (IOError, OSError):
+                    if not blocking:
+                        fh.close()
+                        return False
+                    if fcntl is not None:
+                        raise
+                    time.sleep(0.1)
+        except Exception:
+            fh.close()
+            raise
+        self._fh = fh
+        self._locked = True
+        return True
+
+    def downgrade(self):
+        """Convert a held exclusive lock to a shared lock.
+        """
+        if fcntl is not None:
+            fcntl.flock(self._fh.fileno(), fcntl.LOCK_SH)
+        elif self._locked:
+            self._fh.seek(0)
+            msvcrt.locking(self._fh.fileno(), msvcrt.LK_UNLCK, 1)
+            self._locked = False
+
+    def release(self):
+        fh = self._fh
+        self._fh = None
+        if fcntl is not None:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+        elif self._locked:
+            fh.seek(0)
+            msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+        self._locked = False
+        fh.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class CachePin(object):
+    """A cached file that is kept in the cache until release() is called.
+
+    Returned by SynPhysCache.pin(); can be used as a context manager, which
+    gives the local file name.
+    """
+    def __init__(self, cache, filename, rel_filename, lock):
+        self.cache = cache
+        self.filename = filename
+        self._rel_filename = rel_filename
+        self._lock = lock
+
+    def release(self):
+        if self._lock is None:
+            return
+        lock = self._lock
+        self._lock = None
+        self.cache._unpin(self._rel_filename, lock)
+
+    def __enter__(self):
+        return self.filename
+
+    def __exit__(self, *args):
+        self.release()
+
+
 class SynPhysCache(object):
     """Maintains a local cache of files from the synphys raw data repository.
+
+    Cached files are recorded in an index (cache_index.sqlite inside the cache
+    directory) along with their size, the mtime of the remote file and a SHA-1
+    digest of the copied data. A file is copied again if the remote file changes
+    or the local copy does not match its recorded size (or, with verify=True,
+    its digest).
+
+    Each file is copied while holding a lock on "<file>.lock", so concurrent
+    threads and processes requesting the same file share a single download.
+    Files in use can be pinned with pin(); this holds a shared lock on the
+    same file until the pin is released. While a file is pinned in this
+    process, requests for it return the pinned copy even if the remote file
+    has changed.
+
+    If *max_size* (bytes) is given, files are evicted before each new download to
+    keep the total cache size below that limit. *eviction* selects which files
+    go first: 'lru' (least recently used) or 'lfu' (least frequently used).
+    Files that are being copied or are pinned are never evicted.
     """
-    def __init__(self, local_path=config.cache_path, remote_path=config.synphys_data):
+    def __init__(self, local_path=config.cache_path, remote_path=config.synphys_data, max_size=config.cache_max_size, eviction=config.cache_eviction):
         # If a relative path is given, then interpret it as relative to home
         if not os.path.isabs(local_path):
             local_path = os.path.join(os.path.expanduser('~'), local_path)
 
         self.local_path = os.path.abspath(local_path)
         self.remote_path = os.path.abspath(remote_path)
-        
+        self.max_size = max_size
+        if eviction not in ('lru', 'lfu'):
+            raise ValueError("eviction must be 'lru' or 'lfu' (got %r)" % eviction)
+        self.eviction = eviction
+
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._prefetch_queue = None
+        self._prefetch_thread = None
+        self._pins = {}  # rel_filename: number of pins held in this process
+        self._pin_lock = threading.Lock()
+
     def list_nwbs(self):
         return glob.glob(os.path.join(self.remote_path, '*', 'slice_*', 'site_*', '*.nwb'))
-    
+
     def list_pip_yamls(self):
         return glob.glob(os.path.join(self.remote_path, '*', 'slice_*', 'site_*', 'pipettes.yml'))
 
-    def get_cache(self, filename):
+    def get_cache(self, filename, verify=False):
+        """Return the name of a local copy of *filename*, copying it into the
+        cache first if needed.
+
+        If *verify* is True, the digest of an existing local copy is checked
+        against the one recorded when it was copied.
+
+        The returned file may be evicted at any time to make room for other
+        files; use pin() to keep it while it is in use.
+        """
+        local_filename, lock, rel_filename = self._get(filename, verify)
+        lock.release()
+        return local_filename
+
+    def pin(self, filename, verify=False):
+        """Like get_cache(), but return a CachePin for the local copy. The file
+        is not evicted until the pin is released::
+
+            with cache.pin(nwb_file) as local_file:
+                ...
+        """
+        local_filename, lock, rel_filename = self._get(filename, verify)
+        with self._pin_lock:
+            self._pins[rel_filename] = self._pins.get(rel_filename, 0) + 1
+        return CachePin(self, local_filename, rel_filename, lock)
+
+    def _unpin(self, rel_filename, lock):
+        with self._pin_lock:
+            self._pins[rel_filename] -= 1
+            if self._pins[rel_filename] == 0:
+                del self._pins[rel_filename]
+        lock.release()
+
+    def _get(self, filename, verify):
+        """Make sure the local copy of *filename* is current and return
+        (local_filename, lock, rel_filename), where *lock* is a shared lock
+        on the file that the caller must release.
+        """
         filename = os.path.abspath(filename)
         if not filename.startswith(self.remote_path):
             raise Exception("Requested file %s is not inside %s" % (filename, self.remote_path))
 
         rel_filename = filename[len(self.remote_path):].lstrip(os.sep)
         path, _ = os.path.split(rel_filename)
-        
+
         local_path = os.path.join(self.local_path, path)
         self.mkdir(local_path)
-        
+
         local_filename = os.path.join(self.local_path, rel_filename)
-        
-        sync_file(filename, local_filename)
-        return local_filename
-        
+
+        # A shared lock is enough if the local copy is already current; this
+        # only waits for a copy in progress.
+        lock = FileLock(local_filename + '.lock')
+        lock.acquire(shared=True)
+        try:
+            src_stat = os.stat(filename)
+            current = self._is_current(rel_filename, local_filename, src_stat, verify)
+        except Exception:
+            lock.release()
+            raise
+        if not current:
+            with self._pin_lock:
+                pinned = self._pins.get(rel_filename, 0) > 0
+            if pinned:
+                # Pins held in this process would block the exclusive lock below
+                # forever; keep using the pinned copy until they are released.
+                if not os.path.isfile(local_filename):
+                    lock.release()
+                    raise Exception("Cached file %s is pinned but missing" % local_filename)
+                print("Remote file %s has changed, but its cached copy is in use; using the old copy." % filename)
+                self._touch(rel_filename)
+                return local_filename, lock, rel_filename
+
+            # copying needs an exclusive lock (this waits for any pins to be released)
+            lock.release()
+            lock.acquire()
+            try:
+                src_stat = os.stat(filename)
+                if not self._is_current(rel_filename, local_filename, src_stat, verify):
+                    self._make_room(src_stat.st_size, rel_filename)
+                    self._copy(filename, local_filename, rel_filename, src_stat)
+                lock.downgrade()
+            except Exception:
+                lock.release()
+                raise
+        self._touch(rel_filename)
+        return local_filename, lock, rel_filename
+
+    def prefetch(self, filenames):
+        """Copy *filenames* into the cache in order, in a background thread.
+
+        This returns immediately. A get_cache() call for a file that is being
+        prefetched waits for that copy to finish instead of starting another.
+        """
+        if self._prefetch_thread is None or not self._prefetch_thread.is_alive():
+            self._prefetch_queue = queue.Queue()
+            self._prefetch_thread = threading.Thread(target=self._prefetch_loop, args=(self._prefetch_queue,))
+            self._prefetch_thread.daemon = True
+            self._prefetch_thread.start()
+        for filename in filenames:
+            self._prefetch_queue.put(filename)
+
+    def _prefetch_loop(self, q):
+        while True:
+            filename = q.get()
+            try:
+                self.get_cache(filename)
+            except Exception:
+                print("Error prefetching %s:" % filename)
+                sys.excepthook(*sys.exc_info())
+
+    def cache_size(self):
+        """Return the total size in bytes of all files in the cache index.
+        """
+        with self._db_lock:
+            return self.db.execute("select coalesce(sum(size), 0) from file").fetchone()[0]
+
+    def remove(self, rel_filename):
+        """Remove a file from the cache, unless it is in use (being copied or
+        pinned). Return True if the file was removed.
+        """
+        with self._pin_lock:
+            if self._pins.get(rel_filename, 0) > 0:
+                return False
+        local_filename = os.path.join(self.local_path, rel_filename)
+        lock = FileLock(local_filename + '.lock')
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            if os.path.isfile(local_filename):
+                try:
+                    os.remove(local_filename)
+                except OSError:
+                    # eg. the file is open in another process on Windows
+                    return False
+            with self._db_lock:
+                self.db.execute("delete from file where rel_path=?", (rel_filename,))
+                self.db.commit()
+        finally:
+            lock.release()
+        return True
+
+    @property
+    def db(self):
+        if self._db is None:
+            self.mkdir(self.local_path)
+            db = sqlite3.connect(os.path.join(self.local_path, 'cache_index.sqlite'), timeout=60, check_same_thread=False)
+            db.execute("""create table if not exists file (
+                rel_path text primary key,
+                size integer,
+                remote_mtime real,
+                sha1 text,
+                last_access real,
+                n_access integer
+            )""")
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _entry(self, rel_filename):
+        with self._db_lock:
+            return self.db.execute("select size, remote_mtime, sha1 from file where rel_path=?", (rel_filename,)).fetchone()
+
+    def _record(self, rel_filename, size, remote_mtime, sha1):
+        with self._db_lock:
+            self.db.execute("insert or replace into file (rel_path, size, remote_mtime, sha1, last_access, n_access) values (?, ?, ?, ?, ?, 0)",
+                            (rel_filename, size, remote_mtime, sha1, time.time()))
+            self.db.commit()
+
+    def _touch(self, rel_filename):
+        with self._db_lock:
+            self.db.execute("update file set last_access=?, n_access=n_access+1 where rel_path=?", (time.time(), rel_filename))
+            self.db.commit()
+
+    def _is_current(self, rel_filename, local_filename, src_stat, verify):
+        """Return True if the local copy of a file is complete and up to date.
+        """
+        if not os.path.isfile(local_filename):
+            return False
+        local_stat = os.stat(local_filename)
+        if local_stat.st_size != src_stat.st_size:
+            return False
+        entry = self._entry(rel_filename)
+        if entry is None:
+            # copied before files were indexed; adopt if it passes the old freshness check
+            if local_stat.st_mtime < src_stat.st_mtime:
+                return False
+            self._record(rel_filename, local_stat.st_size, src_stat.st_mtime, file_digest(local_filename))
+            return True
+        size, remote_mtime, sha1 = entry
+        if size != src_stat.st_size or remote_mtime != src_stat.st_mtime:
+            return False
+        if verify and file_digest(local_filename) != sha1:
+            print("Cached file %s does not match its recorded digest; copying again." % local_filename)
+            return False
+        return True
+
+    def _copy(self, filename, local_filename, rel_filename, src_stat):
+        """Copy a remote file into the cache and verify its size and digest.
+
+        Must be called while holding the file's lock.
+        """
+        tmp_filename = local_filename + '.partial'
+        if os.path.exists(tmp_filename):
+            # left behind by an interrupted copy (we hold the lock, so nobody else is writing it)
+            os.remove(tmp_filename)
+        try:
+            print("copy: %s => %s" % (filename, local_filename))
+            src_hash = hashlib.sha1()
+            chunk_copy(filename, tmp_filename, hasher=src_hash)
+            size = os.stat(tmp_filename).st_size
+            if size != src_stat.st_size:
+                raise IOError("Copied %d bytes from %s; expected %d" % (size, filename, src_stat.st_size))
+            sha1 = src_hash.hexdigest()
+            if file_digest(tmp_filename) != sha1:
+                raise IOError("Digest of copied file %s does not match source %s" % (tmp_filename, filename))
+            if os.path.exists(local_filename):
+                os.remove(local_filename)
+            os.rename(tmp_filename, local_filename)
+        finally:
+            if os.path.isfile(tmp_filename):
+                os.remove(tmp_filename)
+        self._record(rel_filename, size, src_stat.st_mtime, sha1)
+
+    def _make_room(self, size, rel_filename):
+        """Evict files until *size* more bytes fit within max_size.
+        """
+        if self.max_size is None:
+            return
+        with self._db_lock:
+            total = self.db.execute("select coalesce(sum(size), 0) from file where rel_path!=?", (rel_filename,)).fetchone()[0]
+            if total + size <= self.max_size:
+                return
+            order = {'lru': 'last_access', 'lfu': 'n_access, last_access'}[self.eviction]
+            candidates = self.db.execute("select rel_path, size from file where rel_path!=? order by %s" % order, (rel_filename,)).fetchall()
+
+        for rel_path, file_size in candidates:
+            if total + size <= self.max_size:
+                break
+            if self.remove(rel_path):
+                total -= file_size
+        if total + size > self.max_size:
+            print("Warning: cache size (%d MB) will exceed limit (%d MB); all remaining files are in use." %
+                  (int((total + size) / 1e6), int(self.max_size / 1e6)))
+
     def mkdir(self, path):
         if not os.path.isdir(path):
             root, _ = os.path.split(path)
             if root != '':
                 self.mkdir(root)
-            os.mkdir(path)
+            try:
+                os.mkdir(path)
+            except OSError:
+                # may have been created concurrently by another worker
+                if not os.path.isdir(path):
+                    raise
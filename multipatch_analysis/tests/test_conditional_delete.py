@@ -0,0 +1,65 @@
+import os
+import sys
+
+# util/ holds scripts rather than a package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'util'))
+import conditional_delete as cd
+
+
+def write(filename, data):
+    d = os.path.dirname(filename)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    with open(filename, 'wb') as fh:
+        fh.write(data)
+
+
+def test_digest_cache_invalidation(tmpdir):
+    cache = cd.DigestCache(str(tmpdir.join('digests.sqlite')))
+    filename = str(tmpdir.join('a.dat'))
+    write(filename, b'original')
+    digest = cd.cached_hash(filename, cache)
+    assert digest == cd.file_hash(filename)
+
+    # unchanged size and mtime: the cached digest is used
+    st = os.stat(filename)
+    write(filename, b'modified')
+    os.utime(filename, (st.st_atime, st.st_mtime))
+    assert cd.cached_hash(filename, cache) == digest
+
+    # a new mtime invalidates the entry
+    os.utime(filename, (st.st_atime, st.st_mtime + 10))
+    assert cd.cached_hash(filename, cache) == cd.file_hash(filename) != digest
+
+    # digests are cached separately per mode
+    assert cd.cached_hash(filename, cache, sampled=True) == cd.sampled_hash(filename)
+
+
+def test_compare_paths_rehashes_backup(tmpdir):
+    src = str(tmpdir.join('src'))
+    dst = str(tmpdir.join('dst'))
+    write(os.path.join(src, 'sub', 'a.dat'), b'data')
+    write(os.path.join(dst, 'sub', 'a.dat'), b'data')
+    cache = cd.DigestCache(str(tmpdir.join('digests.sqlite')))
+    assert cd.compare_paths(src, dst, digest_cache=cache)
+
+    # corrupt the backup without changing its size or mtime
+    dst_file = os.path.join(dst, 'sub', 'a.dat')
+    st = os.stat(dst_file)
+    write(dst_file, b'DATA')
+    os.utime(dst_file, (st.st_atime, st.st_mtime))
+    report = {}
+    assert not cd.compare_paths(src, dst, digest_cache=cache, report=report)
+    assert report['problems'] == [{'file': os.path.join('sub', 'a.dat'), 'reason': 'Hash mismatch'}]
+
+
+def test_compare_paths_missing(tmpdir):
+    src = str(tmpdir.join('src'))
+    dst = str(tmpdir.join('dst'))
+    write(os.path.join(src, 'a.dat'), b'data')
+    write(os.path.join(src, 'b.dat'), b'data')
+    write(os.path.join(dst, 'a.dat'), b'dat')
+    report = {}
+    assert not cd.compare_paths(src, dst, report=report)
+    reasons = sorted([(p['file'], p['reason']) for p in report['problems']])
+    assert reasons == [(os.path.join('.', 'a.dat'), 'Wrong size'), (os.path.join('.', 'b.dat'), 'Missing file')]
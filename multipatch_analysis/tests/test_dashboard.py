@@ -0,0 +1,76 @@
+import os
+import sys
+import shutil
+
+# tools/ holds scripts rather than a package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'tools'))
+from dashboard import SiteIndex
+
+
+def make_site(root, *parts):
+    path = os.path.join(root, *parts)
+    os.makedirs(path)
+    return path
+
+
+def touch(path, t):
+    # set mtimes explicitly; the file system's mtime resolution may be coarse
+    os.utime(path, (t, t))
+
+
+def test_scan(tmpdir):
+    root = str(tmpdir)
+    site1 = make_site(root, 'expt1', 'slice_000', 'site_000')
+    site2 = make_site(root, 'expt1', 'slice_000', 'site_001')
+    make_site(root, '$RECYCLE.BIN', 'slice_000', 'site_000')
+    open(os.path.join(root, 'expt1', 'notes.txt'), 'w').close()
+
+    index = SiteIndex(root)
+    changed = index.scan()
+    assert sorted(rec['path'] for rec in changed) == [site1, site2]
+    assert not any(rec['has_metadata_qc'] for rec in changed)
+
+    # nothing changed; nothing is listed again
+    assert index.scan() == []
+
+    open(os.path.join(site1, 'file_manifest.yml'), 'w').close()
+    touch(site1, index.mtimes[site1] + 10)
+    changed = index.scan()
+    assert [rec['path'] for rec in changed] == [site1]
+    assert changed[0]['has_metadata_qc']
+    assert not changed[0]['has_site_mosaic']
+
+    # new site
+    site3 = make_site(root, 'expt1', 'slice_001', 'site_000')
+    touch(os.path.join(root, 'expt1'), index.mtimes[os.path.join(root, 'expt1')] + 10)
+    assert [rec['path'] for rec in index.scan()] == [site3]
+
+    # removed slice
+    slice_path = os.path.join(root, 'expt1', 'slice_000')
+    shutil.rmtree(slice_path)
+    touch(os.path.join(root, 'expt1'), index.mtimes[os.path.join(root, 'expt1')] + 10)
+    changed = index.scan()
+    assert sorted(rec['path'] for rec in changed) == [site1, site2]
+    assert all(rec['removed'] for rec in changed)
+    assert sorted(index.sites.keys()) == [site3]
+    assert not any(p.startswith(slice_path) for p in index.mtimes)
+
+
+def test_scan_dirty(tmpdir):
+    root = str(tmpdir)
+    site = make_site(root, 'expt1', 'slice_000', 'site_000')
+    index = SiteIndex(root)
+    index.scan()
+
+    # a change inside a site folder re-reads the site, even if its mtime is unchanged
+    mtime = os.stat(site).st_mtime
+    os.makedirs(os.path.join(site, 'sub'))
+    open(os.path.join(site, 'site.mosaic'), 'w').close()
+    touch(site, mtime)
+    assert index.scan() == []
+    index.mark_dirty(os.path.join(site, 'sub'))
+    index.mark_dirty(os.path.dirname(root))
+    changed = index.scan(index.take_dirty())
+    assert [rec['path'] for rec in changed] == [site]
+    assert changed[0]['has_site_mosaic']
+    assert index.take_dirty() == set()
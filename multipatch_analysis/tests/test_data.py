@@ -0,0 +1,60 @@
+import numpy as np
+from multipatch_analysis.data import remove_artifact_windows, crosstalk_edges
+
+
+def remove_artifact_windows_loop(data, edges, window):
+    """Per-edge loop used before remove_artifact_windows was vectorized.
+    """
+    data = np.array(data, dtype=float)
+    if data.ndim == 2:
+        data = data[None, ...]
+    for chan, chan_edges in enumerate(edges):
+        chdata = data[:, chan]
+        for edge in chan_edges:
+            chdata[:, edge:edge+window] = chdata[:, max(0, edge-window):edge].mean(axis=1)[:, None]
+    return data
+
+
+def test_matches_loop_without_overlap():
+    rng = np.random.RandomState(0)
+    data = rng.normal(size=(3, 4, 1000))
+    orig = data.copy()
+    window = 20
+    edges = [
+        np.array([100, 300, 990]),   # last window is cut off at the end of the trace
+        np.array([50, 500]),
+        np.array([], dtype=int),
+        np.array([25, 200, 400, 600]),
+    ]
+    expected = remove_artifact_windows_loop(data, edges, window)
+    assert np.allclose(remove_artifact_windows(data, edges, window), expected)
+
+    # 2D input (single sweep)
+    assert np.allclose(remove_artifact_windows(data[0], edges, window), expected[0])
+
+    # the input is not modified
+    assert np.all(data == orig)
+
+
+def test_overlapping_windows():
+    data = np.arange(100, dtype=float)[None, :]
+    out = remove_artifact_windows(data, [np.array([40, 45])], 10)
+    # means are taken from the original data; the later edge wins where windows overlap
+    assert np.all(out[0, 40:45] == data[0, 30:40].mean())
+    assert np.all(out[0, 45:55] == data[0, 35:45].mean())
+    assert np.all(out[0, 55:] == data[0, 55:])
+
+
+def test_edges_out_of_range():
+    data = np.ones((2, 50))
+    out = remove_artifact_windows(data, [np.array([-5, 60]), np.array([])], 10)
+    assert np.all(out == data)
+
+
+def test_crosstalk_edges():
+    on = [np.array([10, 110]), np.array([20]), np.array([30])]
+    off = [np.array([15, 115]), np.array([25]), np.array([35])]
+    edges = crosstalk_edges([1, 2, 8], on, off, max_distance=3)
+    assert list(edges[0]) == [20, 25]
+    assert list(edges[1]) == [10, 15, 110, 115]
+    assert list(edges[2]) == []
@@ -0,0 +1,66 @@
+import sqlite3
+import datetime
+from multipatch_analysis.experiment_index import ExperimentIndex
+
+
+class FakeExperiment(object):
+    """Minimal stand-in providing the attributes read by index_summary().
+    """
+    def __init__(self, uid):
+        self.uid = uid
+        self.source_id = (None, None)
+        self.site_info = {'__timestamp__': 1500000000.0}
+        self.date = datetime.date(2017, 7, 14)
+        self.region = 'V1'
+        self.expt_info = {'solution': '2mM Ca & Mg', 'temperature': '34C'}
+        self.cre_types = ['sst']
+        self.target_layers = ['2/3']
+        self.n_connections_probed = 0
+        self.connections = []
+        self.connections_probed = []
+        self.cells = {}
+
+    @property
+    def path(self):
+        raise TypeError("no data path")
+
+
+def test_update_and_prune(tmpdir):
+    index = ExperimentIndex(str(tmpdir.join('index.sqlite')))
+    index.update([FakeExperiment(uid) for uid in ('a', 'b', 'c')])
+    assert index.uids() == ['a', 'b', 'c']
+    assert index.load_experiment('b').uid == 'b'
+
+    index.prune(['a', 'c', 'x'])
+    assert index.uids() == ['a', 'c']
+    index.close()
+
+
+def test_schema_change_requires_rebuild(tmpdir):
+    filename = str(tmpdir.join('index.sqlite'))
+    index = ExperimentIndex(filename)
+    index.update([FakeExperiment('a')])
+    assert not index.rebuild_required
+    index.close()
+
+    conn = sqlite3.connect(filename)
+    conn.execute("update meta set value=? where key='schema_version'", (str(ExperimentIndex.schema_version - 1),))
+    conn.commit()
+    conn.close()
+
+    # incompatible index is cleared and flagged until it is rebuilt
+    index = ExperimentIndex(filename)
+    assert len(index) == 0
+    assert index.rebuild_required
+    index.close()
+
+    index = ExperimentIndex(filename)
+    assert index.rebuild_required
+    index.update([FakeExperiment('a')])
+    index.mark_rebuilt()
+    index.close()
+
+    index = ExperimentIndex(filename)
+    assert not index.rebuild_required
+    assert index.uids() == ['a']
+    index.close()
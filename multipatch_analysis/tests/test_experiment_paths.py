@@ -0,0 +1,81 @@
+import os, time, pickle
+import pytest
+from multipatch_analysis.experiment_paths import ServerLock, ExperimentPathIndex
+
+
+def test_lock_exclusive(tmpdir):
+    filename = str(tmpdir.join('x.lock'))
+    a = ServerLock(filename, stale_age=10)
+    a.acquire()
+    assert open(filename).read() == a.token
+
+    b = ServerLock(filename, timeout=1, stale_age=10)
+    with pytest.raises(Exception):
+        b.acquire()
+
+    a.release()
+    assert not os.path.exists(filename)
+    with b:
+        assert open(filename).read() == b.token
+    assert not os.path.exists(filename)
+
+
+def test_lock_heartbeat(tmpdir):
+    filename = str(tmpdir.join('x.lock'))
+    a = ServerLock(filename, stale_age=1.0)
+    a.acquire()
+    try:
+        os.utime(filename, (0, 0))
+        time.sleep(0.5)
+        # refreshed by the heartbeat, so not broken as stale
+        assert os.stat(filename).st_mtime > 0
+        b = ServerLock(filename, timeout=1.5, stale_age=1.0)
+        with pytest.raises(Exception):
+            b.acquire()
+    finally:
+        a.release()
+
+
+def test_lock_stale(tmpdir):
+    filename = str(tmpdir.join('x.lock'))
+    with open(filename, 'w') as fh:
+        fh.write('crashed process')
+    os.utime(filename, (0, 0))
+    a = ServerLock(filename, timeout=5, stale_age=10)
+    a.acquire()
+    assert open(filename).read() == a.token
+
+    # a lock that was taken over is not removed on release
+    with open(filename, 'w') as fh:
+        fh.write('other process')
+    a.release()
+    assert open(filename).read() == 'other process'
+
+
+def test_legacy_pickle(tmpdir):
+    root = str(tmpdir)
+    with open(os.path.join(root, 'experiment_path_cache.pkl'), 'wb') as fh:
+        pickle.dump({1.5: '2019-01-01_000'}, fh)
+    index = ExperimentPathIndex(root=root)
+    # lookups before the index exists read the pickle without creating the index
+    assert index.lookup(1.5) == '2019-01-01_000'
+    assert index.paths() == {1.5: '2019-01-01_000'}
+    assert not os.path.exists(index.filename)
+
+
+def test_reserve(tmpdir):
+    root = str(tmpdir)
+    with open(os.path.join(root, 'experiment_path_cache.pkl'), 'wb') as fh:
+        pickle.dump({1.5: '2019-01-01_000'}, fh)
+    tmpdir.mkdir('2019-01-01_001')
+    index = ExperimentPathIndex(root=root)
+
+    assert index.reserve(1.5, '2019-01-01') == ('2019-01-01_000', False)
+    name, created = index.reserve(2.5, '2019-01-01')
+    assert created and name == '2019-01-01_002'
+    assert index.reserve(2.5, '2019-01-01') == (name, False)
+    assert index.paths() == {1.5: '2019-01-01_000', 2.5: name}
+
+    index.remove(2.5)
+    assert index.lookup(2.5) is None
+    assert not os.path.exists(index.lock_file)
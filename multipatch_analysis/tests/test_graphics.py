@@ -0,0 +1,55 @@
+import numpy as np
+from multipatch_analysis.ui.graphics import MinMaxPyramid
+
+
+def check_view(pyr, start, stop, max_points):
+    y = pyr.y
+    x, yv = pyr.get(start, stop, max_points)
+    assert len(x) == len(yv)
+    start = max(0, start)
+    stop = min(len(y), stop)
+    if stop <= start:
+        assert len(x) == 0
+        return
+    # no more than about 2 * max_points points (plus partial blocks at both ends),
+    # unless even the coarsest level has more blocks than that
+    level = min(pyr.levels - 1, max(0, int(np.ceil(np.log2(float(stop - start) / max_points)))))
+    bs = 2 ** level
+    assert len(x) <= 2 * max(max_points, len(pyr.mins[-1])) + 4
+    assert x.min() >= 0 and x.max() < len(y)
+    # the drawn envelope covers the requested samples
+    assert yv.min() <= y[start:stop].min()
+    assert yv.max() >= y[start:stop].max()
+    # and does not extend past one block outside of them
+    assert yv.min() >= y[max(0, start - bs):stop + bs].min()
+    assert yv.max() <= y[max(0, start - bs):stop + bs].max()
+
+
+def test_levels():
+    y = np.arange(1001)
+    pyr = MinMaxPyramid(y, min_length=100)
+    assert len(pyr.mins[0]) == 1001
+    for k in range(1, pyr.levels):
+        assert len(pyr.mins[k]) == -(-len(pyr.mins[k-1]) // 2)
+    assert len(pyr.mins[-1]) <= 100
+    assert pyr.mins[1][0] == 0 and pyr.maxs[1][0] == 1
+    # the odd last sample forms its own block
+    assert pyr.mins[1][-1] == 1000 and pyr.maxs[1][-1] == 1000
+
+
+def test_get_full_resolution():
+    y = np.random.RandomState(0).normal(size=500)
+    pyr = MinMaxPyramid(y)
+    x, yv = pyr.get(100, 200, 1000)
+    assert np.all(x == np.arange(100, 200))
+    assert np.all(yv == y[100:200])
+
+
+def test_get_bounds():
+    rng = np.random.RandomState(1)
+    y = rng.normal(size=100003)
+    pyr = MinMaxPyramid(y)
+    for start, stop, max_points in [(0, len(y), 500), (-100, 200000, 300), (12345, 54321, 1000),
+                                    (99990, 100003, 10), (500, 500, 100), (70000, 20000, 100),
+                                    (3, 100000, 7)]:
+        check_view(pyr, start, stop, max_points)
@@ -0,0 +1,103 @@
+import time
+import pytest
+from multipatch_analysis import lims
+
+
+specimens = [
+    {'specimen_name': 'Ntsr1-Cre_GN220;Ai14-349905.03.06', 'specimen_id': 1, 'parent_id': None,
+     'organism': 'Mus musculus', 'age': 50, 'date_of_birth': None, 'genotype': 'Ntsr1-Cre_GN220/wt;Ai14/wt',
+     'weight': 20, 'sex': 'M', 'thickness': 350, 'section_instructions': None,
+     'plane_of_section': 'sagittal', 'flipped': 'not flipped', 'histology_well_name': None,
+     'carousel_well_name': None},
+    {'specimen_name': "O'Brien-000001.01.01", 'specimen_id': 2, 'parent_id': None},
+    {'specimen_name': 'cluster', 'specimen_id': 3, 'parent_id': 1},
+]
+
+
+@pytest.fixture
+def backend(tmpdir):
+    backend = lims.MemoryLims(specimens)
+    lims.set_backend(backend)
+    lims.set_cache_file(str(tmpdir.join('lims_cache.sqlite')))
+    yield backend
+    lims.set_backend(lims.lims_utilities)
+    lims.set_cache_file(lims.config.lims_cache_file)
+    lims.set_offline(lims.config.lims_offline)
+
+
+def test_memory_lims(backend):
+    assert lims.specimen_id_from_name(specimens[0]['specimen_name']) == 1
+    assert lims.cell_cluster_ids(1) == [3]
+    with pytest.raises(ValueError):
+        lims.specimen_id_from_name('missing')
+    with pytest.raises(ValueError):
+        lims.query("select * from donors")
+
+
+def test_specimen_info(backend):
+    info = lims.specimen_info(specimens[0]['specimen_name'])
+    assert info['organism'] == 'mouse'
+    assert info['hemisphere'] == 'right'
+    assert info['flipped'] is False
+    assert info['specimen_id'] == 1
+    assert lims.specimen_info(specimen_id=1)['specimen_name'] == specimens[0]['specimen_name']
+
+
+def test_specimen_records_cached(backend):
+    names = [rec['specimen_name'] for rec in specimens] + ['missing']
+    found = lims.specimen_records(specimen_names=names)
+    assert sorted(found.keys()) == sorted(names[:3])
+    assert len(backend.queries) == 1
+
+    # cached records are not queried again; missing ones are
+    found = lims.specimen_records(specimen_names=names)
+    assert len(found) == 3
+    assert len(backend.queries) == 2
+    assert "O''Brien" not in backend.queries[1]
+
+    # records older than max_age are fetched again
+    time.sleep(0.01)
+    lims.specimen_records(specimen_names=names[:1], max_age=0)
+    assert len(backend.queries) == 3
+
+    # offline, cached records of any age are used and nothing is queried
+    lims.set_offline(True)
+    assert len(lims.specimen_records(specimen_names=names, max_age=0)) == 3
+    assert len(backend.queries) == 3
+    with pytest.raises(Exception):
+        lims.specimen_info('missing')
+
+
+def test_specimen_cache(tmpdir):
+    cache = lims.SpecimenCache(str(tmpdir.join('sub', 'cache.sqlite')))
+    cache.put(specimens[:2])
+    assert cache.get('specimen_id', [1, 2, 5]) == {1: specimens[0], 2: specimens[1]}
+    assert list(cache.get('name', [specimens[1]['specimen_name']]).keys()) == [specimens[1]['specimen_name']]
+    time.sleep(0.01)
+    assert cache.get('specimen_id', [1], max_age=0) == {}
+    cache.clear()
+    assert cache.get('specimen_id', [1]) == {}
+    cache.close()
+
+
+def test_submission_status(tmpdir):
+    status = lims.SubmissionStatus(str(tmpdir.join('lims_submissions.sqlite')))
+    status.set('site_a', 'submitted', spec_name='spec', spec_id=1, acq_timestamp=1.5)
+    status.set('site_b', 'error', 'failed checks')
+    # fields given as None keep their previous values
+    status.set('site_a', 'succeeded', 'done')
+    rec = status.get('site_a')
+    assert rec['state'] == 'succeeded' and rec['message'] == 'done'
+    assert rec['spec_name'] == 'spec' and rec['spec_id'] == 1 and rec['acq_timestamp'] == 1.5
+
+    assert [r['site_path'] for r in status.by_state('error')] == ['site_b']
+    assert [r['site_path'] for r in status.by_state()] == ['site_a', 'site_b']
+    assert set(status.get_many(['site_a', 'site_b', 'site_c']).keys()) == {'site_a', 'site_b'}
+    status.remove('site_b')
+    assert status.get('site_b') is None
+
+
+def test_submission_state():
+    assert lims.submission_state([]) == (None, '')
+    subs = [('trigger pending', 'a'), ('succeeded', 'b'), ('succeeded', 'c')]
+    assert lims.submission_state(subs) == ('succeeded', 'b\nc')
@@ -0,0 +1,87 @@
+import os
+import datetime
+import threading
+import pytest
+from multipatch_analysis import qc_summary, config
+
+
+@pytest.fixture
+def nwb_file(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, 'cache_path', str(tmpdir.join('cache')))
+    filename = str(tmpdir.join('expt.nwb'))
+    with open(filename, 'wb') as fh:
+        fh.write(b'x' * 100)
+    return filename
+
+
+def summary():
+    return {1: {
+        'start_time': [datetime.datetime(2018, 1, 2, 3, 4, 5, 678000)],
+        'clamp_mode': ['ic'],
+        'baseline_potential': [-0.07],
+        'baseline_current': [1e-11],
+        'baseline_rms_noise': [2e-4],
+    }}
+
+
+def save(nwb_file, **kwds):
+    stat = os.stat(nwb_file)
+    data = {'version': qc_summary.SUMMARY_VERSION, 'nwb_file': nwb_file,
+            'size': stat.st_size, 'mtime': stat.st_mtime, 'channels': qc_summary._encode(summary())}
+    data.update(kwds)
+    qc_summary._write(qc_summary.summary_file(nwb_file), data)
+
+
+def test_load(nwb_file):
+    assert qc_summary.load_qc_summary(nwb_file) is None
+    save(nwb_file)
+    assert qc_summary.summary_file(nwb_file).startswith(config.cache_path)
+    loaded = qc_summary.load_qc_summary(nwb_file)
+    assert list(loaded.keys()) == [1]
+    assert loaded[1]['start_time'] == summary()[1]['start_time']
+    assert loaded[1]['baseline_potential'] == [-0.07]
+
+
+def test_invalidation(nwb_file):
+    save(nwb_file, version=qc_summary.SUMMARY_VERSION - 1)
+    assert qc_summary.load_qc_summary(nwb_file) is None
+
+    save(nwb_file)
+    st = os.stat(nwb_file)
+    os.utime(nwb_file, (st.st_atime, st.st_mtime + 10))
+    assert qc_summary.load_qc_summary(nwb_file) is None
+
+    save(nwb_file)
+    with open(nwb_file, 'ab') as fh:
+        fh.write(b'x')
+    os.utime(nwb_file, (st.st_atime, st.st_mtime + 10))
+    assert qc_summary.load_qc_summary(nwb_file) is None
+
+    with open(qc_summary.summary_file(nwb_file), 'w') as fh:
+        fh.write('{"version": ')
+    assert qc_summary.load_qc_summary(nwb_file) is None
+
+
+def test_background_build(nwb_file, monkeypatch):
+    release = threading.Event()
+    builds = []
+    def build(filename):
+        builds.append(filename)
+        release.wait(5)
+        return summary()
+    monkeypatch.setattr(qc_summary, 'build_qc_summary', build)
+
+    results = []
+    done = threading.Event()
+    def callback(filename, result):
+        results.append((filename, result))
+        if len(results) == 2:
+            done.set()
+
+    # concurrent requests wait for the same build
+    assert qc_summary.get_qc_summary(nwb_file, callback) is None
+    assert qc_summary.get_qc_summary(nwb_file, callback) is None
+    release.set()
+    assert done.wait(5)
+    assert builds == [nwb_file]
+    assert results == [(nwb_file, summary())] * 2
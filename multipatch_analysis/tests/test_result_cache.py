@@ -0,0 +1,70 @@
+import os
+from multipatch_analysis.result_cache import ResultCache
+
+
+def test_get_set(tmpdir):
+    cache = ResultCache('test', path=str(tmpdir))
+    assert cache.get(('a', 1)) is None
+    cache.set(('a', 1), {'x': [1, 2, 3]})
+    assert cache.get(('a', 1)) == {'x': [1, 2, 3]}
+    assert ('a', 1) in cache
+    assert len(cache) == 1
+    assert cache.keys() == [('a', 1)]
+
+    del cache[('a', 1)]
+    assert ('a', 1) not in cache
+
+
+def test_version_invalidation(tmpdir):
+    cache = ResultCache('test', version=1, path=str(tmpdir))
+    cache.set('key', 'v1 result')
+    assert cache.get('key') == 'v1 result'
+
+    cache2 = ResultCache('test', version=2, path=str(tmpdir))
+    assert cache2.get('key') is None
+    assert 'key' not in cache2
+    assert len(cache2) == 0
+
+    # the entry is still valid for its own version
+    assert ResultCache('test', version=1, path=str(tmpdir)).get('key') == 'v1 result'
+
+
+def test_source_mtime_invalidation(tmpdir):
+    source = str(tmpdir.join('source.nwb'))
+    open(source, 'w').write('data')
+    cache = ResultCache('test', path=str(tmpdir.join('cache')))
+    cache.set('key', 'result', source_file=source)
+    assert cache.get('key', source_file=source) == 'result'
+
+    st = os.stat(source)
+    os.utime(source, (st.st_atime, st.st_mtime + 10))
+    assert cache.get('key', source_file=source) is None
+    # without a source file the entry is not checked
+    assert cache.get('key') == 'result'
+
+
+def test_sidecar(tmpdir):
+    cache = ResultCache('test', path=str(tmpdir), sidecar_size=100)
+    value = 'x' * 1000
+    cache.set('big', value)
+    assert len(os.listdir(cache.sidecar_path)) == 1
+    assert cache.get('big') == value
+
+    cache.set('big', 'small')
+    assert cache.get('big') == 'small'
+    assert len(os.listdir(cache.sidecar_path)) == 0
+
+
+def test_lru_eviction(tmpdir):
+    value = 'x' * 1000
+    cache = ResultCache('test', path=str(tmpdir), max_size=3500)
+    for key in ('a', 'b', 'c'):
+        cache.set(key, value)
+    # touch 'a' so that 'b' is the least recently used entry
+    assert cache.get('a') == value
+    cache.set('d', value)
+
+    assert 'b' not in cache
+    for key in ('a', 'c', 'd'):
+        assert key in cache
+    assert cache.size() <= 3500
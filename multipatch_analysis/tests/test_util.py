@@ -0,0 +1,77 @@
+import os
+import numpy as np
+from multipatch_analysis.util import delta_copy, sync_file, _weak_checksums
+
+
+def write(filename, data):
+    with open(filename, 'wb') as fh:
+        fh.write(data)
+
+
+def read(filename):
+    with open(filename, 'rb') as fh:
+        return fh.read()
+
+
+def random_bytes(n, seed=0):
+    return np.random.RandomState(seed).randint(0, 256, size=n).astype(np.uint8).tobytes()
+
+
+def test_weak_checksums():
+    data = random_bytes(1000)
+    n = 64
+    sums = _weak_checksums(data, n)
+    assert len(sums) == len(data) - n + 1
+    for k in (0, 1, 500, len(data) - n):
+        block = bytearray(data[k:k+n])
+        a = sum(block)
+        b = sum([(n - i) * x for i, x in enumerate(block)])
+        assert sums[k] == (a & 0xffff) | ((b & 0xffff) << 16)
+
+
+def test_delta_copy_edits(tmpdir):
+    src = str(tmpdir.join('src'))
+    dst = str(tmpdir.join('dst'))
+    base = random_bytes(200000)
+    edits = [
+        base,                                               # unchanged
+        base + random_bytes(5000, 1),                       # appended
+        base[:150000],                                      # truncated
+        random_bytes(10, 2) + base,                         # inserted at start
+        base[:50000] + base[50100:],                        # deleted in the middle
+        base[:1000] + random_bytes(100, 3) + base[1100:],   # overwritten
+        b'',                                                # emptied
+    ]
+    for new in edits:
+        write(dst, base)
+        write(src, new)
+        literal = delta_copy(src, dst, block_size=4096)
+        assert read(dst) == new
+        assert os.stat(dst).st_mtime == os.stat(src).st_mtime
+        assert not os.path.exists(dst + '.partial')
+        if new == base:
+            assert literal == 0
+
+
+def test_delta_copy_reuses_shifted_data(tmpdir):
+    src = str(tmpdir.join('src'))
+    dst = str(tmpdir.join('dst'))
+    base = random_bytes(100 * 4096)
+    write(dst, base)
+    write(src, b'xyz' + base)
+    literal = delta_copy(src, dst, block_size=4096)
+    assert read(dst) == b'xyz' + base
+    # only the inserted bytes need to come from src
+    assert literal == 3
+
+
+def test_sync_file_delta(tmpdir):
+    src = str(tmpdir.join('src'))
+    dst = str(tmpdir.join('dst'))
+    write(src, random_bytes(10000))
+    assert sync_file(src, dst, delta=True, progress=False) == 'copy'
+    assert sync_file(src, dst, delta=True, progress=False) == 'skip'
+    write(src, random_bytes(12000, 1))
+    assert sync_file(src, dst, delta=True, progress=False) == 'update'
+    assert read(dst) == read(src)
+    assert sync_file(src, dst, delta=True, progress=False) == 'skip'
@@ -76,6 +76,115 @@ class MatrixItem(pg.QtGui.QGraphicsItemGroup):
         return self._bounding_rect
     
     
+class MinMaxPyramid(object):
+    """Min/max decimation levels for a regularly sampled trace.
+
+    Level k (k >= 1) holds the minimum and maximum of each block of 2**k
+    samples, so any view of the trace can be drawn from the level whose
+    block size matches the number of samples per pixel. Building all levels
+    costs about as much memory as the trace itself.
+    """
+    def __init__(self, y, min_length=256):
+        y = np.asarray(y)
+        self.y = y
+        self.mins = [y]
+        self.maxs = [y]
+        mn = mx = y
+        while len(mn) > min_length:
+            if len(mn) % 2 == 1:
+                # repeat the last sample so that it forms a complete block
+                mn = np.append(mn, mn[-1])
+                mx = np.append(mx, mx[-1])
+            mn = np.minimum(mn[0::2], mn[1::2])
+            mx = np.maximum(mx[0::2], mx[1::2])
+            self.mins.append(mn)
+            self.maxs.append(mx)
+
+    @property
+    def levels(self):
+        return len(self.mins)
+
+    def get(self, start, stop, max_points):
+        """Return (x_index, y) to draw samples *start*:*stop* with at most about
+        2 * *max_points* points. x_index is in units of samples.
+        """
+        start = max(0, int(start))
+        stop = min(len(self.y), int(stop))
+        n = stop - start
+        level = 0
+        while level < self.levels - 1 and n > max_points * 2 ** level:
+            level += 1
+        if level == 0:
+            return np.arange(start, stop), self.y[start:stop]
+
+        bs = 2 ** level
+        b0 = start // bs
+        b1 = min(len(self.mins[level]), -(-stop // bs))
+        mn = self.mins[level][b0:b1]
+        mx = self.maxs[level][b0:b1]
+        # the last block may be partial; keep its center inside the trace
+        x = np.minimum(np.arange(b0, b1) * bs + bs // 2, len(self.y) - 1)
+        x = np.repeat(x, 2)
+        y = np.empty(len(mn) * 2, dtype=mn.dtype)
+        y[0::2] = mn
+        y[1::2] = mx
+        return x, y
+
+
+class DecimatedCurveItem(pg.PlotCurveItem):
+    """Curve for a regularly sampled trace that draws only the visible part
+    of the trace, at a resolution matched to the width of its view.
+
+    Parameters
+    ----------
+    y : array | MinMaxPyramid
+        Sample values (or a pyramid already built from them)
+    dt : float
+        Sample interval
+    t0 : float
+        Time of the first sample
+    """
+    def __init__(self, y, dt, t0=0, **kwds):
+        pg.PlotCurveItem.__init__(self, **kwds)
+        self.pyramid = y if isinstance(y, MinMaxPyramid) else MinMaxPyramid(y)
+        self.dt = dt
+        self.t0 = t0
+        self._drawn = None
+        self._update_lod()
+
+    def dataBounds(self, ax, frac=1.0, orthoRange=None):
+        # bounds of the whole trace, not just the part being drawn
+        y = self.pyramid.y
+        if len(y) == 0:
+            return (None, None)
+        if ax == 0:
+            return (self.t0, self.t0 + (len(y) - 1) * self.dt)
+        return (self.pyramid.mins[-1].min(), self.pyramid.maxs[-1].max())
+
+    def viewRangeChanged(self):
+        pg.PlotCurveItem.viewRangeChanged(self)
+        self._update_lod()
+
+    def _update_lod(self):
+        n = len(self.pyramid.y)
+        vb = self.getViewBox()
+        if vb is None:
+            start, stop, width = 0, n, 1000
+        else:
+            (x0, x1), _ = vb.viewRange()
+            width = max(1, int(vb.width()))
+            start = int(np.floor((x0 - self.t0) / self.dt)) - 1
+            stop = int(np.ceil((x1 - self.t0) / self.dt)) + 2
+        start = min(max(0, start), n)
+        stop = min(max(start, stop), n)
+        key = (start, stop, width)
+        if key == self._drawn:
+            return
+        self._drawn = key
+        x, y = self.pyramid.get(start, stop, width)
+        self.setData(self.t0 + x * self.dt, y)
+
+
 def distance_plot(connected, distance, plots=None, color=(100, 100, 255), window=40e-6, spacing=None, name=None, fill_alpha=30):
     """Draw connectivity vs distance profiles with confidence intervals.
     
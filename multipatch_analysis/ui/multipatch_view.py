@@ -1,15 +1,38 @@
+from collections import OrderedDict
 import numpy as np
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter1d
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtGui, QtCore
 from neuroanalysis.ui.plot_grid import PlotGrid
 from neuroanalysis.miesnwb import MiesNwb
 from neuroanalysis.filter import remove_artifacts
+from .graphics import DecimatedCurveItem
+from ..data import crosstalk_edges, remove_artifact_windows
 
 
 class MultipatchMatrixView(QtGui.QWidget):
+    """Displays responses for every pair of selected channels in a matrix of plots.
+
+    Rendering is split into cached stages so that a parameter change only
+    repeats the work that depends on it:
+
+    * the packed (sweeps, channels, samples) block for the selected sweeps
+    * each channel's artifact-removed and lowpass-filtered data
+    * the curves drawn in each matrix cell; cells whose inputs did not change
+      are left untouched
+
+    Traces are drawn with DecimatedCurveItem, which draws only the visible
+    samples at a min/max decimation level matched to the plot width.
+    """
+    filter_cache_size = 64
+
     def __init__(self, parent=None):
         QtGui.QWidget.__init__(self, parent)
+
+        self._block = None
+        self._filter_cache = OrderedDict()
+        self._cell_keys = {}
+        self._shape = None
         self.layout = QtGui.QGridLayout()
         self.setLayout(self.layout)
         self.layout.setContentsMargins(0, 0, 0, 0)
@@ -44,6 +67,55 @@ class MultipatchMatrixView(QtGui.QWidget):
         self.channels = channels
         self._update_plots(auto_range=True)
 
+    def _load_block(self, sweeps):
+        """Return (data, stim, dt, devices) for *sweeps*, packed into
+        (sweeps, channels, samples) arrays. The last selection is cached.
+        """
+        key = tuple(sweeps)
+        if self._block is None or self._block[0] != key:
+            data = MiesNwb.pack_sweep_data(sweeps)
+            data, stim = data[...,0], data[...,1]  # unpack stim and recordings
+            dt = sweeps[0].recordings[0]['primary'].dt
+            self._block = (key, (data, stim, dt, list(sweeps[0].devices)))
+            self._filter_cache.clear()
+            self._cell_keys = {}
+        return self._block[1]
+
+    def _filtered_channel(self, raw, dt, chans, index, edges):
+        """Return (key, data) where data is the (sweeps, samples) array *raw*
+        recorded from chans[index] with artifacts from adjacent channels removed
+        and the lowpass filter applied, and key identifies the parameters used.
+
+        Results are cached by channel and the parameters that affect them.
+        """
+        remove_art = self.params['remove artifacts']
+        art_window = self.params['remove artifacts', 'window'] if remove_art else None
+        lowpass = self.params['lowpass']
+        sigma = self.params['lowpass', 'sigma'] if lowpass else None
+
+        # other selected headstages close enough to cause artifacts in this one
+        j = index
+        sources = [i for i in range(len(chans)) if i != j and abs(chans[j] - chans[i]) <= 3]
+        key = (chans[j], tuple(chans[i] for i in sources) if remove_art else (), art_window, sigma)
+        if key in self._filter_cache:
+            self._filter_cache[key] = self._filter_cache.pop(key)
+            return key, self._filter_cache[key]
+
+        chdata = raw
+        if remove_art:
+            # remove capacitive artifacts from adjacent electrodes
+            npts = int(art_window / dt)
+            chdata = remove_artifact_windows(chdata[:, None, :], [edges], npts)[:, 0]
+
+        # lowpass filter
+        if lowpass:
+            chdata = gaussian_filter1d(chdata, sigma / dt, axis=-1)
+
+        self._filter_cache[key] = chdata
+        while len(self._filter_cache) > self.filter_cache_size:
+            self._filter_cache.popitem(last=False)
+        return key, chdata
+
     def _params_changed(self, *args):
         self._update_plots()
 
@@ -58,20 +130,20 @@ class MultipatchMatrixView(QtGui.QWidget):
     def _update_plots(self, auto_range=False):
         sweeps = self.sweeps
         chans = self.channels
-        self.plots.clear()
         if len(sweeps) == 0 or len(chans) == 0:
+            self.plots.clear()
+            self._cell_keys = {}
+            self._shape = None
             return
         
         # collect data
-        data = MiesNwb.pack_sweep_data(sweeps)
-        data, stim = data[...,0], data[...,1]  # unpack stim and recordings
-        dt = sweeps[0].recordings[0]['primary'].dt
+        data, stim, dt, devices = self._load_block(sweeps)
 
         # mask for selected channels
-        mask = np.array([ch in chans for ch in sweeps[0].devices])
-        data = data[:, mask]
+        mask = np.array([ch in chans for ch in devices])
         stim = stim[:, mask]
-        chans = np.array(sweeps[0].devices)[mask]
+        chans = np.array(devices)[mask]
+        chan_index = np.argwhere(mask)[:,0]
 
         modes = [sweeps[0][ch].clamp_mode for ch in chans]
         
@@ -82,73 +154,70 @@ class MultipatchMatrixView(QtGui.QWidget):
         on_times = [np.argwhere(diff[i] > 0)[1:,0] for i in range(diff.shape[0])]
         off_times = [np.argwhere(diff[i] < 0)[1:,0] for i in range(diff.shape[0])]
 
-        # remove capacitive artifacts from adjacent electrodes
-        if self.params['remove artifacts']:
-            npts = int(self.params['remove artifacts', 'window'] / dt)
-            for i in range(stim.shape[0]):
-                for j in range(stim.shape[0]):
-                    if i == j:
-                        continue
-                    
-                    # are these headstages adjacent?
-                    hs1, hs2 = chans[i], chans[j]
-                    if abs(hs2-hs1) > 3:
-                        continue
-                    
-                    # remove artifacts
-                    for k in range(len(on_times[i])):
-                        on = on_times[i][k]
-                        off = off_times[i][k]
-                        data[:, j, on:on+npts] = data[:, j, max(0,on-npts):on].mean(axis=1)[:,None]
-                        data[:, j, off:off+npts] = data[:, j, max(0,off-npts):off].mean(axis=1)[:,None]
-
-        # lowpass filter
-        if self.params['lowpass']:
-            data = gaussian_filter(data, (0, 0, self.params['lowpass', 'sigma'] / dt))
+        # artifact removal and lowpass filter, per channel
+        edges = crosstalk_edges(chans, on_times, off_times)
+        filtered = [self._filtered_channel(data[:, chan_index[i]], dt, list(chans), i, edges[i]) for i in range(len(chans))]
+        filter_keys = [f[0] for f in filtered]
+        filtered = [f[1] for f in filtered]
 
         # prepare to plot
         window = int(self.params['window'] / dt)
         n_sweeps = data.shape[0]
-        n_channels = data.shape[1]
-        self.plots.set_shape(n_channels, n_channels)
-        self.plots.setClipToView(True)
-        self.plots.setDownsampling(True, True, 'peak')
-        self.plots.enableAutoRange(False, False)
-
-        show_sweeps = 'sweeps' in self.params['show']
-        show_sweep_avg = 'sweep avg' in self.params['show']
-        show_pulse_avg = self.params['show'] == 'pulse avg'
+        n_channels = len(chans)
+        if self._shape != (n_channels, n_channels):
+            self.plots.clear()
+            self._cell_keys = {}
+            self._shape = (n_channels, n_channels)
+            self.plots.set_shape(n_channels, n_channels)
+            self.plots.enableAutoRange(False, False)
+
+        show = self.params['show']
+        show_sweeps = 'sweeps' in show
+        show_sweep_avg = 'sweep avg' in show
+        show_pulse_avg = show == 'pulse avg'
+        first_pulse = self.params['first pulse']
+        last_pulse = self.params['last pulse']
+        remove_baseline = self.params['remove baseline']
+        show_ticks = self.params['show ticks']
 
         for i in range(n_channels):
             for j in range(n_channels):
                 plt = self.plots[i, j]
-                start = on_times[j][self.params['first pulse']] - window
+                start = on_times[j][first_pulse] - window
                 if start < 0:
                     frontpad = -start
                     start = 0
                 else:
                     frontpad = 0
-                stop = on_times[j][self.params['last pulse']] + window
+                stop = on_times[j][last_pulse] + window
+
+                # skip cells whose content would not change
+                cell_key = (filter_keys[i], chans[j], modes[i], start, stop, frontpad, window,
+                            first_pulse, last_pulse, show, remove_baseline, show_ticks)
+                if self._cell_keys.get((i, j)) == cell_key:
+                    continue
+                self._cell_keys[(i, j)] = cell_key
+                plt.clear()
 
                 # select the data segment to be displayed in this matrix cell
                 # add padding if necessary
+                chdata = filtered[i]
                 if frontpad == 0:
-                    seg = data[:, i, start:stop].copy()
+                    seg = chdata[:, start:stop].copy()
                 else:
-                    seg = np.empty((data.shape[0], stop + frontpad), data.dtype)
-                    seg[:, frontpad:] = data[:, i, start:stop]
+                    seg = np.empty((chdata.shape[0], stop + frontpad), chdata.dtype)
+                    seg[:, frontpad:] = chdata[:, start:stop]
                     seg[:, :frontpad] = seg[:, frontpad:frontpad+1]
 
                 # subtract off baseline for each sweep
-                if self.params['remove baseline']:
+                if remove_baseline:
                     seg -= seg[:, :window].mean(axis=1)[:,None]
 
                 if show_sweeps:
                     alpha = 100 if show_sweep_avg else 200
                     color = (255, 255, 255, alpha)
-                    t = np.arange(seg.shape[1]) * dt
                     for k in range(n_sweeps):
-                        plt.plot(t, seg[k], pen={'color': color, 'width': 1}, antialias=True)
+                        plt.addItem(DecimatedCurveItem(seg[k], dt, pen={'color': color, 'width': 1}, antialias=True))
 
                 if show_sweep_avg or show_pulse_avg:
                     # average selected segments over all sweeps
@@ -157,17 +226,12 @@ class MultipatchMatrixView(QtGui.QWidget):
                     if show_pulse_avg:
                         # average over all selected pulses
                         pulses = []
-                        for k in range(self.params['first pulse'], self.params['last pulse'] + 1):
-                            pstart = on_times[j][k] - on_times[j][self.params['first pulse']]
+                        for k in range(first_pulse, last_pulse + 1):
+                            pstart = on_times[j][k] - on_times[j][first_pulse]
                             pstop = pstart + (window * 2)
                             pulses.append(segm[pstart:pstop])
-                        # for p in pulses:
-                        #     t = np.arange(p.shape[0]) * dt
-                        #     plt.plot(t, p)
                         segm = np.vstack(pulses).mean(axis=0)
 
-                    t = np.arange(segm.shape[0]) * dt
-
                     if i == j:
                         color = (80, 80, 80)
                     else:
@@ -181,9 +245,9 @@ class MultipatchMatrixView(QtGui.QWidget):
                         b = np.clip(g + max(qe, 0), 0, 255)
                         color = (r, g, b)
 
-                    plt.plot(t, segm, pen={'color': color, 'width': 1}, antialias=True)
+                    plt.addItem(DecimatedCurveItem(segm, dt, pen={'color': color, 'width': 1}, antialias=True))
 
-                if self.params['show ticks']:
+                if show_ticks:
                     vt = pg.VTickGroup((on_times[j]-start) * dt, [0, 0.15], pen=0.4)
                     plt.addItem(vt)
 
@@ -208,11 +272,15 @@ class MultipatchMatrixView(QtGui.QWidget):
                     plt.setLabels(left=('CH%d'%chans[i], 'A' if modes[i] == 'vc' else 'V'))
 
         if auto_range:
+            i = n_channels - 1
             r = 14e-12 if modes[i] == 'vc' else 5e-3
             self.plots[0, 1].setYRange(-r, r)
             r = 2e-9 if modes[i] == 'vc' else 100e-3
             self.plots[0, 0].setYRange(-r, r)
 
-            self.plots[0, 0].setXRange(t[0], t[-1])
-
-        
\ No newline at end of file
+            # time range of the last cell
+            if show_pulse_avg:
+                n_samples = window * 2
+            else:
+                n_samples = on_times[-1][last_pulse] - on_times[-1][first_pulse] + window * 2
+            self.plots[0, 0].setXRange(0, (n_samples - 1) * dt)
@@ -1,3 +1,4 @@
+import sys, threading
 import numpy as np
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtGui, QtCore
@@ -15,11 +16,23 @@ from neuroanalysis.stats import ragged_mean
 
 class PairView(QtGui.QWidget):
     """For analyzing pre/post-synaptic pairs.
+
+    Sweeps are processed in a background PairAnalysisJob; plots are filled in
+    as each sweep and pulse is finished. Processed sweeps are cached per
+    (sweep, channels, filter parameters), so returning to a previous
+    selection or changing only the fit does not repeat the filtering.
     """
+    sweep_cache_size = 200
+
     def __init__(self, parent=None):
         self.sweeps = []
         self.channels = []
 
+        self._job = None
+        self._old_jobs = []
+        self._sweep_cache = OrderedDict()
+        self._sweep_cache_lock = threading.Lock()
+
         self.current_event_set = None
         self.event_sets = []
 
@@ -106,9 +119,13 @@ class PairView(QtGui.QWidget):
         self.current_event_set = None
         self.event_table.clear()
         
+        # abandon any processing for the previous selection
+        self._cancel_job()
+
         # clear all plots
         self.pre_plot.clear()
         self.post_plot.clear()
+        self.response_plots.clear()
 
         pre = self.params['pre']
         post = self.params['post']
@@ -122,143 +139,94 @@ class PairView(QtGui.QWidget):
         for ch, mode, plot in [(pre, pre_mode, self.pre_plot), (post, post_mode, self.post_plot)]:
             units = 'A' if mode == 'vc' else 'V'
             plot.setLabels(left=("Channel %d" % ch, units), bottom=("Time", 's'))
-        
-        # Iterate over selected channels of all sweeps, plotting traces one at a time
-        # Collect information about pulses and spikes
-        pulses = []
-        spikes = []
-        post_traces = []
-        for i,sweep in enumerate(sweeps):
-            pre_trace = sweep[pre]['primary']
-            post_trace = sweep[post]['primary']
-            
-            # Detect pulse times
-            stim = sweep[pre]['command'].data
-            sdiff = np.diff(stim)
-            on_times = np.argwhere(sdiff > 0)[1:, 0]  # 1: skips test pulse
-            off_times = np.argwhere(sdiff < 0)[1:, 0]
-            pulses.append(on_times)
-
-            # filter data
-            post_filt = self.artifact_remover.process(post_trace, list(on_times) + list(off_times))
-            post_filt = self.baseline_remover.process(post_filt)
-            post_filt = self.filter.process(post_filt)
-            post_traces.append(post_filt)
-            
-            # plot raw data
-            color = pg.intColor(i, hues=len(sweeps)*1.3, sat=128)
-            color.setAlpha(128)
-            for trace, plot in [(pre_trace, self.pre_plot), (post_filt, self.post_plot)]:
-                plot.plot(trace.time_values, trace.data, pen=color, antialias=False)
-
-            # detect spike times
-            spike_inds = []
-            spike_info = []
-            for on, off in zip(on_times, off_times):
-                spike = detect_evoked_spike(sweep[pre], [on, off])
-                spike_info.append(spike)
-                if spike is None:
-                    spike_inds.append(None)
-                else:
-                    spike_inds.append(spike['rise_index'])
-            spikes.append(spike_info)
-                    
-            dt = pre_trace.dt
-            vticks = pg.VTickGroup([x * dt for x in spike_inds if x is not None], yrange=[0.0, 0.2], pen=color)
-            self.pre_plot.addItem(vticks)
 
-        # Iterate over spikes, plotting average response
-        all_responses = []
-        avg_responses = []
-        fits = []
-        fit = None
-        
-        npulses = max(map(len, pulses))
+        job = PairAnalysisJob(self, sweeps, pre, post, post_mode, self._filter_key())
+        job.sig_sweep_processed.connect(self._sweep_processed)
+        job.sig_sweeps_done.connect(self._sweeps_done)
+        job.sig_pulse_fitted.connect(self._pulse_fitted)
+        job.sig_job_done.connect(self._job_done)
+        job.finished.connect(self._job_finished)
+        self._job = job
+        job.start()
+
+    def _filter_key(self):
+        """Return a hashable snapshot of the current processing parameters.
+        """
+        return tuple(_param_key(p) for p in (self.artifact_remover.params, self.baseline_remover.params, self.filter.params))
+
+    def _cancel_job(self):
+        if self._job is None:
+            return
+        self._job.cancel()
+        # keep a reference until the thread exits
+        self._old_jobs.append(self._job)
+        self._job = None
+
+    def _job_finished(self):
+        self._old_jobs = [job for job in self._old_jobs if job.isRunning()]
+
+    def _cached_sweep(self, key):
+        with self._sweep_cache_lock:
+            result = self._sweep_cache.pop(key, None)
+            if result is not None:
+                self._sweep_cache[key] = result
+            return result
+
+    def _cache_sweep(self, key, result):
+        with self._sweep_cache_lock:
+            self._sweep_cache[key] = result
+            while len(self._sweep_cache) > self.sweep_cache_size:
+                self._sweep_cache.popitem(last=False)
+
+    def _sweep_processed(self, job, i, result):
+        """Plot one processed sweep (called in the GUI thread).
+        """
+        if job is not self._job:
+            return
+        color = pg.intColor(i, hues=len(job.sweeps)*1.3, sat=128)
+        color.setAlpha(128)
+        for trace, plot in [(result['pre_trace'], self.pre_plot), (result['post_filt'], self.post_plot)]:
+            plot.plot(trace.time_values, trace.data, pen=color, antialias=False)
+
+        dt = result['pre_trace'].dt
+        spike_inds = [None if spike is None else spike['rise_index'] for spike in result['spikes']]
+        vticks = pg.VTickGroup([x * dt for x in spike_inds if x is not None], yrange=[0.0, 0.2], pen=color)
+        self.pre_plot.addItem(vticks)
+
+    def _sweeps_done(self, job, npulses):
+        """Prepare the response plots once all sweeps are processed.
+        """
+        if job is not self._job:
+            return
         self.response_plots.clear()
         self.response_plots.set_shape(1, npulses+1) # 1 extra for global average
         self.response_plots.setYLink(self.response_plots[0,0])
         for i in range(1, npulses+1):
             self.response_plots[0,i].hideAxis('left')
-        units = 'A' if post_mode == 'vc' else 'V'
-        self.response_plots[0, 0].setLabels(left=("Averaged events (Channel %d)" % post, units))
-        
-        fit_pen = {'color':(30, 30, 255), 'width':2, 'dash': [1, 1]}
-        for i in range(npulses):
-            # get the chunk of each sweep between spikes
-            responses = []
-            all_responses.append(responses)
-            for j, sweep in enumerate(sweeps):
-                # get the current spike
-                if i >= len(spikes[j]):
-                    continue
-                spike = spikes[j][i]
-                if spike is None:
-                    continue
-                
-                # find next spike
-                next_spike = None
-                for sp in spikes[j][i+1:]:
-                    if sp is not None:
-                        next_spike = sp
-                        break
-                    
-                # determine time range for response
-                max_len = int(40e-3 / dt)  # don't take more than 50ms for any response
-                start = spike['rise_index']
-                if next_spike is not None:
-                    stop = min(start + max_len, next_spike['rise_index'])
-                else:
-                    stop = start + max_len
-                    
-                # collect data from this trace
-                trace = post_traces[j]
-                d = trace.data[start:stop].copy()
-                responses.append(d)
-
-            if len(responses) == 0:
-                continue
-                
-            # extend all responses to the same length and take nanmean
-            avg = ragged_mean(responses, method='clip')
-            avg -= float_mode(avg[:int(1e-3/dt)])
-            avg_responses.append(avg)
-            
-            # plot average response for this pulse
-            start = np.median([sp[i]['rise_index'] for sp in spikes if sp[i] is not None]) * dt
-            t = np.arange(len(avg)) * dt
-            self.response_plots[0,i].plot(t, avg, pen='w', antialias=True)
+        units = 'A' if job.post_mode == 'vc' else 'V'
+        self.response_plots[0, 0].setLabels(left=("Averaged events (Channel %d)" % job.post, units))
 
-            # fit!
-            fit = self.fit_psp(avg, t, dt, post_mode)
-            fits.append(fit)
-            
+    def _pulse_fitted(self, job, result):
+        """Plot the average response and fit for one pulse (or the global average).
+        """
+        if job is not self._job:
+            return
+        fit_pen = {'color':(30, 30, 255), 'width':2, 'dash': [1, 1]}
+        i = result['index']
+        t = result['t']
+        fit = result['fit']
+        self.response_plots[0,i].plot(t, result['avg'], pen='w', antialias=True)
+        curve = self.response_plots[0,i].plot(t, fit.eval(), pen=fit_pen, antialias=True).curve
+        if i != -1:
             # let the user mess with this fit
-            curve = self.response_plots[0,i].plot(t, fit.eval(), pen=fit_pen, antialias=True).curve
             curve.setClickable(True)
             curve.fit = fit
             curve.sigClicked.connect(self.fit_curve_clicked)
-            
-        # display global average
-        global_avg = ragged_mean(avg_responses, method='clip')
-        t = np.arange(len(global_avg)) * dt
-        self.response_plots[0,-1].plot(t, global_avg, pen='w', antialias=True)
-        global_fit = self.fit_psp(global_avg, t, dt, post_mode)
-        self.response_plots[0,-1].plot(t, global_fit.eval(), pen=fit_pen, antialias=True)
-            
-        # display fit parameters in table
-        events = []
-        for i,f in enumerate(fits + [global_fit]):
-            if f is None:
-                continue
-            if i >= len(fits):
-                vals = OrderedDict([('id', 'avg'), ('spike_time', np.nan), ('spike_stdev', np.nan)])
-            else:
-                spt = [s[i]['peak_index'] * dt for s in spikes if s[i] is not None]
-                vals = OrderedDict([('id', i), ('spike_time', np.mean(spt)), ('spike_stdev', np.std(spt))])
-            vals.update(OrderedDict([(k,f.best_values[k]) for k in f.params.keys()]))
-            events.append(vals)
-            
-        self.current_event_set = (pre, post, events, sweeps)
+
+    def _job_done(self, job, events):
+        if job is not self._job:
+            return
+        self.current_event_set = (job.pre, job.post, events, job.sweeps)
         self.event_set_list.setCurrentRow(0)
         self.event_set_selected()
 
@@ -303,7 +271,8 @@ class PairView(QtGui.QWidget):
     def event_set_selected(self):
         sel = self.event_set_list.selectedItems()[0]
         if sel.text() == "current":
-            self.event_table.setData(self.current_event_set[2])
+            if self.current_event_set is not None:
+                self.event_table.setData(self.current_event_set[2])
         else:
             self.event_table.setData(sel.event_set[2])
     
@@ -366,4 +335,192 @@ class PairView(QtGui.QWidget):
             self.fit_explorer = FitExplorer(curve.fit)
         else:
             self.fit_explorer.set_fit(curve.fit)
-        self.fit_explorer.show()
\ No newline at end of file
+        self.fit_explorer.show()
+
+
+def _param_key(param):
+    """Return a hashable summary of the values in a parameter tree.
+    """
+    return tuple((ch.name(), repr(ch.value()), _param_key(ch)) for ch in param.children())
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class PairAnalysisJob(QtCore.QThread):
+    """Processes sweeps for a PairView in a background thread.
+
+    Results are emitted as they become available:
+
+    * sig_sweep_processed(job, index, result) for each sweep
+    * sig_sweeps_done(job, npulses) once all sweeps are processed
+    * sig_pulse_fitted(job, result) for each pulse average, then for the
+      global average (with index -1)
+    * sig_job_done(job, events) with the table of fit results
+
+    cancel() stops the job at the next sweep or pulse boundary.
+    """
+    sig_sweep_processed = QtCore.Signal(object, object, object)
+    sig_sweeps_done = QtCore.Signal(object, object)
+    sig_pulse_fitted = QtCore.Signal(object, object)
+    sig_job_done = QtCore.Signal(object, object)
+
+    def __init__(self, view, sweeps, pre, post, post_mode, filter_key):
+        QtCore.QThread.__init__(self)
+        self.view = view
+        self.sweeps = list(sweeps)
+        self.pre = pre
+        self.post = post
+        self.post_mode = post_mode
+        self.filter_key = filter_key
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def check_cancelled(self):
+        if self._cancelled.is_set():
+            raise JobCancelled()
+
+    def run(self):
+        try:
+            self._run()
+        except JobCancelled:
+            pass
+        except Exception:
+            sys.excepthook(*sys.exc_info())
+
+    def process_sweep(self, sweep):
+        """Detect pulses and spikes and filter the postsynaptic trace of one
+        sweep, or return the cached result.
+        """
+        view = self.view
+        pre, post = self.pre, self.post
+        key = (sweep, pre, post, self.filter_key)
+        result = view._cached_sweep(key)
+        if result is not None:
+            return result
+
+        pre_trace = sweep[pre]['primary']
+        post_trace = sweep[post]['primary']
+        
+        # Detect pulse times
+        stim = sweep[pre]['command'].data
+        sdiff = np.diff(stim)
+        on_times = np.argwhere(sdiff > 0)[1:, 0]  # 1: skips test pulse
+        off_times = np.argwhere(sdiff < 0)[1:, 0]
+
+        # filter data
+        post_filt = view.artifact_remover.process(post_trace, list(on_times) + list(off_times))
+        post_filt = view.baseline_remover.process(post_filt)
+        post_filt = view.filter.process(post_filt)
+
+        # detect spike times
+        spike_info = []
+        for on, off in zip(on_times, off_times):
+            spike_info.append(detect_evoked_spike(sweep[pre], [on, off]))
+
+        result = {'pre_trace': pre_trace, 'post_filt': post_filt, 'pulses': on_times, 'spikes': spike_info}
+
+        # The processors read their live parameters; if these changed while
+        # this sweep was processed, the result does not belong under *key*.
+        self.check_cancelled()
+        if view._filter_key() != self.filter_key:
+            raise JobCancelled()
+        view._cache_sweep(key, result)
+        return result
+
+    def _run(self):
+        sweeps = self.sweeps
+        post_mode = self.post_mode
+
+        # Iterate over selected channels of all sweeps, collecting
+        # information about pulses and spikes
+        pulses = []
+        spikes = []
+        post_traces = []
+        for i,sweep in enumerate(sweeps):
+            self.check_cancelled()
+            result = self.process_sweep(sweep)
+            pulses.append(result['pulses'])
+            spikes.append(result['spikes'])
+            post_traces.append(result['post_filt'])
+            dt = result['pre_trace'].dt
+            self.sig_sweep_processed.emit(self, i, result)
+
+        # Iterate over spikes, calculating average response
+        avg_responses = []
+        fits = []
+        
+        npulses = max(map(len, pulses))
+        self.sig_sweeps_done.emit(self, npulses)
+        
+        for i in range(npulses):
+            self.check_cancelled()
+
+            # get the chunk of each sweep between spikes
+            responses = []
+            for j, sweep in enumerate(sweeps):
+                # get the current spike
+                if i >= len(spikes[j]):
+                    continue
+                spike = spikes[j][i]
+                if spike is None:
+                    continue
+                
+                # find next spike
+                next_spike = None
+                for sp in spikes[j][i+1:]:
+                    if sp is not None:
+                        next_spike = sp
+                        break
+                    
+                # determine time range for response
+                max_len = int(40e-3 / dt)  # don't take more than 50ms for any response
+                start = spike['rise_index']
+                if next_spike is not None:
+                    stop = min(start + max_len, next_spike['rise_index'])
+                else:
+                    stop = start + max_len
+                    
+                # collect data from this trace
+                trace = post_traces[j]
+                d = trace.data[start:stop].copy()
+                responses.append(d)
+
+            if len(responses) == 0:
+                continue
+                
+            # extend all responses to the same length and take nanmean
+            avg = ragged_mean(responses, method='clip')
+            avg -= float_mode(avg[:int(1e-3/dt)])
+            avg_responses.append(avg)
+            
+            # fit!
+            t = np.arange(len(avg)) * dt
+            fit = self.view.fit_psp(avg, t, dt, post_mode)
+            fits.append(fit)
+            self.sig_pulse_fitted.emit(self, {'index': i, 't': t, 'avg': avg, 'fit': fit})
+            
+        # global average
+        self.check_cancelled()
+        global_avg = ragged_mean(avg_responses, method='clip')
+        t = np.arange(len(global_avg)) * dt
+        global_fit = self.view.fit_psp(global_avg, t, dt, post_mode)
+        self.sig_pulse_fitted.emit(self, {'index': -1, 't': t, 'avg': global_avg, 'fit': global_fit})
+            
+        # collect fit parameters for the event table
+        events = []
+        for i,f in enumerate(fits + [global_fit]):
+            if f is None:
+                continue
+            if i >= len(fits):
+                vals = OrderedDict([('id', 'avg'), ('spike_time', np.nan), ('spike_stdev', np.nan)])
+            else:
+                spt = [s[i]['peak_index'] * dt for s in spikes if s[i] is not None]
+                vals = OrderedDict([('id', i), ('spike_time', np.mean(spt)), ('spike_stdev', np.std(spt))])
+            vals.update(OrderedDict([(k,f.best_values[k]) for k in f.params.keys()]))
+            events.append(vals)
+
+        self.sig_job_done.emit(self, events)
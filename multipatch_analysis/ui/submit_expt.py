@@ -8,7 +8,7 @@ import acq4.util.Canvas, acq4.util.DataManager
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtGui, QtCore
 
-from .. import metadata_submission, config
+from .. import metadata_submission, config, qc_summary
 from . import ui
 
 
@@ -322,6 +322,9 @@ class NwbTreeItem(TypeSelectItem):
         else:
             typ = 'ignore'
         TypeSelectItem.__init__(self, ui, fh, types, typ)
+        if typ == 'MIES physiology':
+            # start generating the QC summary now so the timeline loads quickly
+            qc_summary.get_qc_summary(fh.name())
     
 
 class MPLogTreeItem(TypeSelectItem):
@@ -2,11 +2,11 @@ from collections import OrderedDict
 import os, sys, subprocess, datetime
 import numpy as np
 import pyqtgraph as pg
-from pyqtgraph.Qt import QtGui
+from pyqtgraph.Qt import QtGui, QtCore
 from neuroanalysis.ui.plot_grid import PlotGrid
-from neuroanalysis.miesnwb import MiesNwb
 from .. import constants
 from .. import config
+from .. import qc_summary
 
 
 class SynapseTreeWidget(QtGui.QTreeWidget):
@@ -73,10 +73,15 @@ class ExperimentInfoWidget(QtGui.QWidget):
 
 
 class ExperimentTimeline(QtGui.QWidget):
+    # emitted from a background thread when a QC summary has been generated
+    sig_summary_ready = QtCore.Signal(object, object)  # nwb file name, summary
+
     def __init__(self):
         QtGui.QWidget.__init__(self)
         self.channels = None
         self.start_time = None  # starting time according to NWB file
+        self.nwb_handle = None
+        self.sig_summary_ready.connect(self._summary_ready)
         
         self.layout = QtGui.QGridLayout()
         self.setLayout(self.layout)
@@ -138,48 +143,46 @@ class ExperimentTimeline(QtGui.QWidget):
             self.add_pipette(i, status=status, internal_dye=dye, internal=internal)
         
     def load_nwb(self, nwb_handle):
-        with pg.BusyCursor():
-            self._load_nwb(nwb_handle)
-        
-    def _load_nwb(self, nwb_handle):
+        """Plot QC metrics for all recordings in an NWB file and set pipette
+        time ranges.
+
+        Metrics are read from the file's QC summary (see qc_summary). If there
+        is none yet, it is generated in a background thread and plotted when ready.
+        """
         self.nwb_handle = nwb_handle
-        self.nwb = MiesNwb(nwb_handle.name())
-        
-        # load all recordings
-        recs = {}
-        for srec in self.nwb.contents:
-            for chan in srec.devices:
-                recs.setdefault(chan, []).append(srec[chan])
+        summary = qc_summary.get_qc_summary(nwb_handle.name(), callback=self.sig_summary_ready.emit)
+        if summary is not None:
+            self._load_summary(summary)
+
+    def _summary_ready(self, nwb_file, summary):
+        if self.nwb_handle is None or nwb_file != self.nwb_handle.name():
+            # another file was loaded in the meantime
+            return
+        if summary is None:
+            print("Could not load QC metrics from %s" % nwb_file)
+            return
+        with pg.BusyCursor():
+            self._load_summary(summary)
 
-        chans = sorted(recs.keys())
+    def _load_summary(self, summary):
+        chans = sorted(summary.keys())
         
         # find time of first recording
-        start_time = min([rec[0].start_time for rec in recs.values()])
+        start_time = min([summary[chan]['start_time'][0] for chan in chans])
         self.start_time = start_time
-        end_time = max([rec[-1].start_time for rec in recs.values()])
+        end_time = max([summary[chan]['start_time'][-1] for chan in chans])
         self.plots.setXRange(0, (end_time-start_time).seconds)
         
         # plot all recordings
         for i,chan in enumerate(chans):
-            n_recs = len(recs[chan])
-            times = np.empty(n_recs)
-            i_hold = np.empty(n_recs)
-            v_hold = np.empty(n_recs)
-            v_noise = np.empty(n_recs)
-            i_noise = np.empty(n_recs)
-            
-            # load QC metrics for all recordings
-            for j,rec in enumerate(recs[chan]):
-                dt = (rec.start_time - start_time).seconds
-                times[j] = dt
-                v_hold[j] = rec.baseline_potential
-                i_hold[j] = rec.baseline_current
-                if rec.clamp_mode == 'vc':
-                    v_noise[j] = np.nan
-                    i_noise[j] = rec.baseline_rms_noise
-                else:
-                    v_noise[j] = rec.baseline_rms_noise
-                    i_noise[j] = np.nan
+            metrics = summary[chan]
+            times = np.array([(t - start_time).seconds for t in metrics['start_time']], dtype=float)
+            v_hold = np.array(metrics['baseline_potential'], dtype=float)
+            i_hold = np.array(metrics['baseline_current'], dtype=float)
+            noise = np.array(metrics['baseline_rms_noise'], dtype=float)
+            vc = np.array(metrics['clamp_mode']) == 'vc'
+            v_noise = np.where(vc, np.nan, noise)
+            i_noise = np.where(vc, noise, np.nan)
                     
             # scale all qc metrics to the range 0-1
             pass_brush = pg.mkBrush(100, 100, 255, 200)
@@ -195,13 +198,14 @@ class ExperimentTimeline(QtGui.QWidget):
                 brushes = np.where(np.abs(data) > 1.0, fail_brush, pass_brush)
                 plt.plot(times, data, pen=None, symbol=symbol, symbolPen=None, symbolBrush=brushes)
 
-        for i in recs.keys():
-            start = (recs[i][0].start_time - start_time).seconds - 1
-            stop = (recs[i][-1].start_time - start_time).seconds + 1
+        for i in chans:
+            rec_times = summary[i]['start_time']
+            start = (rec_times[0] - start_time).seconds - 1
+            stop = (rec_times[-1] - start_time).seconds + 1
             pip_param = self.params.child('Pipette %d' % (i+1))
             pip_param.set_time_range(start, stop)
             
-            got_data = len(recs[i]) > 2
+            got_data = len(rec_times) > 2
             pip_param['got data'] = got_data
         
     def add_pipette(self, channel, status=None, **kwds):
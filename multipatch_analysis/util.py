@@ -1,34 +1,75 @@
-import os, sys, time
+import os, sys, time, hashlib, threading
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 
-def sync_file(src, dst):
+def sync_file(src, dst, delta=False, **kwds):
     """Safely copy *src* to *dst*, but only if *src* is newer or a different size.
+
+    If *delta* is True and *dst* already exists, unchanged data is reused from
+    *dst* and only the parts that differ are taken from *src* (see delta_copy).
+    Note that this does not keep a renamed backup of the previous file as
+    safe_copy does.
+
+    Extra keyword arguments are passed to chunk_copy().
     """
     if os.path.isfile(dst):
         src_stat = os.stat(src)
         dst_stat = os.stat(dst)
         up_to_date = dst_stat.st_mtime >= src_stat.st_mtime and src_stat.st_size == dst_stat.st_size
-        
+
         if up_to_date:
             return "skip"
-        
-        safe_copy(src, dst)
+
+        if delta:
+            delta_copy(src, dst, limiter=kwds.get('limiter'))
+        else:
+            safe_copy(src, dst, **kwds)
         return "update"
     else:
-        safe_copy(src, dst)
+        safe_copy(src, dst, **kwds)
         return "copy"
 
 
-def safe_copy(src, dst):
+def sync_files(files, workers=4, max_bandwidth=None, delta=False):
+    """Synchronize many files concurrently.
+
+    *files* is a list of (src, dst) pairs; each is handled with sync_file().
+    If *max_bandwidth* (bytes/sec) is given, it limits the combined rate of
+    all copies.
+
+    Returns a list with the sync_file() status for each pair, or the exception
+    raised while copying it.
+    """
+    limiter = None if max_bandwidth is None else RateLimiter(max_bandwidth)
+
+    def sync(pair):
+        try:
+            return sync_file(pair[0], pair[1], delta=delta, limiter=limiter, progress=False)
+        except Exception as exc:
+            return exc
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(sync, files)
+    finally:
+        pool.close()
+
+
+def safe_copy(src, dst, **kwds):
     """Copy a file, but rename the destination file if it already exists.
-    
+
     Also, the destination file is suffixed ".partial" until the copy is complete.
+    Extra keyword arguments are passed to chunk_copy().
     """
     tmp_dst = dst + '.partial'
     try:
         new_name = None
         print("copy: %s => %s" % (src, dst))
-        chunk_copy(src, tmp_dst)
+        chunk_copy(src, tmp_dst, **kwds)
         if os.path.exists(dst):
             # rename destination file to avoid overwriting
             now = time.strftime('%Y-%m-%d_%H:%M:%S')
@@ -48,42 +89,260 @@ def safe_copy(src, dst):
     finally:
         if os.path.isfile(tmp_dst):
             os.remove(tmp_dst)
-    
 
-def chunk_copy(src, dst, chunk_size=100e6):
+
+def chunk_copy(src, dst, chunk_size=100e6, hasher=None, progress=True, limiter=None):
     """Manually copy a file one chunk at a time.
-    
+
     This allows progress feedback and more graceful cancellation during long
     copy operations.
+
+    The copy is done in the kernel with os.copy_file_range or os.sendfile where
+    available. Otherwise (or if *hasher* is given) reading and writing are
+    overlapped using a background reader thread.
+
+    If *hasher* is given (for example a hashlib object), it is updated with
+    each chunk as it is read. If *limiter* is given (a RateLimiter), it is used
+    to cap the copy bandwidth.
     """
     if os.path.exists(dst):
         raise Exception("Won't copy over existing file %s" % dst)
     size = os.stat(src).st_size
+    chunk_size = int(chunk_size)
+    if limiter is not None:
+        # smaller chunks give smoother rate limiting
+        chunk_size = int(min(chunk_size, max(1e6, limiter.rate / 4.)))
     in_fh = open(src, 'rb')
-    out_fh = open(dst, 'ab')
-    msglen = 0
+    out_fh = open(dst, 'wb')
+    msglen = [0]
+    tot = [0]
+
+    def update(n):
+        tot[0] += n
+        if limiter is not None:
+            limiter.consume(n)
+        if progress and size > chunk_size * 2:
+            n = int(50 * (float(tot[0]) / size))
+            msg = ('[' + '#' * n + '-' * (50-n) + ']  %d / %d MB\r') % (int(tot[0]/1e6), int(size/1e6))
+            msglen[0] = len(msg)
+            sys.stdout.write(msg)
+            sys.stdout.flush()
+
     try:
         with in_fh:
             with out_fh:
-                chunk_size = int(chunk_size)
-                tot = 0
-                while True:
-                    chunk = in_fh.read(chunk_size)
-                    out_fh.write(chunk)
-                    tot += len(chunk)
-                    if size > chunk_size * 2:
-                        n = int(50 * (float(tot) / size))
-                        msg = ('[' + '#' * n + '-' * (50-n) + ']  %d / %d MB\r') % (int(tot/1e6), int(size/1e6))
-                        msglen = len(msg)
-                        sys.stdout.write(msg)
-                        sys.stdout.flush()
-                    if len(chunk) < chunk_size:
-                        break
-                sys.stdout.write("[###  flushing..  \r")
-                sys.stdout.flush()
-        sys.stdout.write(' '*msglen + '\r')
-        sys.stdout.flush()
+                if hasher is not None or not _kernel_copy(in_fh, out_fh, chunk_size, update):
+                    _buffered_copy(in_fh, out_fh, chunk_size, hasher, update)
+                if progress:
+                    sys.stdout.write("[###  flushing..  \r")
+                    sys.stdout.flush()
+        if progress:
+            sys.stdout.write(' '*msglen[0] + '\r')
+            sys.stdout.flush()
     except Exception:
         if os.path.isfile(dst):
             os.remove(dst)
         raise
+
+
+def _kernel_copy(in_fh, out_fh, chunk_size, update):
+    """Copy between two open files without passing data through Python.
+
+    Returns False (having copied nothing) if neither os.copy_file_range nor
+    os.sendfile works for these files.
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    # only Linux sendfile accepts a regular file as output
+    sendfile = getattr(os, 'sendfile', None) if sys.platform.startswith('linux') else None
+    if copy_file_range is None and sendfile is None:
+        return False
+    in_fd = in_fh.fileno()
+    out_fd = out_fh.fileno()
+    copied = 0
+    while True:
+        try:
+            if copy_file_range is not None:
+                n = copy_file_range(in_fd, out_fd, chunk_size)
+            else:
+                n = sendfile(out_fd, in_fd, None, chunk_size)
+        except Exception:
+            if copied == 0:
+                # unsupported here (eg. copy_file_range across filesystems)
+                if copy_file_range is not None and sendfile is not None:
+                    copy_file_range = None
+                    continue
+                return False
+            raise
+        if n == 0:
+            return True
+        copied += n
+        update(n)
+
+
+def _buffered_copy(in_fh, out_fh, chunk_size, hasher, update):
+    """Copy between two open files, reading the next chunk in a background
+    thread while the current one is written.
+    """
+    chunks = queue.Queue(maxsize=1)
+    stop = threading.Event()
+
+    def read():
+        try:
+            while not stop.is_set():
+                chunk = in_fh.read(chunk_size)
+                while not stop.is_set():
+                    try:
+                        chunks.put(chunk, timeout=0.5)
+                        break
+                    except queue.Full:
+                        pass
+                if len(chunk) < chunk_size:
+                    break
+        except Exception as exc:
+            while not stop.is_set():
+                try:
+                    chunks.put(exc, timeout=0.5)
+                    break
+                except queue.Full:
+                    pass
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if hasher is not None:
+                hasher.update(chunk)
+            out_fh.write(chunk)
+            update(len(chunk))
+            if len(chunk) < chunk_size:
+                break
+    finally:
+        stop.set()
+        reader.join()
+
+
+def delta_copy(src, dst, block_size=2**17, limiter=None):
+    """Update *dst* to match *src* using an rsync-style rolling checksum.
+
+    The existing *dst* is divided into blocks of *block_size* bytes, each indexed
+    by a weak (rolling) and a strong (md5) checksum. *src* is then scanned once
+    with the rolling checksum, so blocks of *dst* are recognized anywhere in
+    *src*, even if data was inserted or removed before them. Matching blocks are
+    copied from the old *dst*; only the remaining literal data is taken from
+    *src*. The result is written to a temporary file that replaces *dst* when
+    complete.
+
+    *src* is still read in full (it is only accessible as a file); if *limiter*
+    is given, it limits the rate of these reads. Returns the number of literal
+    bytes taken from *src*. The mtime of *dst* is set to that of *src*.
+    """
+    import numpy as np
+    block_size = int(block_size)
+    src_stat = os.stat(src)
+
+    # signatures of all complete blocks in dst: {weak: {strong: offset}}
+    blocks = {}
+    with open(dst, 'rb') as fh:
+        offset = 0
+        while True:
+            block = fh.read(block_size)
+            if len(block) < block_size:
+                # a final partial block can only match the end of src
+                tail = (offset, block)
+                break
+            weak = int(_weak_checksums(block, block_size)[0])
+            blocks.setdefault(weak, {}).setdefault(hashlib.md5(block).digest(), offset)
+            offset += block_size
+    weak_keys = np.array(sorted(blocks.keys()), dtype=np.int64)
+
+    scan_size = max(2 * block_size, 2**21)
+    literal = 0
+    tmp_dst = dst + '.partial'
+    try:
+        with open(src, 'rb') as in_fh, open(dst, 'rb') as old_fh, open(tmp_dst, 'wb') as out_fh:
+            buf = b''
+            while True:
+                data = in_fh.read(scan_size)
+                if limiter is not None:
+                    limiter.consume(len(data))
+                eof = len(data) == 0
+                buf += data
+                pos = 0
+                if len(buf) >= block_size and len(weak_keys) > 0:
+                    weak = _weak_checksums(buf, block_size)
+                    found = weak_keys[np.minimum(np.searchsorted(weak_keys, weak), len(weak_keys) - 1)] == weak
+                    for i in np.argwhere(found)[:, 0]:
+                        i = int(i)
+                        if i < pos:
+                            continue
+                        match = blocks[int(weak[i])].get(hashlib.md5(buf[i:i+block_size]).digest())
+                        if match is None:
+                            continue
+                        out_fh.write(buf[pos:i])
+                        literal += i - pos
+                        old_fh.seek(match)
+                        out_fh.write(old_fh.read(block_size))
+                        pos = i + block_size
+                if eof:
+                    keep = len(buf)
+                    if len(tail[1]) > 0 and len(buf) - pos >= len(tail[1]) and buf.endswith(tail[1]):
+                        keep -= len(tail[1])
+                else:
+                    # windows starting in the last block_size-1 bytes are checked
+                    # again once more data has been read
+                    keep = max(pos, len(buf) - block_size + 1)
+                out_fh.write(buf[pos:keep])
+                literal += keep - pos
+                if eof and keep < len(buf):
+                    out_fh.write(tail[1])
+                buf = buf[keep:]
+                if eof:
+                    break
+        if sys.platform == 'win32':
+            os.remove(dst)
+        os.rename(tmp_dst, dst)
+    finally:
+        if os.path.isfile(tmp_dst):
+            os.remove(tmp_dst)
+    # otherwise an unchanged dst would look out of date to sync_file
+    os.utime(dst, (src_stat.st_atime, src_stat.st_mtime))
+    return literal
+
+
+def _weak_checksums(data, n):
+    """Return the rolling checksum (an adler32-like sum, as used by rsync) of
+    every *n*-byte window in *data*.
+    """
+    import numpy as np
+    x = np.frombuffer(data, dtype=np.uint8).astype(np.int64)
+    s = np.concatenate([[0], np.cumsum(x)])
+    t = np.concatenate([[0], np.cumsum(x * np.arange(len(x), dtype=np.int64))])
+    k = np.arange(len(x) - n + 1, dtype=np.int64)
+    a = s[k+n] - s[k]
+    b = (k + n) * a - (t[k+n] - t[k])
+    return (a & 0xffff) | ((b & 0xffff) << 16)
+
+
+class RateLimiter(object):
+    """Limits the combined rate of data transfers (bytes/sec) across threads.
+
+    Each transfer calls consume(n) after moving n bytes; this blocks as needed
+    to keep the average rate below the limit.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._lock = threading.Lock()
+        self._next_time = time.time()
+
+    def consume(self, n):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_time)
+            self._next_time = start + n / self.rate
+            wait = self._next_time - now
+        if wait > 0:
+            time.sleep(wait)
@@ -27,6 +27,10 @@ def arg_to_date(arg):
 parser = argparse.ArgumentParser()
 parser.add_argument('--reload', action='store_true', default=False, dest='reload',
                     help='Reload all experiment data from the server.')
+parser.add_argument('--force', action='store_true', default=False,
+                    help='Combined with --reload, reload experiments even if their files have not changed.')
+parser.add_argument('--load-summary', type=str, default=None, dest='load_summary',
+                    help='Combined with --reload, write per-experiment load timing and errors to this JSON file.')
 parser.add_argument('--reload-old', action='store_true', default=False, dest='reload_old',
                     help='Reload all experiment data from old summary files.')
 parser.add_argument('--region', type=str)
@@ -51,7 +55,7 @@ args = parser.parse_args(sys.argv[1:])
 all_expts = ExperimentList(cache=cache_file)
 
 if args.reload:
-    all_expts.load_from_server()
+    all_expts.load_from_server(force=args.force, summary_file=args.load_summary)
 
 if args.reload_old:
     files = config.summary_files
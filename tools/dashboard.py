@@ -1,126 +1,346 @@
-import os, sys, datetime, re, glob
-import config
-import database
-from acq4.util.DataManager import getDirHandle
+"""
+Dashboard showing the status of every experiment site on the server.
+
+Sites are found by an incremental index of the expt/slice/site folders
+(SiteIndex). After the first pass, each rescan only stats the known folders
+and lists those whose mtime changed. Where pyinotify is available, changes
+are picked up from inotify events and the full mtime rescan runs only
+occasionally as a fallback (network file systems do not report all changes
+through inotify).
+
+DB and LIMS status for all sites are read with one bulk query each, and only
+sites whose status changed are sent to the UI.
+"""
+from __future__ import print_function
+import os, sys, datetime, re, time, threading
 import pyqtgraph as pg
+import pyqtgraph.configfile
 from pyqtgraph.Qt import QtGui, QtCore
+from multipatch_analysis import config, lims
+from multipatch_analysis.database import database as db
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 
 class Dashboard(QtGui.QWidget):
+    fields = ['timestamp', 'rig', 'has_metadata_qc', 'has_site_mosaic', 'in_db', 'lims_state', 'path']
+
     def __init__(self):
         QtGui.QWidget.__init__(self)
-        
+
         self.layout = QtGui.QGridLayout()
         self.setLayout(self.layout)
-        
+
         self.expt_tree = pg.TreeWidget()
-        self.expt_tree.setColumnCount(5)
+        self.expt_tree.setColumnCount(len(self.fields))
+        self.expt_tree.setHeaderLabels(self.fields)
         self.layout.addWidget(self.expt_tree, 0, 0)
-        
+
         self.resize(1000, 900)
-        
+
         self.records = {}
-        
-        self.poll_thread = PollThread()
+
+        self.poll_thread = PollThread(config.synphys_data)
         self.poll_thread.update.connect(self.poller_update)
         self.poll_thread.start()
-        
-    def poller_update(self, rec):
-        ts = rec['timestamp']
-        if ts in self.records:
-            item = self.records[ts]['item']
-            self.records[ts].update(rec)
+
+    def poller_update(self, recs):
+        """Add, update or remove tree items for a batch of changed site records.
+        """
+        self.expt_tree.setUpdatesEnabled(False)
+        try:
+            for rec in recs:
+                path = rec['path']
+                if rec.get('removed', False):
+                    old = self.records.pop(path, None)
+                    if old is not None:
+                        index = self.expt_tree.indexOfTopLevelItem(old['item'])
+                        self.expt_tree.takeTopLevelItem(index)
+                    continue
+
+                if path in self.records:
+                    item = self.records[path]['item']
+                    self.records[path].update(rec)
+                    rec = self.records[path]
+                else:
+                    item = pg.TreeWidgetItem()
+                    self.expt_tree.addTopLevelItem(item)
+                    rec = dict(rec, item=item)
+                    self.records[path] = rec
+
+                for i, field in enumerate(self.fields):
+                    item.setText(i, str(rec.get(field, '')))
+        finally:
+            self.expt_tree.setUpdatesEnabled(True)
+
+    def closeEvent(self, ev):
+        self.poll_thread.stop()
+        QtGui.QWidget.closeEvent(self, ev)
+
+
+class SiteIndex(object):
+    """Incremental index of the expt/slice/site folders below *root*.
+
+    Every folder's mtime is remembered. A folder is listed again only when its
+    mtime has changed (entries were added, removed or renamed), so a rescan of
+    an unchanged tree costs one stat() per folder. Site records are rebuilt
+    only for sites whose folder changed.
+    """
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.mtimes = {}     # folder path: mtime when last listed
+        self.children = {}   # folder path: list of subfolder names
+        self.files = {}      # site path: set of file names
+        self.sites = {}      # site path: record
+        self._dirty = set()
+        self._dirty_lock = threading.Lock()
+
+    def mark_dirty(self, path):
+        """Request that *path* (a folder at any depth) be listed on the next scan.
+        """
+        with self._dirty_lock:
+            self._dirty.add(os.path.abspath(path))
+
+    def take_dirty(self):
+        with self._dirty_lock:
+            dirty = self._dirty
+            self._dirty = set()
+        return dirty
+
+    def scan(self, paths=None):
+        """Update the index and return a list of site records that changed.
+
+        If *paths* is given, only those folders (and any changed folders
+        below them) are examined; otherwise the whole tree is checked.
+        Removed sites are returned as {'path': path, 'removed': True}.
+        """
+        changed = []
+        if paths is None:
+            self._scan_dir(self.root, 0, changed, force=False)
+        else:
+            for path in sorted(paths):
+                depth = self._depth(path)
+                if depth is None:
+                    continue
+                if depth > 3:
+                    # a change inside a site folder; re-read the site
+                    path = os.path.join(self.root, *self._rel_parts(path)[:3])
+                    depth = 3
+                self._scan_dir(path, depth, changed, force=True)
+        return changed
+
+    def _rel_parts(self, path):
+        rel = os.path.relpath(os.path.abspath(path), self.root)
+        return [] if rel == '.' else rel.split(os.sep)
+
+    def _depth(self, path):
+        parts = self._rel_parts(path)
+        if len(parts) > 0 and parts[0] == '..':
+            return None
+        return len(parts)
+
+    def _scan_dir(self, path, depth, changed, force):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self._forget(path, changed)
+            return
+        listed = force or self.mtimes.get(path) != mtime
+
+        if depth == 3:
+            if listed or path not in self.sites:
+                self.mtimes[path] = mtime
+                self.files[path] = set(os.listdir(path))
+                rec = self._site_record(path)
+                if rec != self.sites.get(path):
+                    self.sites[path] = rec
+                    changed.append(rec)
+            return
+
+        if listed:
+            self.mtimes[path] = mtime
+            names = []
+            for name in sorted(os.listdir(path)):
+                if depth == 0 and 'recycle' in name.lower():
+                    continue
+                if os.path.isdir(os.path.join(path, name)):
+                    names.append(name)
+            for name in set(self.children.get(path, [])) - set(names):
+                self._forget(os.path.join(path, name), changed)
+            self.children[path] = names
+
+        for name in self.children.get(path, []):
+            self._scan_dir(os.path.join(path, name), depth + 1, changed, force=False)
+
+    def _forget(self, path, changed):
+        """Remove a folder and everything below it from the index.
+        """
+        for name in self.children.pop(path, []):
+            self._forget(os.path.join(path, name), changed)
+        self.mtimes.pop(path, None)
+        self.files.pop(path, None)
+        if self.sites.pop(path, None) is not None:
+            changed.append({'path': path, 'removed': True})
+
+    def _site_record(self, path):
+        files = self.files[path]
+        old = self.sites.get(path)
+        if old is not None and old['timestamp'] is not None:
+            ts = old['timestamp']
         else:
-            item = pg.TreeWidgetItem()
-            self.expt_tree.addTopLevelItem(item)
-            rec['item'] = item
-            self.records[ts] = rec
-            
-        for i, field in enumerate(['timestamp', 'rig', 'has_metadata_qc', 'has_site_mosaic']):
-            item.setText(i, str(rec[field]))
+            ts = None
+            if '.index' in files:
+                try:
+                    ts = pyqtgraph.configfile.readConfigFile(os.path.join(path, '.index'))['.'].get('__timestamp__')
+                except Exception:
+                    print("Error reading %s:" % os.path.join(path, '.index'))
+                    sys.excepthook(*sys.exc_info())
+
+        rig = ''
+        #rig = re.search('(MP\d)_', path).groups()[0]
+
+        rec = {
+            'path': path,
+            'timestamp': ts,
+            'rig': rig,
+            'has_metadata_qc': 'file_manifest.yml' in files,
+            'has_site_mosaic': 'site.mosaic' in files,
+        }
+        if old is not None:
+            # status fields are maintained by PollThread.update_status
+            rec['in_db'] = old.get('in_db')
+            rec['lims_state'] = old.get('lims_state')
+        return rec
+
+
+class InotifyWatcher(object):
+    """Marks folders in a SiteIndex dirty when inotify reports a change.
+    """
+    def __init__(self, index):
+        self.index = index
+        mask = (pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_ATTRIB)
+        self.wm = pyinotify.WatchManager()
+        self.notifier = pyinotify.ThreadedNotifier(self.wm, self._event)
+        self.notifier.daemon = True
+        self.notifier.start()
+        # site folders are 3 levels deep; don't watch anything below that
+        exclude = lambda path: index._depth(path) > 3
+        self.wm.add_watch(index.root, mask, rec=True, auto_add=True, exclude_filter=exclude, quiet=True)
+
+    def _event(self, event):
+        self.index.mark_dirty(event.path)
+
+    def stop(self):
+        self.notifier.stop()
 
 
 class PollThread(QtCore.QThread):
     """Used to check in the background for changes to experiment status.
+
+    Emits `update` with a list of changed site records.
+
+    Every *interval* seconds, folders reported by inotify are rescanned (or,
+    without inotify, the whole tree is rescanned by mtime). A full rescan
+    also happens every *full_interval* seconds, and DB / LIMS status for all
+    sites is refreshed every *status_interval* seconds.
     """
     update = QtCore.Signal(object)
-    
-    def __init__(self):
+
+    def __init__(self, root, interval=5, full_interval=600, status_interval=60):
         QtCore.QThread.__init__(self)
-        
+        self.index = SiteIndex(root)
+        self.interval = interval
+        self.full_interval = full_interval
+        self.status_interval = status_interval
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+        self.wait()
+
     def run(self):
-        while True:
+        watcher = None
+        if pyinotify is not None:
             try:
-                self.poll()
+                watcher = InotifyWatcher(self.index)
             except Exception:
+                print("Could not start inotify watcher; using mtime rescans only:")
                 sys.excepthook(*sys.exc_info())
-            break
-                
-    def poll(self):
-        print("loading site paths..")
-        #site_paths = glob.glob(os.path.join(config.synphys_data, '*', 'slice_*', 'site_*'))
-        
-        root_dh = getDirHandle(config.synphys_data)
-        
-        print(root_dh.name())
-        for expt in root_dh.ls():
-            expt_dh = root_dh[expt]
-            print(expt_dh.name())
-            if not expt_dh.isDir():
+
+        next_full = 0
+        next_status = 0
+        try:
+            while not self._stop.is_set():
+                try:
+                    now = time.time()
+                    if watcher is None or now >= next_full:
+                        # dirty folders will be covered by the full scan
+                        self.index.take_dirty()
+                        changed = self.index.scan()
+                        next_full = now + (self.interval if watcher is None else self.full_interval)
+                    else:
+                        changed = self.index.scan(self.index.take_dirty())
+
+                    if now >= next_status:
+                        changed = self.update_status(self.index.sites.values(), changed)
+                        next_status = now + self.status_interval
+                    else:
+                        new = [rec for rec in changed if not rec.get('removed') and 'in_db' not in rec]
+                        changed = self.update_status(new, changed)
+
+                    if len(changed) > 0:
+                        # send copies; the index keeps modifying its own records
+                        self.update.emit([dict(rec) for rec in changed])
+                except Exception:
+                    sys.excepthook(*sys.exc_info())
+                self._stop.wait(self.interval)
+        finally:
+            if watcher is not None:
+                watcher.stop()
+
+    def update_status(self, recs, changed):
+        """Fill in 'in_db' and 'lims_state' for *recs* using one DB query and one
+        LIMS status table lookup. Returns *changed* extended with any other
+        records whose status changed.
+        """
+        recs = list(recs)
+        if len(recs) == 0:
+            return changed
+        try:
+            db_timestamps = db.experiment_timestamps()
+        except Exception:
+            print("Error reading experiments from DB:")
+            sys.excepthook(*sys.exc_info())
+            db_timestamps = None
+        lims_status = lims.submission_status().get_many([rec['path'] for rec in recs])
+
+        changed_paths = set(rec['path'] for rec in changed)
+        changed = list(changed)
+        for rec in recs:
+            ts = rec['timestamp']
+            if db_timestamps is None or ts is None:
+                in_db = rec.get('in_db')
+            else:
+                in_db = datetime.datetime.fromtimestamp(ts) in db_timestamps
+            lims_rec = lims_status.get(rec['path'])
+            lims_state = None if lims_rec is None else lims_rec['state']
+
+            if 'in_db' in rec and (in_db, lims_state) == (rec['in_db'], rec['lims_state']):
                 continue
-            for slice_name in expt_dh.ls():
-                slice_dh = expt_dh[slice_name]
-                if not slice_dh.isDir():
-                    continue
-                print(slice_dh.name())
-                for site_name in slice_dh.ls():
-                    site_dh = slice_dh[site_name]
-                    if not site_dh.isDir():
-                        continue
-                    self.check(site_dh)
-            
-    def check(self, site_dh):
-        print("   check %s" % site_dh.name())
-        ts = site_dh.info()['__timestamp__']
-        date = datetime.datetime.fromtimestamp(ts)
-        site_id = date
-        
-        rig = ''
-        #rig = re.search('(MP\d)_', site_dh.name()).groups()[0]
-        
-        has_meta_qc = 'file_manifest.yml' in site_dh.ls()
-        has_site_mosaic = 'site.mosaic' in site_dh.ls()
-        
-        
-        
-        #try:
-            #expt_entry = database.experiment_from_timestamp(date)
-            #expt_steps = expt_entry.submission_data
-            #if expt_steps is None:
-                #expt_steps = {}
-        #except KeyError:
-            #expt_entry = None
-            #expt_steps = {}
-        
-        #print("{rig} {date} {uid} {in_db} {in_server}".format(
-            #rig=rig,
-            #date=date.strftime('%Y-%m-%d'), 
-            #uid='%0.2f'%ts,
-            #in_db=expt_entry is not None,
-            #in_server='raw_data_location' in expt_steps,
-        #))
-        
-        self.update.emit({
-            'dh': site_dh.name(), 
-            'timestamp': ts, 
-            'rig': rig, 
-            'has_metadata_qc': has_meta_qc,
-            'has_site_mosaic': has_site_mosaic,
-        })
+            rec['in_db'] = in_db
+            rec['lims_state'] = lims_state
+            if rec['path'] not in changed_paths:
+                changed.append(rec)
+                changed_paths.add(rec['path'])
+        return changed
 
 
 if __name__ == '__main__':
     app = pg.mkQApp()
-    db = Dashboard()
-    db.show()
-    
\ No newline at end of file
+    db_win = Dashboard()
+    db_win.show()
+    if sys.flags.interactive == 0:
+        app.exec_()
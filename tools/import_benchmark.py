@@ -0,0 +1,89 @@
+"""
+Measure how long it takes a fresh Python process to import analysis modules,
+and whether importing them pulls in Qt.
+
+Each module is imported in a new interpreter (as in a worker process), and the
+best of several runs is reported. Exits with status 1 if any module takes
+longer than --max-time seconds or loads Qt when it should not.
+
+    python tools/import_benchmark.py
+    python tools/import_benchmark.py multipatch_analysis.experiment_list --repeat 5
+"""
+from __future__ import print_function, division
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+# modules used by headless workers; these must not import Qt
+HEADLESS_MODULES = [
+    'multipatch_analysis.config',
+    'multipatch_analysis.data',
+    'multipatch_analysis.connection_detection',
+    'multipatch_analysis.synaptic_dynamics',
+    'multipatch_analysis.database.database',
+]
+
+_probe = """
+import sys, time, json
+start = time.time()
+import %s
+elapsed = time.time() - start
+qt = sorted(set(m.split('.')[0] for m in sys.modules if m.split('.')[0] in ('PyQt4', 'PyQt5', 'PySide', 'PySide2', 'pyqtgraph')))
+print(json.dumps({'time': elapsed, 'qt': qt}))
+"""
+
+
+def time_import(module, repeat=3):
+    """Import *module* in *repeat* fresh interpreters.
+
+    Returns (best import time in seconds, best total process time, list of Qt packages loaded).
+    """
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root, env.get('PYTHONPATH', '')])
+    best = None
+    best_total = None
+    for i in range(repeat):
+        start = time.time()
+        out = subprocess.check_output([sys.executable, '-c', _probe % module], env=env, cwd=root)
+        total = time.time() - start
+        result = json.loads(out.decode().strip().split('\n')[-1])
+        best = result['time'] if best is None else min(best, result['time'])
+        best_total = total if best_total is None else min(best_total, total)
+    return best, best_total, result['qt']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import time of analysis modules.")
+    parser.add_argument('modules', nargs='*', default=HEADLESS_MODULES, help="Modules to import (default: headless analysis modules)")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of runs per module; the best is reported")
+    parser.add_argument('--max-time', type=float, default=1.0, dest='max_time', help="Fail if a process takes longer than this (seconds) to start and import")
+    args = parser.parse_args()
+
+    failed = False
+    print("%-45s %10s %10s  %s" % ("module", "import (s)", "total (s)", "Qt"))
+    for module in args.modules:
+        try:
+            t, total, qt = time_import(module, args.repeat)
+        except subprocess.CalledProcessError:
+            print("%-45s  import failed" % module)
+            failed = True
+            continue
+        flags = []
+        if total > args.max_time:
+            flags.append('SLOW')
+        if module in HEADLESS_MODULES and len(qt) > 0:
+            flags.append('QT')
+        failed = failed or len(flags) > 0
+        print("%-45s %10.3f %10.3f  %s %s" % (module, t, total, ','.join(qt) or '-', ' '.join(flags)))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
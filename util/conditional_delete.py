@@ -1,37 +1,49 @@
-import os, sys, re, shutil, hashlib, time
+import os, sys, re, shutil, hashlib, time, json, sqlite3, threading, argparse
+from multiprocessing.pool import ThreadPool
 
 
 ignored_files = ['.*Thumbs.db']
 ignored_regex = [re.compile(x) for x in ignored_files]
 
 
-def conditional_delete(path1, path2):
+def conditional_delete(path1, path2, report=None, **kwds):
     """Delete *path1* only if all files that would be deleted also exist in *path2*.
 
     Return True if *path1* was deleted.
 
     This is used for recovering disk space after verifying the contents of a backup.
+    If *report* is a dict, it is filled with the results of compare_paths(). Extra
+    keyword arguments are passed to compare_paths().
     """
     print("Comparing %s..." % path1)
-    if not compare_paths(path1, path2):
+    if report is None:
+        report = {}
+    if not compare_paths(path1, path2, report=report, **kwds):
         print("    Skipping %s" % path1)
         return False
 
     print("    Removing %s..." % path1)
     shutil.rmtree(path1)
+    report['deleted'] = True
     print("    Done.")
     return True
 
 
-def conditional_delete_old(path1, path2, min_age=120):
+def conditional_delete_old(path1, path2, min_age=120, report_file=None, dry_run=False, **kwds):
     """Conditionally delete subdirectories from *path1* if they are older than *min_age* (in days) and
     have a valid copy in *path2*.
 
     The age of each subfolder is determined using its MTIME.
+
+    If *report_file* is given, a JSON report is written there listing each
+    subdirectory with its status ('deleted', 'safe' (verified, but *dry_run* was
+    set), 'not backed up' or 'too young') and the comparison results. Extra
+    keyword arguments are passed to compare_paths().
     """
     too_young = []
     deleted_paths = []
     invalid_paths = []
+    report = {'path1': path1, 'path2': path2, 'min_age': min_age, 'time': time.time(), 'paths': []}
 
     for f in os.listdir(path1):
         src_path = os.path.join(path1, f)
@@ -40,32 +52,64 @@ def conditional_delete_old(path1, path2, min_age=120):
             continue
         if age_in_days(src_path) < min_age:
             too_young.append(src_path)
+            report['paths'].append({'path': src_path, 'status': 'too young'})
             continue
         dst_path = os.path.join(path2, f)
-        deleted = conditional_delete(src_path, dst_path)
+        path_report = {'path': src_path}
+        if dry_run:
+            print("Comparing %s..." % src_path)
+            deleted = compare_paths(src_path, dst_path, report=path_report, **kwds)
+            path_report['status'] = 'safe' if deleted else 'not backed up'
+        else:
+            deleted = conditional_delete(src_path, dst_path, report=path_report, **kwds)
+            path_report['status'] = 'deleted' if deleted else 'not backed up'
+        report['paths'].append(path_report)
         if deleted:
             deleted_paths.append(src_path)
         else:
             invalid_paths.append(src_path)
     print("-----------------")
-    print("Deleted %d;  skipped %d  (%d too young, %d not backed up)" % (len(deleted_paths), len(too_young)+len(invalid_paths), len(too_young), len(invalid_paths)))
+    print("%s %d;  skipped %d  (%d too young, %d not backed up)" % ('Safe to delete' if dry_run else 'Deleted', len(deleted_paths), len(too_young)+len(invalid_paths), len(too_young), len(invalid_paths)))
+
+    if report_file is not None:
+        json.dump(report, open(report_file, 'w'), indent=2)
+    return report
 
 
 def age_in_days(path):
     return (time.time() - os.stat(path).st_mtime) / (3600*24.)
 
 
-def compare_paths(path1, path2):
+def compare_paths(path1, path2, workers=8, sample_above=None, digest_cache=None, trust_cache=False, report=None):
     """Return True only if all files inside the tree at *path1* also exist in the same relative 
     locations in *path2*.
+
+    Files with matching sizes are compared by digest, using a pool of *workers*
+    threads. Files larger than *sample_above* bytes are compared using
+    sampled_hash() rather than a full hash. If *digest_cache* (a DigestCache) is
+    given, digests of unchanged files in *path1* are reused from previous runs.
+    Files in *path2* are always hashed again, since a corrupted backup may keep
+    its size and mtime; set *trust_cache* to use the cache for them as well.
+
+    If *report* is a dict, it is filled with 'match', 'n_files', 'n_bytes',
+    'ignored' (list of files) and 'problems' (list of {'file', 'reason'}).
     """
-    match = True
+    if report is None:
+        report = {}
+    problems = []
+    ignored = []
+    to_hash = []
+    n_bytes = 0
+
+    def problem(rel_path, reason):
+        print("      %s %s" % (reason, rel_path))
+        problems.append({'file': rel_path, 'reason': reason})
+
     for src_path, dirs, files in os.walk(path1):
         subpath = os.path.relpath(src_path, path1)
         dst_path = os.path.join(path2, subpath)
         if not os.path.isdir(dst_path):
-            match = False
-            print("      Missing directory %s" % subpath)
+            problem(subpath, "Missing directory")
             continue
         for f in files:
             rel_file = os.path.join(subpath, f)
@@ -77,6 +121,7 @@ def compare_paths(path1, path2):
                 if x.match(src_file) is not None:
                     # ignore this file
                     print("      Ignored file %s" % rel_file)
+                    ignored.append(rel_file)
                     ignore = True
                     break
             if ignore:
@@ -84,19 +129,42 @@ def compare_paths(path1, path2):
 
             dst_file = os.path.join(dst_path, f)
             if not os.path.isfile(dst_file):
-                match = False
-                print("      Missing file %s" % rel_file)
+                problem(rel_file, "Missing file")
                 continue
-            if os.stat(src_file).st_size != os.stat(dst_file).st_size:
-                match = False
-                print("      Wrong size %s" % rel_file)
-                continue
-            if file_hash(src_file) != file_hash(dst_file):
-                match = False
-                print("      Hash mismatch %s" % rel_file)
+            size = os.stat(src_file).st_size
+            if size != os.stat(dst_file).st_size:
+                problem(rel_file, "Wrong size")
                 continue
+            n_bytes += size
+            to_hash.append((rel_file, src_file, dst_file, size))
+
+    def compare(item):
+        rel_file, src_file, dst_file, size = item
+        sampled = sample_above is not None and size > sample_above
+        try:
+            dst_cache = digest_cache if trust_cache else None
+            same = cached_hash(src_file, digest_cache, sampled) == cached_hash(dst_file, dst_cache, sampled)
+        except Exception as exc:
+            return rel_file, "Error hashing (%s)" % exc
+        return rel_file, None if same else "Hash mismatch"
 
-    return match
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(compare, to_hash, chunksize=1)
+    finally:
+        pool.close()
+    for rel_file, reason in results:
+        if reason is not None:
+            problem(rel_file, reason)
+
+    report.update({
+        'match': len(problems) == 0,
+        'n_files': len(to_hash),
+        'n_bytes': n_bytes,
+        'ignored': ignored,
+        'problems': problems,
+    })
+    return len(problems) == 0
 
 
 def file_hash(filename, blocksize=2**24, func=hashlib.sha1):
@@ -109,9 +177,90 @@ def file_hash(filename, blocksize=2**24, func=hashlib.sha1):
     return hash.hexdigest()
 
 
-if __name__ == '__main__':
-    path1, path2 = sys.argv[1:]
-    conditional_delete_old(path1, path2)
+def sampled_hash(filename, n_samples=64, sample_size=2**20, func=hashlib.sha1):
+    """Return a digest of the file size and *n_samples* blocks read at evenly
+    spaced offsets (including the first and last block).
 
+    This is much faster than file_hash() for very large files, but only detects
+    differences that fall within the sampled blocks.
+    """
+    size = os.stat(filename).st_size
+    hash = func()
+    hash.update(str(size).encode())
+    with open(filename, "rb") as f:
+        if size <= n_samples * sample_size:
+            offsets = [0]
+            sample_size = size
+        else:
+            step = (size - sample_size) / float(n_samples - 1)
+            offsets = [int(i * step) for i in range(n_samples)]
+        for offset in offsets:
+            f.seek(offset)
+            hash.update(f.read(sample_size))
+    return hash.hexdigest()
+
+
+def cached_hash(filename, digest_cache=None, sampled=False):
+    """Return file_hash() (or sampled_hash() if *sampled*) for a file, using
+    *digest_cache* to avoid rehashing files that have not changed.
+    """
+    filename = os.path.abspath(filename)
+    mode = 'sampled' if sampled else 'full'
+    if digest_cache is not None:
+        stat = os.stat(filename)
+        digest = digest_cache.get(filename, stat.st_size, stat.st_mtime, mode)
+        if digest is not None:
+            return digest
+    digest = sampled_hash(filename) if sampled else file_hash(filename)
+    if digest_cache is not None:
+        digest_cache.set(filename, stat.st_size, stat.st_mtime, mode, digest)
+    return digest
+
+
+class DigestCache(object):
+    """Persistent store of file digests keyed by (path, size, mtime, mode).
 
+    Entries for a path are replaced whenever the file's size or mtime changes.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.conn.execute("""create table if not exists digest (
+            path text,
+            mode text,
+            size integer,
+            mtime real,
+            digest text,
+            primary key (path, mode)
+        )""")
+        self.conn.commit()
+
+    def get(self, path, size, mtime, mode):
+        with self._lock:
+            row = self.conn.execute("select digest from digest where path=? and mode=? and size=? and mtime=?", (path, mode, size, mtime)).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, path, size, mtime, mode, digest):
+        with self._lock:
+            self.conn.execute("insert or replace into digest (path, mode, size, mtime, digest) values (?, ?, ?, ?, ?)", (path, mode, size, mtime, digest))
+            self.conn.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Delete subdirectories of path1 that are verified to have a copy in path2.")
+    parser.add_argument('path1')
+    parser.add_argument('path2')
+    parser.add_argument('--min-age', type=float, default=120, dest='min_age', help="Minimum age of deleted folders (days)")
+    parser.add_argument('--workers', type=int, default=8, help="Number of files to hash concurrently")
+    parser.add_argument('--sample-above', type=float, default=None, dest='sample_above', help="Use sampled hashing for files larger than this (MB)")
+    parser.add_argument('--digest-cache', type=str, default=os.path.join(os.path.expanduser('~'), '.conditional_delete_digests.sqlite'), dest='digest_cache')
+    parser.add_argument('--trust-cache', action='store_true', default=False, dest='trust_cache', help="Also use cached digests for files in path2")
+    parser.add_argument('--report', type=str, default=None, help="Write a JSON report to this file")
+    parser.add_argument('--dry-run', action='store_true', default=False, dest='dry_run', help="Only report which folders are safe to delete")
+    args = parser.parse_args()
 
+    sample_above = None if args.sample_above is None else args.sample_above * 1e6
+    conditional_delete_old(args.path1, args.path2, min_age=args.min_age, report_file=args.report, dry_run=args.dry_run,
+                           workers=args.workers, sample_above=sample_above, digest_cache=DigestCache(args.digest_cache),
+                           trust_cache=args.trust_cache)
@@ -86,7 +86,14 @@ if __name__ == '__main__':
     print([ex.uid for ex in selected_expts])
     
     if args.local is True:
+        cache = synphys_cache.get_cache()
         for i, expt in enumerate(selected_expts):
+            # copy the next experiment's NWB file while this one is imported
+            if i + 1 < len(selected_expts):
+                try:
+                    cache.prefetch([selected_expts[i+1].nwb_file])
+                except Exception:
+                    pass
             submit_expt(expt.uid)
     else:
         ids = [expt.uid for expt in selected_expts]
@@ -94,7 +101,7 @@ if __name__ == '__main__':
         # Dispose DB engine before forking, otherwise child processes will
         # inherit and muck with the same connections. See:
         # http://docs.sqlalchemy.org/en/rel_1_0/faq/connections.html#how-do-i-use-engines-connections-sessions-with-python-multiprocessing-or-os-fork
-        database.engine.dispose()
+        database.get_engine().dispose()
         
         pool = multiprocessing.Pool(processes=args.workers, maxtasksperchild=1)
         pool.map(submit_expt, ids, chunksize=1)  # note: maxtasksperchild is broken unless we also force chunksize
@@ -1,8 +1,21 @@
-import os, sys, glob, json
+"""
+Packages raw data for each recorded site into a combined NWB/JSON pair and
+submits it to LIMS.
+
+Submissions are handled in batches by SubmissionService: sites are checked
+concurrently, packaged in a pool of worker processes, and then handed to
+LIMS. The state of every site is kept in a local status table (see
+lims.SubmissionStatus), so that later status lookups do not have to query
+LIMS again.
+"""
+from __future__ import print_function
+import os, sys, glob, json, argparse, multiprocessing
+from multiprocessing.pool import ThreadPool
 import yaml
 from collections import OrderedDict
 from acq4.util.DataManager import getDirHandle
 from multipatch_analysis import config, lims
+from multipatch_analysis.lims import submission_status, submission_state
 
 
 class LIMSSubmission(object):
@@ -18,6 +31,10 @@ class LIMSSubmission(object):
         # in order to force the data to be uploaded to a specific specimen
         # that will not be used for real data.
         self.spec_name = _override_spec_name
+
+        # may be filled in ahead of check() by SubmissionService
+        self.spec_id = None
+        self.roi_plans = None
         
     def check(self):
         errors = []
@@ -33,16 +50,19 @@ class LIMSSubmission(object):
         if self.spec_name is None:
             self.spec_name = self.site_dh.parent().info()['specimen_ID'].strip()
         
-        try:
-            sid = lims.specimen_id_from_name(self.spec_name)
-        except ValueError as err:
-            errors.append(err.message)
-            # bail out here; downstream checks will fail.
-            return errors, warnings
-        self.spec_id = sid
+        if self.spec_id is None:
+            try:
+                self.spec_id = lims.specimen_id_from_name(self.spec_name)
+            except ValueError as err:
+                errors.append(err.message)
+                # bail out here; downstream checks will fail.
+                return errors, warnings
+        sid = self.spec_id
         
         # LIMS upload will fail if the specimen has not been given an ephys roi plan.
-        roi_plans = lims.specimen_ephys_roi_plans(self.spec_name)
+        if self.roi_plans is None:
+            self.roi_plans = lims.specimen_ephys_roi_plans(self.spec_name)
+        roi_plans = self.roi_plans
         lims_edit_href = '<a href="http://lims2/specimens/{sid}/edit">http://lims2/specimens/{sid}/edit</a>'.format(sid=sid)
         if len(roi_plans) == 0:
             errors.append('Specimen has no ephys roi plan. Edit:' + lims_edit_href)
@@ -57,6 +77,7 @@ class LIMSSubmission(object):
         source_nwb_files = [f['path'] for f in self.files if f['category'] == 'MIES physiology']
         if len(source_nwb_files) == 0:
             errors.append("%d NWB files specified (should be 1)" % len(source_nwb_files))
+            return errors, warnings
         self.source_nwb = source_nwb_files[0]
         
         return errors, warnings
@@ -65,40 +86,235 @@ class LIMSSubmission(object):
         return {'lims': None}
         
     def submit(self):
-        import nwb_packaging
-        
         assert len(self.check()[0]) == 0
         
         # Generate combined NWB file
         print("Generating combined NWB file..")
-        slice_dh = self.site_dh.parent()
-        file_paths = [slice_dh[f['path']].name() for f in self.files if f['path'] is not self.source_nwb]
-        source_nwb = slice_dh[self.source_nwb].name()
-        combined_nwb = nwb_packaging.buildCombinedNWB(source_nwb, file_paths)
-        assert os.path.isfile(combined_nwb)
-        
-        # Generate json metadata file
-        json_file = os.path.splitext(combined_nwb)[0] + '.json'
-        json.dump(self.meta, open(json_file, 'wb'))
+        combined_nwb, json_file = package_submission(self.package_args())
         print("Generated files:")
         print("    " + combined_nwb)
         print("    " + json_file)
-        
-        # submit to LIMS
+
+        self.submit_files(combined_nwb, json_file)
+
+    def package_args(self):
+        """Return the arguments to package_submission() for this site.
+        """
+        slice_dh = self.site_dh.parent()
+        file_paths = [slice_dh[f['path']].name() for f in self.files if f['path'] is not self.source_nwb]
+        source_nwb = slice_dh[self.source_nwb].name()
+        return source_nwb, file_paths, self.meta
+
+    def submit_files(self, combined_nwb, json_file):
+        """Submit packaged files to LIMS, then delete them.
+        """
         print("Submitting to LIMS..")
-        self.lims_incoming_files = lims.submit_expt(self.spec_name, str(self.meta['acq_timestamp']), combined_nwb, json_file)
-        
-        # delete submission files
-        os.remove(json_file)
-        os.remove(combined_nwb)
+        try:
+            self.lims_incoming_files = lims.submit_expt(self.spec_name, str(self.meta['acq_timestamp']), combined_nwb, json_file)
+        finally:
+            # delete submission files
+            remove_package(combined_nwb, json_file)
+
+    def status(self, refresh=False):
+        """Return the (state, message) recorded for this site in the local
+        status table (see lims.SubmissionStatus), or (None, '') if nothing has been
+        submitted.
 
-    def status(self):
-        ts = self.meta['acq_timestamp']
-        return lims.expt_submissions(self.spec_id, ts)
+        LIMS is only queried if the site has no recorded state, or if *refresh*
+        is True and the site has not yet succeeded.
+        """
+        table = submission_status()
+        site_path = self.site_dh.name()
+        rec = table.get(site_path)
+        if rec is None or (refresh and rec['state'] not in table.final_states):
+            ts = self.meta['acq_timestamp']
+            state, message = submission_state(lims.expt_submissions(self.spec_id, ts))
+            if state is not None:
+                table.set(site_path, state, message, self.spec_name, self.spec_id, ts)
+                return state, message
+            if rec is None:
+                return None, ''
+        return rec['state'], rec['message']
+
+
+def package_submission(args):
+    """Build the combined NWB and JSON metadata files for a submission.
+
+    *args* is (source_nwb, file_paths, meta) as returned by
+    LIMSSubmission.package_args(). Returns (combined_nwb, json_file).
+    This runs in SubmissionService worker processes.
+    """
+    from multipatch_analysis import nwb_packaging
+    source_nwb, file_paths, meta = args
+
+    combined_nwb = nwb_packaging.buildCombinedNWB(source_nwb, file_paths)
+    assert os.path.isfile(combined_nwb)
+
+    # Generate json metadata file
+    json_file = os.path.splitext(combined_nwb)[0] + '.json'
+    json.dump(meta, open(json_file, 'wb'))
+    return combined_nwb, json_file
+
+
+def remove_package(combined_nwb, json_file):
+    """Delete files written by package_submission().
+
+    The folder they are in (nwb_packaging.tmpdir) is left in place; it is
+    created once per process and reused by later packaging calls.
+    """
+    for f in (json_file, combined_nwb):
+        if os.path.isfile(f):
+            os.remove(f)
+
+
+class SubmissionService(object):
+    """Submits many sites to LIMS in one batch.
+
+    1. Specimen IDs for all sites are looked up together (see lims.specimen_records),
+       then the remaining per-site checks run in a pool of *workers* threads.
+    2. Sites that pass are packaged in a pool of *processes* worker processes.
+    3. Packages are submitted to LIMS one at a time as they become ready.
+
+    The outcome for each site is recorded in the status table (see lims.submission_status()).
+    """
+    def __init__(self, workers=8, processes=None, status=None):
+        self.workers = workers
+        self.processes = processes or multiprocessing.cpu_count()
+        self.status = submission_status() if status is None else status
+
+    def prepare(self, site_dhs):
+        """Return a LIMSSubmission for each site, with specimen IDs filled in
+        from a single batch of LIMS queries.
+        """
+        subs = []
+        for dh in site_dhs:
+            subs.append(LIMSSubmission(dh, read_file_manifest(dh)))
+
+        names = [dh.parent().info()['specimen_ID'].strip() for dh in site_dhs]
+        recs = lims.specimen_records(specimen_names=names)
+        for sub, name in zip(subs, names):
+            if sub.spec_name is None:
+                sub.spec_name = name
+            if len(recs.get(name, [])) == 1:
+                sub.spec_id = recs[name][0]['specimen_id']
+        return subs
+
+    def check(self, subs):
+        """Run check() on many submissions concurrently. Returns a list of
+        (errors, warnings) in the same order; sites with errors are recorded
+        in the status table.
+        """
+        def check(sub):
+            try:
+                return sub.check()
+            except Exception as exc:
+                return ['Error checking submission: %s' % exc], []
+
+        pool = ThreadPool(self.workers)
+        try:
+            results = pool.map(check, subs)
+        finally:
+            pool.close()
 
+        failed = [(sub.site_dh.name(), 'error', '\n'.join(err), sub.spec_name, sub.spec_id, None)
+                  for sub, (err, warn) in zip(subs, results) if len(err) > 0]
+        self.status.set_many(failed)
+        return results
 
-def find_submittable_expts():
+    def submit(self, site_dhs):
+        """Check, package and submit all sites. Returns {site_path: (state, message)}.
+        """
+        subs = self.prepare(site_dhs)
+        results = self.check(subs)
+        ready = [sub for sub, (err, warn) in zip(subs, results) if len(err) == 0]
+
+        outcome = OrderedDict()
+        for sub, (err, warn) in zip(subs, results):
+            if len(err) > 0:
+                outcome[sub.site_dh.name()] = ('error', '\n'.join(err))
+        if len(ready) == 0:
+            return outcome
+
+        pool = multiprocessing.Pool(min(self.processes, len(ready)))
+        try:
+            packages = pool.imap(_package_submission, [sub.package_args() for sub in ready])
+            for i, sub in enumerate(ready):
+                site_path = sub.site_dh.name()
+                print("=== Submit site %d/%d : %s" % (i+1, len(ready), site_path))
+                try:
+                    result = packages.next()
+                    if isinstance(result, Exception):
+                        raise result
+                    sub.submit_files(*result)
+                    state, message = 'submitted', ''
+                except Exception as exc:
+                    sys.excepthook(*sys.exc_info())
+                    state, message = 'error', str(exc)
+                self.status.set(site_path, state, message, sub.spec_name, sub.spec_id, sub.meta['acq_timestamp'])
+                outcome[site_path] = (state, message)
+        finally:
+            pool.close()
+            pool.join()
+
+        return outcome
+
+    def refresh(self, states=('submitted', 'trigger pending', 'trigger failed')):
+        """Query LIMS for the current state of all sites recorded in any of
+        *states*, and update the status table. Returns the number of sites
+        whose state changed.
+        """
+        recs = self.status.by_state(*states)
+
+        def query(rec):
+            try:
+                return submission_state(lims.expt_submissions(rec['spec_id'], rec['acq_timestamp']))
+            except Exception as exc:
+                return exc
+
+        pool = ThreadPool(self.workers)
+        try:
+            results = pool.map(query, recs)
+        finally:
+            pool.close()
+
+        updates = []
+        for rec, result in zip(recs, results):
+            if isinstance(result, Exception):
+                print("Error checking LIMS status of %s: %s" % (rec['site_path'], result))
+                continue
+            state, message = result
+            if state is not None and (state, message) != (rec['state'], rec['message']):
+                updates.append((rec['site_path'], state, message, None, None, None))
+        self.status.set_many(updates)
+        return len(updates)
+
+
+def _package_submission(args):
+    # pool.imap would abandon the remaining results after the first exception
+    try:
+        return package_submission(args)
+    except Exception as exc:
+        return exc
+
+
+def read_file_manifest(dh):
+    """Return the list of files in a site's file_manifest.yml.
+    """
+    files = yaml.load(open(dh['file_manifest.yml'].name(), 'rb'))
+    
+    # file manifests are written by windows, so we have to re-normalize the file names.
+    for f in files:
+        f['path'] = os.path.join(*f['path'].split('\\'))
+    return files
+
+
+def find_submittable_expts(workers=8):
     """Search synphys data storage for experiments that are ready to be submitted to LIMS.
+
+    Sites with a recorded state in the status table are skipped without
+    contacting LIMS (except those in the 'error' state, which are retried).
+    LIMS is only checked for sites that have no recorded state; anything
+    already submitted is recorded so it is not checked again.
     """
     
     # Start by finding all site paths that have an nwb file and a file_manifest.yml
@@ -110,49 +326,79 @@ def find_submittable_expts():
             all_sites[path] = 1
     
     # filter out anything that has been submitted already
-    ready_sites = []
-    for path in all_sites.keys():
-        site_dh = getDirHandle(path)
+    table = submission_status()
+    known = table.get_many(all_sites.keys())
+    site_dhs = [getDirHandle(path) for path in all_sites.keys()
+                if path not in known or known[path]['state'] == 'error']
+
+    names = [dh.parent().info()['specimen_ID'].strip() for dh in site_dhs]
+    recs = lims.specimen_records(specimen_names=names)
+
+    def check_site(args):
+        site_dh, spec_name = args
         acq_ts = site_dh.info()['__timestamp__']
-        spec_name = site_dh.parent().info()['specimen_ID'].strip()
-        spec_id = lims.specimen_id_from_name(spec_name)
-        subs = lims.expt_submissions(spec_id, acq_ts)
-        if len(subs) == 0:
+        if len(recs.get(spec_name, [])) == 1:
+            spec_id = recs[spec_name][0]['specimen_id']
+        else:
+            spec_id = lims.specimen_id_from_name(spec_name)
+        state, message = submission_state(lims.expt_submissions(spec_id, acq_ts))
+        return state, message, spec_id, acq_ts
+
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(check_site, zip(site_dhs, names))
+    finally:
+        pool.close()
+
+    ready_sites = []
+    updates = []
+    for site_dh, spec_name, (state, message, spec_id, acq_ts) in zip(site_dhs, names, results):
+        if state is None:
             ready_sites.append(site_dh)
+        else:
+            updates.append((site_dh.name(), state, message, spec_name, spec_id, acq_ts))
+    table.set_many(updates)
 
     return ready_sites
     
 
 def submit_site(dh):
-    files = yaml.load(open(dh['file_manifest.yml'].name(), 'rb'))
-    
-    # file manifests are written by windows, so we have to re-normalize the file names.
-    for f in files:
-        f['path'] = os.path.join(*f['path'].split('\\'))
-        
-    sub = LIMSSubmission(dh, files)
+    sub = LIMSSubmission(dh, read_file_manifest(dh))
     err, warn = sub.check()
     if len(err) > 0:
         raise Exception('LIMS submission errors:' + '\n'.join(err))
     
     sub.submit()
+    submission_status().set(dh.name(), 'submitted', '', sub.spec_name, sub.spec_id, sub.meta['acq_timestamp'])
     
     return sub
     
     
 if __name__ == '__main__':
-    print("Searching for sites to submit..")
-    sites = find_submittable_expts()
-    
-    subs = []
-    for i,site in enumerate(sites):
-        print("=== Submit site %d/%d : %s" % (i, len(sites), site))
-        try:
-            sub = submit_site(site)
-            subs.append(sub)
-        except Exception as exc:
-            sys.excepthook(*sys.exc_info())
-            subs.append(exc)
-            
-    
-    
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Submit experiments to LIMS.")
+    parser.add_argument('--workers', type=int, default=8, help="Number of threads used to query LIMS")
+    parser.add_argument('--processes', type=int, default=None, help="Number of processes used to package NWB files")
+    parser.add_argument('--status', action='store_true', default=False, help="Print the recorded submission status of all sites and exit")
+    parser.add_argument('--refresh', action='store_true', default=False, help="Update the status of submitted sites from LIMS and exit")
+    args = parser.parse_args(sys.argv[1:])
+
+    service = SubmissionService(workers=args.workers, processes=args.processes)
+
+    if args.refresh:
+        n = service.refresh()
+        print("Updated status of %d sites." % n)
+    elif args.status:
+        for rec in service.status.by_state():
+            print("%-16s %s" % (rec['state'], rec['site_path']))
+            if rec['state'] in ('error', 'trigger failed') and rec['message']:
+                print("    " + rec['message'].replace('\n', '\n    '))
+    else:
+        print("Searching for sites to submit..")
+        sites = find_submittable_expts(workers=args.workers)
+        print("Found %d sites." % len(sites))
+        outcome = service.submit(sites)
+        counts = OrderedDict()
+        for state, message in outcome.values():
+            counts[state] = counts.get(state, 0) + 1
+        for state, n in counts.items():
+            print("%s: %d" % (state, n))
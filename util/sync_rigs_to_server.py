@@ -16,21 +16,60 @@ rsync itself, but in practice this presents a few difficult issues:
   subprocessing, CLI flag generation, and fragile pipe communication.
 """
 
-import os, sys, shutil, glob, traceback, pickle, time
+import os, sys, shutil, glob, traceback, time, json, threading, argparse
+from multiprocessing.pool import ThreadPool
 from acq4.util.DataManager import getDirHandle
 
 from multipatch_analysis import config
-from multipatch_analysis.util import sync_file
+from multipatch_analysis.util import sync_file, RateLimiter
+from multipatch_analysis.experiment_paths import experiment_path_index
+
+
+class SyncLog(object):
+    """Collects sync log messages and appends them to the sync_log file on the
+    server in batches, rather than reopening the file for every message.
+    """
+    def __init__(self, filename=None, batch_size=200):
+        if filename is None:
+            filename = os.path.join(config.synphys_data, 'sync_log')
+        self.filename = filename
+        self.batch_size = batch_size
+        self._lines = []
+        self._lock = threading.Lock()
+
+    def log(self, msg):
+        print(msg)
+        with self._lock:
+            self._lines.append(msg)
+            full = len(self._lines) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            lines = self._lines
+            self._lines = []
+            if len(lines) == 0:
+                return
+            with open(self.filename, 'ab') as log_fh:
+                log_fh.write('\n'.join(lines) + '\n')
 
 
 class RawDataSubmission(object):
     """Copies all raw data to a central server.
+
+    submit() does the whole sync serially. Alternatively, plan() returns the list
+    of files to copy, each of which is passed to transfer() (possibly from several
+    threads), followed by a call to finish().
     """
     message = "Copying data to server"
     
-    def __init__(self, site_dh):
+    def __init__(self, site_dh, sync_log=None):
         self.changes = None
         self.site_dh = site_dh
+        self._own_log = sync_log is None
+        self.sync_log = SyncLog() if sync_log is None else sync_log
+        self._lock = threading.Lock()
         
     def check(self):
         return [], []
@@ -39,14 +78,25 @@ class RawDataSubmission(object):
         return {'raw_data': None}
         
     def submit(self):
+        for src_path, dst_path in self.plan():
+            self.transfer(src_path, dst_path)
+        self.finish()
+
+    def plan(self):
+        """Create directories on the server and return a list of (src, dst) for
+        all files that may need to be copied.
+        """
         self.changes = []
+        self.tasks = []
+        self.skipped = 0
+        self.newest_mtime = 0
+        self.server_site_path = None
         site_dh = self.site_dh
         slice_dh = site_dh.parent()
         expt_dh = slice_dh.parent()
         
         now = time.strftime('%Y-%m-%d_%H:%M:%S')
         self.log("========== %s : Sync %s to server" % (now, site_dh.name()))
-        self.skipped = 0
         
         try:
             # Decide how the top-level directory will be named on the remote server
@@ -56,31 +106,68 @@ class RawDataSubmission(object):
             
             self.server_path = server_expt_path
             self.log("    using server path: %s" % server_expt_path)
-            self._sync_paths(expt_dh.name(), server_expt_path)
+            self._plan_paths(expt_dh.name(), server_expt_path)
             
             # Copy slice files if needed
             server_slice_path = os.path.join(server_expt_path, slice_dh.shortName())
-            self._sync_paths(slice_dh.name(), server_slice_path)
+            self._plan_paths(slice_dh.name(), server_slice_path)
 
             # Copy site files if needed
             server_site_path = os.path.join(server_slice_path, site_dh.shortName())
-            self._sync_paths(site_dh.name(), server_site_path)
-            
-            self.log("    Done; skipped %d files." % self.skipped)
-            
-            # Leave a note about the source of this data
-            open(os.path.join(server_site_path, 'sync_source'), 'wb').write(site_dh.name())
+            self._plan_paths(site_dh.name(), server_site_path)
+            self.server_site_path = server_site_path
         except Exception:
             err = traceback.format_exc()
             self.changes.append(('error', site_dh.name(), err))
             self.log(err)
+            self.tasks = []
+        return self.tasks
+
+    def transfer(self, src_path, dst_path, **kwds):
+        """Copy one file from plan() to the server if needed. Extra keyword
+        arguments are passed to sync_file().
+        """
+        try:
+            status = sync_file(src_path, dst_path, **kwds)
+        except Exception:
+            err = traceback.format_exc()
+            self.changes.append(('error', src_path, err))
+            self.log(err)
+            return
+        if status == 'skip':
+            with self._lock:
+                self.skipped += 1
+        elif status == 'copy':
+            self.log("    copy %s => %s" % (src_path, dst_path))
+            self.changes.append(('copy', src_path, dst_path))
+        elif status == 'update':
+            self.log("    updt %s => %s" % (src_path, dst_path))
+            self.changes.append(('update', src_path, dst_path))
+
+    def finish(self):
+        """Record completion of the sync once all files have been transferred.
+        """
+        try:
+            if self.server_site_path is not None and not self.failed:
+                self.log("    Done; skipped %d files." % self.skipped)
+                
+                # Leave a note about the source of this data
+                open(os.path.join(self.server_site_path, 'sync_source'), 'wb').write(self.site_dh.name())
+        except Exception:
+            err = traceback.format_exc()
+            self.changes.append(('error', self.site_dh.name(), err))
+            self.log(err)
+        if self._own_log:
+            self.sync_log.flush()
+
+    @property
+    def failed(self):
+        return any(ch[0] == 'error' for ch in self.changes)
 
     def log(self, msg):
-        print(msg)
-        with open(os.path.join(config.synphys_data, 'sync_log'), 'ab') as log_fh:
-            log_fh.write(msg+'\n')
+        self.sync_log.log(msg)
         
-    def _sync_paths(self, source, target):
+    def _plan_paths(self, source, target):
         """Non-recursive directory sync.
         """
         if not os.path.isdir(target):
@@ -100,101 +187,177 @@ class RawDataSubmission(object):
                     self.changes.append(('error', src_path, 'file too large'))
                     continue
                 
-                status = sync_file(src_path, dst_path)
-                if status == 'skip':
-                    self.skipped += 1
-                elif status == 'copy':
-                    self.log("    copy %s => %s" % (src_path, dst_path))
-                    self.changes.append(('copy', src_path, dst_path))
-                elif status == 'update':
-                    self.log("    updt %s => %s" % (src_path, dst_path))
-                    self.changes.append(('update', src_path, dst_path))
+                self.newest_mtime = max(self.newest_mtime, src_stat.st_mtime)
+                self.tasks.append((src_path, dst_path))
+
+
+class SyncManifest(object):
+    """Persistent record of the state of each site at its last successful sync.
+
+    A site is considered unchanged (and can be skipped without listing or
+    stat-ing its files) if the modification times of its site, slice and
+    experiment directories are the same as when it was last synced, and none of
+    its files had been modified within *settle_time* seconds of that sync.
+    Recently acquired sites are always checked, because acquisition files may be
+    modified in place without changing their directory's mtime.
+    """
+    def __init__(self, filename=None, settle_time=24*3600):
+        if filename is None:
+            cache_path = config.cache_path
+            if not os.path.isabs(cache_path):
+                cache_path = os.path.join(os.path.expanduser('~'), cache_path)
+            filename = os.path.join(cache_path, 'sync_manifest.json')
+        self.filename = filename
+        self.settle_time = settle_time
+        self.sites = {}
+        if os.path.isfile(filename):
+            try:
+                self.sites = json.load(open(filename, 'rb'))
+            except Exception:
+                print("Error loading sync manifest; all sites will be checked:")
+                sys.excepthook(*sys.exc_info())
+
+    @staticmethod
+    def _dir_mtimes(site_dir):
+        slice_dir = os.path.dirname(site_dir)
+        expt_dir = os.path.dirname(slice_dir)
+        return [os.stat(d).st_mtime for d in (site_dir, slice_dir, expt_dir)]
+
+    def is_unchanged(self, site_dir):
+        rec = self.sites.get(site_dir)
+        if rec is None:
+            return False
+        if rec['synced'] - rec['newest_mtime'] < self.settle_time:
+            return False
+        return self._dir_mtimes(site_dir) == rec['dir_mtimes']
+
+    def record(self, site_dir, newest_mtime):
+        self.sites[site_dir] = {
+            'dir_mtimes': self._dir_mtimes(site_dir),
+            'newest_mtime': newest_mtime,
+            'synced': time.time(),
+        }
+
+    def save(self):
+        path = os.path.dirname(self.filename)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        tmp = self.filename + '.tmp'
+        json.dump(self.sites, open(tmp, 'wb'))
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tmp, self.filename)
+
+
+class SyncScheduler(object):
+    """Synchronizes many sites from rig raw data paths to the server.
+
+    Sites whose directories are unchanged since their last sync are skipped (see
+    SyncManifest). Directory creation and server path lookup for the remaining
+    sites happen serially, then all of their files are transferred with a pool of
+    *workers* threads sharing an optional *max_bandwidth* cap (bytes/sec).
+    """
+    def __init__(self, workers=4, max_bandwidth=None, manifest=None, sync_log=None):
+        self.workers = workers
+        self.max_bandwidth = max_bandwidth
+        self.manifest = SyncManifest() if manifest is None else manifest
+        self.sync_log = SyncLog() if sync_log is None else sync_log
+
+    def scan(self, raw_data_paths=None):
+        """Return a list of all site directories in *raw_data_paths*
+        (default config.raw_data_paths).
+        """
+        if raw_data_paths is None:
+            raw_data_paths = config.raw_data_paths
+        sites = []
+        for raw_data_path in raw_data_paths:
+            sites.extend(find_all_sites(raw_data_path))
+        return sites
+
+    def run(self, sites=None, full=False):
+        """Sync *sites* (default: all sites from scan()) to the server.
+
+        Unless *full* is True, sites recorded as unchanged in the manifest are
+        skipped. Returns a list of (site_dir, changes, errors, warnings) for all
+        sites that changed or failed.
+        """
+        if sites is None:
+            sites = self.scan()
+        log = []
+        subs = []
+        tasks = []
+        n_skipped = 0
+        try:
+            for site_dir in sites:
+                try:
+                    if not full and self.manifest.is_unchanged(site_dir):
+                        n_skipped += 1
+                        continue
+                    sub = RawDataSubmission(getDirHandle(site_dir), sync_log=self.sync_log)
+                    err, warn = sub.check()
+                    if len(err) > 0:
+                        log.append((site_dir, [], err, warn))
+                        continue
+                    for src_path, dst_path in sub.plan():
+                        tasks.append((sub, src_path, dst_path))
+                    subs.append((site_dir, sub, warn))
+                except Exception:
+                    exc = traceback.format_exc()
+                    print(exc)
+                    log.append((site_dir, [], exc, []))
+            self.sync_log.log("Sync: %d sites unchanged, checking %d files from %d sites" % (n_skipped, len(tasks), len(subs)))
+
+            limiter = None if self.max_bandwidth is None else RateLimiter(self.max_bandwidth)
+            def transfer(task):
+                sub, src_path, dst_path = task
+                sub.transfer(src_path, dst_path, limiter=limiter, progress=False)
+
+            pool = ThreadPool(self.workers)
+            try:
+                pool.map(transfer, tasks, chunksize=1)
+            finally:
+                pool.close()
+
+            for site_dir, sub, warn in subs:
+                sub.finish()
+                if len(sub.changes) > 0:
+                    log.append((site_dir, sub.changes, [], warn))
+                if not sub.failed:
+                    self.manifest.record(site_dir, sub.newest_mtime)
+        finally:
+            self.manifest.save()
+            self.sync_log.flush()
+        return log
 
 
 def get_experiment_server_path(dh):
     server_path = config.synphys_data
     acq_timestamp = dh.info()['__timestamp__']
     
-    # First check the cache
-    cache = experiment_path_cache()
-    if acq_timestamp in cache:
-        return os.path.join(server_path, cache[acq_timestamp])
-    
-    # We have not already submitted a site from this experiment folder;
-    # look for a suitable new directory name on the server
+    # Look up the experiment in the path index, or reserve a new directory name
+    # on the server if we have not already submitted a site from this experiment folder
+    index = experiment_path_index()
     expt_base_name = dh.shortName().split('_')[0]
-    expt_dirs = set(os.listdir(server_path))
-    i = 0
-    while True:
-        expt_name = expt_base_name + '_%03d' % i
-        if expt_name not in expt_dirs:
-            break
-        i += 1
+    expt_name, created = index.reserve(acq_timestamp, expt_base_name)
     server_expt_path = os.path.join(server_path, expt_name)
-    assert not os.path.exists(server_expt_path)
+    if not created:
+        return server_expt_path
     
-    os.mkdir(server_expt_path)
     try:
+        assert not os.path.exists(server_expt_path)
+        os.mkdir(server_expt_path)
         dh = getDirHandle(server_expt_path)
         # temporarily mark with timestamp; should be overwritten later.
         dh.setInfo(__timestamp__=acq_timestamp)
     except Exception:
         if os.path.exists(server_expt_path):
             shutil.rmtree(server_expt_path)
+        index.remove(acq_timestamp)
         raise
     
-    cache[acq_timestamp] = expt_name
-    write_expt_path_cache()
-    
     return server_expt_path
 
 
-_expt_path_cache = None
-def experiment_path_cache():
-    global _expt_path_cache
-    if _expt_path_cache is None:
-        cache_file = os.path.join(config.synphys_data, 'experiment_path_cache.pkl')
-        if os.path.isfile(cache_file):
-            try:
-                _expt_path_cache = pickle.load(open(cache_file, 'rb'))
-            except Exception:
-                print("Error loading experiment path cache; will regenerate:")
-                sys.excepthook(*sys.exc_info())
-                generate_expt_path_cache()
-        else:
-            generate_expt_path_cache()
-    return _expt_path_cache
-
-
-def generate_expt_path_cache():
-    global _expt_path_cache
-    _expt_path_cache = {}
-    root = getDirHandle(config.synphys_data)
-    for f in root.ls():
-        if 'recycle' in f.lower():
-            continue
-        dh = root[f]
-        if not dh.isDir():
-            continue
-        try:
-            acq_timestamp = dh.info()['__timestamp__']
-        except KeyError:
-            print("NO TIMESTAMP:", dh.name())
-            sys.exit(-1)
-        if acq_timestamp in _expt_path_cache:
-            raise Exception("timestamp %s appears twice in synphys data!!" % acq_timestamp)
-        _expt_path_cache[acq_timestamp] = dh.name(relativeTo=root)
-    write_expt_path_cache()
-    
-    
-def write_expt_path_cache():
-    global _expt_path_cache
-    cache_file = os.path.join(config.synphys_data, 'experiment_path_cache.pkl')
-    tmp = cache_file+'.tmp'
-    pickle.dump(_expt_path_cache, open(tmp, 'wb'))
-    os.rename(tmp, cache_file)
-    
-
 def sync_experiment(site_dir):
     dh = getDirHandle(site_dir)
     sub = RawDataSubmission(dh)
@@ -211,51 +374,40 @@ def find_all_sites(root):
     return sites
     
 
-def sync_all(log):
-    for raw_data_path in config.raw_data_paths:
-        paths = find_all_sites(raw_data_path)
-        sync_paths(paths, log)
+def sync_all(log, **kwds):
+    """Sync all sites found in config.raw_data_paths, skipping those that are
+    unchanged since their last sync. Keyword arguments are passed to SyncScheduler.
+    """
+    log.extend(SyncScheduler(**kwds).run())
 
 
-def sync_paths(paths, log):
-    for site_dir in paths:
-        try:
-            changes, err, warn = sync_experiment(site_dir)
-            if len(changes) > 0:
-                log.append((site_dir, changes, err, warn))
-        except Exception:
-            exc = traceback.format_exc()
-            print(exc)
-            log.append((site_dir, [], exc, []))
+def sync_paths(paths, log, **kwds):
+    """Sync the given site directories. Keyword arguments are passed to SyncScheduler.
+    """
+    log.extend(SyncScheduler(**kwds).run(paths, full=True))
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*', help="Site directories to sync (default: all sites in config.raw_data_paths)")
+    parser.add_argument('--workers', type=int, default=4, help="Number of files to copy concurrently")
+    parser.add_argument('--max-bandwidth', type=float, default=None, dest='max_bandwidth', help="Combined bandwidth limit in MB/s")
+    parser.add_argument('--full', action='store_true', default=False, help="Check all sites, even those unchanged since their last sync")
+    args = parser.parse_args()
+
+    opts = {'workers': args.workers}
+    if args.max_bandwidth is not None:
+        opts['max_bandwidth'] = args.max_bandwidth * 1e6
+
     log = []
-    
-    paths = sys.argv[1:]
-    if len(paths) == 0:
-        sync_all(log)
+    if len(args.paths) == 0:
+        scheduler = SyncScheduler(**opts)
+        log.extend(scheduler.run(full=args.full))
     else:
-        sync_paths(paths, log)
+        sync_paths(args.paths, log, **opts)
     
     errs = [change for site in log for change in site[1] if change[0] == 'error']
     print("\n----- DONE ------\n   %d errors" % len(errs))
     
     for err in errs:
         print(err[1], err[2])
-    
-    #sites = find_all_sites(config.raw_data_paths[1])
-    #path = get_experiment_server_path(getDirHandle(sites[0]).parent().parent())
-    #changes, err, warn = sync_experiment(sites[0])
-    
-    #print("CHANGES:")
-    #for ch in changes:
-        #print(ch)
-        
-    #print("ERRORS:")
-    #print("\n".join(err))
-    
-    #print("WARNINGS:")
-    #print("\n".join(warn))
-    
-    
\ No newline at end of file